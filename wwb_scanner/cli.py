@@ -0,0 +1,124 @@
+'''Headless command line interface
+
+Only the modules needed to run a scan and save it are imported (never the
+GUI or plotting libraries), so startup stays within
+:data:`STARTUP_BUDGET`::
+
+    python -m wwb_scanner.cli scan 470 608 -o scan.csv
+    python -m wwb_scanner.cli list
+'''
+import time
+
+START_TS = time.time()
+
+import sys
+import logging
+import argparse
+
+# Seconds allowed from the start of this module to the start of a scan
+STARTUP_BUDGET = .5
+
+# Modules that must not be loaded before scanning starts
+HEAVY_MODULES = ['scipy', 'matplotlib', 'kivy', 'rtlsdr']
+
+logger = logging.getLogger(__name__)
+
+def get_loaded_heavy_modules():
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+def check_startup(budget=STARTUP_BUDGET, start_ts=None):
+    '''Log a warning if startup took longer than ``budget`` seconds or
+    imported any of :data:`HEAVY_MODULES`
+
+    Returns the startup time
+    '''
+    if start_ts is None:
+        start_ts = START_TS
+    elapsed = time.time() - start_ts
+    if elapsed > budget:
+        logger.warning('startup took %.3fs (budget: %.3fs)', elapsed, budget)
+    loaded = get_loaded_heavy_modules()
+    if loaded:
+        logger.warning('modules loaded during startup: %s', ', '.join(loaded))
+    return elapsed
+
+def scan(args):
+    from wwb_scanner.scanner import Scanner
+    from wwb_scanner.scanner.reprocess import CLIProgress
+    device = dict(gain=args.gain, is_simulated=args.simulated)
+    if args.device_index is not None:
+        device['device_index'] = args.device_index
+    if args.serial_number is not None:
+        device['serial_number'] = args.serial_number
+    sampling = {}
+    if args.sample_rate is not None:
+        sampling['sample_rate'] = args.sample_rate
+    scanner = Scanner(config=dict(
+        scan_range=[args.start, args.end],
+        checkpoint_scans=args.checkpoint,
+        device=device,
+        sampling=sampling,
+    ))
+    elapsed = check_startup()
+    if args.timing:
+        sys.stderr.write('startup: %.3fs\n' % (elapsed))
+    scanner.on_progress = CLIProgress()
+    scanner.run_scan()
+    scanner.on_progress(1.)
+    if args.output:
+        scanner.spectrum.export_to_file(filename=args.output,
+                                        frequency_format=args.frequency_format)
+    if scanner.save_future is not None:
+        scanner.save_future.result()
+    if args.timing:
+        sys.stderr.write('total: %.3fs\n' % (time.time() - START_TS))
+    return scanner.spectrum
+
+def list_scans(args):
+    import datetime
+    from wwb_scanner.utils.dbstore import db_store
+    scans = db_store.query_scans(limit=args.limit, name=args.name)
+    for d in scans:
+        ts = d['timestamp_utc']
+        if ts is not None:
+            ts = datetime.datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+        print('%6s  %-19s  %8s - %-8s  %7s  %s' % (
+            d['eid'], ts, d['start_freq'], d['end_freq'], d['num_samples'], d['name']))
+    if args.timing:
+        sys.stderr.write('total: %.3fs\n' % (time.time() - START_TS))
+    return scans
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Headless RTL-SDR scanner')
+    p.add_argument('--timing', action='store_true',
+                   help='Print startup and run times to stderr')
+    sub = p.add_subparsers()
+
+    sp = sub.add_parser('scan', help='Run a scan and save it to the database')
+    sp.add_argument('start', type=float, help='Start frequency (MHz)')
+    sp.add_argument('end', type=float, help='End frequency (MHz)')
+    sp.add_argument('-o', '--output', help='Export the spectrum to this file')
+    sp.add_argument('-f', '--frequency-format', dest='frequency_format',
+                    help='Format string for exported frequencies')
+    sp.add_argument('-g', '--gain', type=float, default=30., help='Gain (dB)')
+    sp.add_argument('-s', '--sample-rate', type=float, dest='sample_rate',
+                    help='Sample rate (Hz)')
+    sp.add_argument('-d', '--device-index', type=int, dest='device_index')
+    sp.add_argument('--serial-number', dest='serial_number')
+    sp.add_argument('--simulated', action='store_true',
+                    help='Use a simulated device')
+    sp.add_argument('--no-checkpoint', action='store_false', dest='checkpoint',
+                    help='Do not checkpoint the scan')
+    sp.set_defaults(func=scan)
+
+    lp = sub.add_parser('list', help='List saved scans (newest first)')
+    lp.add_argument('-n', '--limit', type=int, default=20)
+    lp.add_argument('--name', help='Only scans with names containing this')
+    lp.set_defaults(func=list_scans)
+
+    args = p.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    return args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,2 @@
 from .exporters import BaseExporter, CSVExporter, WWBLegacyExporter, WWBExporter
-from .importers import BaseImporter, CSVImporter, WWBImporter
+from .importers import BaseImporter, CSVImporter, RtlPowerImporter, WWBImporter
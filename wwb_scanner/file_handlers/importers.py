@@ -1,28 +1,36 @@
 import os.path
+import re
+import time
 import datetime
 import xml.etree.ElementTree as ET
 import itertools
 
-from wwb_scanner.scan_objects import Spectrum
+import numpy as np
+
+from wwb_scanner.scan_objects import Spectrum, TimeBasedSpectrum
 
 class BaseImporter(object):
     def __init__(self, **kwargs):
         self.spectrum = Spectrum()
         self.filename = kwargs.get('filename')
     @classmethod
-    def import_file(cls, filename):
+    def import_file(cls, filename, **kwargs):
         ext = os.path.splitext(filename)[1].strip('.').lower()
         def find_importer(_cls):
-            if getattr(_cls, '_extension', None) == ext:
-                return _cls
             for _subcls in _cls.__subclasses__():
                 r = find_importer(_subcls)
                 if r is not None:
                     return r
+            if getattr(_cls, '_extension', None) == ext and _cls.is_valid_file(filename):
+                return _cls
             return None
         cls = find_importer(BaseImporter)
-        fh = cls(filename=filename)
+        kwargs['filename'] = filename
+        fh = cls(**kwargs)
         return fh()
+    @classmethod
+    def is_valid_file(cls, filename):
+        return True
     def __call__(self):
         self.file_data = self.load_file()
         self.parse_file_data()
@@ -46,6 +54,102 @@ class CSVImporter(BaseImporter):
             f, v = line.split(',')
             spectrum.add_sample(frequency=float(f), dbFS=float(v))
 
+class RtlPowerImporter(CSVImporter):
+    '''Importer for ``rtl_power`` CSV logs
+
+    The file is read in chunks of ``chunk_rows`` lines which are converted
+    to numeric arrays in bulk, so memory use does not grow with file size.
+
+    params:
+        time_based: if True, build a :class:`TimeBasedSpectrum` with one row
+            per sweep. Otherwise build a max-hold :class:`Spectrum`
+        freq_range: ``[start, end]`` (in MHz) to restrict the import to
+        time_range: ``[start, end]`` (as UTC timestamps) to restrict the
+            import to
+        chunk_rows: number of lines parsed at a time
+    '''
+    DATETIME_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d),\s*(\d\d):(\d\d):(\d\d)')
+    def __init__(self, **kwargs):
+        super(RtlPowerImporter, self).__init__(**kwargs)
+        self.time_based = kwargs.get('time_based', False)
+        if self.time_based:
+            self.spectrum = TimeBasedSpectrum()
+        self.freq_range = kwargs.get('freq_range')
+        self.time_range = kwargs.get('time_range')
+        self.chunk_rows = kwargs.get('chunk_rows', 4096)
+        self.max_hold = {}
+        self.sweep_timestamps = set()
+    @classmethod
+    def is_valid_file(cls, filename):
+        with open(filename, 'r') as f:
+            line = f.readline()
+        return cls.DATETIME_RE.match(line) is not None and line.count(',') >= 6
+    def __call__(self):
+        with open(self.filename, 'r') as f:
+            while True:
+                lines = list(itertools.islice(f, self.chunk_rows))
+                if not len(lines):
+                    break
+                self.parse_chunk(lines)
+        self.build_spectrum()
+        return self.spectrum
+    def parse_chunk(self, lines):
+        num_fields = set(line.count(',') for line in lines if line.strip())
+        if len(num_fields) > 1:
+            for line in lines:
+                self.parse_chunk([line])
+            return
+        text = self.DATETIME_RE.sub(r'\1\2\3,\4\5\6', ''.join(lines))
+        data = np.fromstring(text.replace('\n', ','), sep=',')
+        ncols = num_fields.pop() + 1
+        data = data[:data.size - data.size % ncols].reshape(-1, ncols)
+        timestamps = self.calc_timestamps(data[:, 0], data[:, 1])
+        hz_low, hz_high, hz_step = data[:, 2], data[:, 3], data[:, 4]
+        powers = data[:, 6:]
+        mask = np.ones(data.shape[0], dtype=bool)
+        if self.time_range is not None:
+            mask &= (timestamps >= self.time_range[0]) & (timestamps <= self.time_range[1])
+        if self.freq_range is not None:
+            # Bins start at hz_low and end before hz_high
+            mask &= (hz_high > self.freq_range[0] * 1e6) & (hz_low <= self.freq_range[1] * 1e6)
+        bin_index = np.arange(powers.shape[1])
+        for i in np.flatnonzero(mask):
+            freqs = (hz_low[i] + bin_index * hz_step[i]) / 1e6
+            self.add_row(timestamps[i], freqs, powers[i])
+    def calc_timestamps(self, dates, times):
+        keys = np.unique(np.stack([dates, times], axis=1), axis=0)
+        timestamps = np.empty(dates.size)
+        for d, t in keys:
+            dt = datetime.datetime.strptime('%08d%06d' % (d, t), '%Y%m%d%H%M%S')
+            ts = time.mktime(dt.timetuple())
+            timestamps[(dates == d) & (times == t)] = ts
+        return timestamps
+    def add_row(self, timestamp, freqs, powers):
+        if self.freq_range is not None:
+            in_range = (freqs >= self.freq_range[0]) & (freqs <= self.freq_range[1])
+            freqs, powers = freqs[in_range], powers[in_range]
+            if not freqs.size:
+                return
+        self.sweep_timestamps.add(timestamp)
+        if self.time_based:
+            self.spectrum.add_samples(freqs, dbFS=powers, timestamp=timestamp)
+            return
+        key = freqs[0]
+        if key in self.max_hold:
+            _freqs, _powers = self.max_hold[key]
+            np.maximum(_powers, powers, out=_powers)
+        else:
+            self.max_hold[key] = (freqs, powers.copy())
+    def build_spectrum(self):
+        spectrum = self.spectrum
+        if len(self.sweep_timestamps):
+            spectrum.timestamp_utc = min(self.sweep_timestamps)
+        if self.time_based:
+            return
+        for key in sorted(self.max_hold.keys()):
+            freqs, powers = self.max_hold[key]
+            spectrum.add_samples(freqs, dbFS=powers)
+
 class BaseWWBImporter(BaseImporter):
     def load_file(self):
         return ET.parse(self.filename)
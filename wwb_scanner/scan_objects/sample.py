@@ -17,7 +17,7 @@ class Sample(JSONMixin):
         return getattr(self, '_frequency', None)
     @frequency.setter
     def frequency(self, value):
-        if not isinstance(value, numbers.Number):
+        if value is None or not isinstance(value, (float, numbers.Number)):
             return
         if self.frequency == value:
             return
@@ -40,12 +40,17 @@ class Sample(JSONMixin):
     @property
     def magnitude(self):
         m = getattr(self, '_magnitude', None)
-        if m is None and self.iq is not None:
-            m = np.abs(self.iq)
+        if m is None:
+            if self.iq is not None:
+                m = np.abs(self.iq)
+            else:
+                db = getattr(self, '_dbFS', None)
+                if db is not None:
+                    m = 10 ** (db / 10.)
         return m
     @magnitude.setter
     def magnitude(self, value):
-        if not isinstance(value, numbers.Number):
+        if value is None or not isinstance(value, (float, numbers.Number)):
             return
         old = self.magnitude
         if old == value:
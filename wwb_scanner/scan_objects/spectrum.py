@@ -1,19 +1,21 @@
 import threading
 import datetime
 import time
+import base64
+
+import numpy as np
 
 from wwb_scanner.core import JSONMixin
-from wwb_scanner.utils.dbstore import db_store
+from wwb_scanner.utils.dbstore import db_store, db_writer
 from wwb_scanner.utils.color import Color
+from wwb_scanner.utils.samplecodec import (
+    encode_samples, decode_samples, DEFAULT_FORMAT, DB_RESOLUTION, FREQ_RESOLUTION,
+)
 from wwb_scanner.scan_objects import Sample, TimeBasedSample
-try:
-    from wwb_scanner import file_handlers
-except ImportError:
-    file_handlers = None
-try:
-    from wwb_scanner.ui.plots import SpectrumPlot
-except ImportError:
-    SpectrumPlot = None
+
+# Imported on first use (the plots import matplotlib)
+file_handlers = None
+SpectrumPlot = None
 
 EPOCH = datetime.datetime(1970, 1, 1)
 
@@ -35,7 +37,35 @@ def get_spectrum_plot():
         SpectrumPlot = _SpectrumPlot
     return SpectrumPlot
 
+class SpectrumSnapshot(object):
+    '''Immutable copy of the data in a :class:`Spectrum`
+
+    Attributes:
+        version: the :attr:`Spectrum.data_version` the snapshot was built from
+        frequencies: sorted frequencies (read-only array)
+        dbFS: values for each frequency (read-only array)
+    '''
+    __slots__ = ('version', 'frequencies', 'dbFS')
+    def __init__(self, version, frequencies, dbFS):
+        frequencies.flags.writeable = False
+        dbFS.flags.writeable = False
+        self.version = version
+        self.frequencies = frequencies
+        self.dbFS = dbFS
+    @property
+    def magnitude(self):
+        return 10 ** (self.dbFS / 10.)
+    def __len__(self):
+        return self.frequencies.size
+
 class Spectrum(JSONMixin):
+    # See :mod:`wwb_scanner.utils.samplecodec`
+    samples_encoding = DEFAULT_FORMAT
+    samples_db_resolution = DB_RESOLUTION
+    samples_freq_resolution = FREQ_RESOLUTION
+    # If True, snapshots are built by merging the samples changed since the
+    # previous snapshot into its arrays
+    incremental_snapshots = True
     def __init__(self, **kwargs):
         self.name = kwargs.get('name')
         self.eid = kwargs.get('eid')
@@ -57,8 +87,17 @@ class Spectrum(JSONMixin):
         self.step_size = kwargs.get('step_size')
         self.data_updated = threading.Event()
         self.data_update_lock = threading.Lock()
+        self.data_version = 0
+        self.live = False
+        self.snapshot_interval = kwargs.get('snapshot_interval', .1)
+        self._snapshot = None
+        self._last_publish = 0.
+        # Frequencies changed since the last snapshot (None if a full
+        # rebuild is needed)
+        self._changed_frequencies = None
         self.samples = {}
         self.center_frequencies = kwargs.get('center_frequencies', [])
+        self.resolution_regions = kwargs.get('resolution_regions', [])
     @property
     def datetime_utc(self):
         return getattr(self, '_datetime_utc', None)
@@ -121,7 +160,14 @@ class Spectrum(JSONMixin):
                 config.eid = value
     def _deserialize(self, **kwargs):
         samples = kwargs.get('samples', {})
-        if isinstance(samples, dict):
+        if isinstance(samples, dict) and 'encoding' in samples:
+            samples = decode_samples(samples['encoding'],
+                                     base64.b64decode(samples['data']))
+        if isinstance(samples, np.ndarray):
+            # Structured array loaded from the db store
+            if samples.size:
+                self.add_samples(samples['frequency'], dbFS=samples['dbFS'])
+        elif isinstance(samples, dict):
             for key, data in samples.items():
                 if isinstance(data, dict):
                     self.add_sample(**data)
@@ -162,10 +208,56 @@ class Spectrum(JSONMixin):
         sample = self._build_sample(**kwargs)
         self.set_data_updated()
         return sample
+    def add_samples(self, frequencies, **kwargs):
+        '''Add samples from arrays of frequencies and values
+
+        Values are given as one of the ``iq``, ``magnitude`` or ``dbFS``
+        keyword arguments. Behaves like repeated calls to :meth:`add_sample`
+        without rescanning the existing frequencies for every sample.
+        '''
+        key, values = self._get_sample_values(kwargs)
+        force_magnitude = kwargs.get('force_magnitude')
+        force_lower_freq = kwargs.get('force_lower_freq', True)
+        samples = self.samples
+        max_f = max(samples.keys()) if len(samples) else None
+        num_added = 0
+        for f, value in zip(list(frequencies), list(values)):
+            sample = samples.get(f)
+            if sample is not None:
+                if force_magnitude:
+                    setattr(sample, key, value)
+                continue
+            if max_f is not None and f < max_f and not force_lower_freq:
+                continue
+            self._build_sample(spectrum=self, frequency=f, **{key: value})
+            if max_f is None or f > max_f:
+                max_f = f
+            num_added += 1
+        self.set_data_updated()
+        return num_added
+    @staticmethod
+    def _get_sample_values(kwargs):
+        for key in ['iq', 'magnitude', 'dbFS']:
+            if key in kwargs:
+                return key, kwargs[key]
+        raise KeyError('One of iq, magnitude or dbFS is required')
     def _build_sample(self, **kwargs):
         sample = Sample(**kwargs)
         self.samples[sample.frequency] = sample
+        self._set_frequency_changed(sample.frequency)
         return sample
+    def _set_frequency_changed(self, f):
+        changed = self._changed_frequencies
+        if changed is not None:
+            changed.add(f)
+    def remove_samples_in_range(self, f_min, f_max):
+        keys = [f for f in self.samples.keys() if f_min <= f < f_max]
+        for key in keys:
+            del self.samples[key]
+        if len(keys):
+            self._changed_frequencies = None
+            self.set_data_updated()
+        return len(keys)
     def iter_frequencies(self):
         for key in sorted(self.samples.keys()):
             yield key
@@ -176,20 +268,105 @@ class Spectrum(JSONMixin):
         sample = kwargs.get('sample')
         if sample.frequency not in self.samples:
             return
+        self._set_frequency_changed(sample.frequency)
         self.set_data_updated()
     def set_data_updated(self):
         with self.data_update_lock:
+            self.data_version += 1
             self.data_updated.set()
+    def publish_snapshot(self, min_interval=None):
+        '''Build a :class:`SpectrumSnapshot` and make it the current one
+
+        Must be called from the thread that modifies the samples. If
+        ``min_interval`` is given, nothing is done unless that many seconds
+        have passed since the last snapshot was published.
+
+        Only the samples changed since the previous snapshot are read (see
+        :attr:`incremental_snapshots`), so the cost does not grow with the
+        number of samples in the spectrum.
+        '''
+        now = time.time()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self.data_version:
+            return snapshot
+        if min_interval is not None and now - self._last_publish < min_interval:
+            return snapshot
+        version = self.data_version
+        changed = self._changed_frequencies
+        if snapshot is not None and changed is not None and self.incremental_snapshots:
+            freqs, dbFS = self._merge_changed_samples(snapshot, changed)
+        else:
+            freqs, dbFS = self.get_sample_arrays()
+        self._changed_frequencies = set()
+        snapshot = SpectrumSnapshot(version, freqs, dbFS)
+        self._snapshot = snapshot
+        self._last_publish = now
+        return snapshot
+    def _merge_changed_samples(self, snapshot, changed):
+        # Copy the arrays of the previous snapshot, update the values of
+        # existing frequencies and insert the new ones
+        samples = self.samples
+        changed = sorted(changed)
+        dtype = np.dtype(float)
+        freqs = np.fromiter(changed, dtype, len(changed))
+        dbFS = np.fromiter((samples[f].dbFS for f in changed), dtype, len(changed))
+        old_freqs = snapshot.frequencies
+        index = np.searchsorted(old_freqs, freqs)
+        exists = index < old_freqs.size
+        exists[exists] = old_freqs[index[exists]] == freqs[exists]
+        new_dbFS = snapshot.dbFS.copy()
+        new_dbFS[index[exists]] = dbFS[exists]
+        is_new = ~exists
+        if not is_new.any():
+            return old_freqs, new_dbFS
+        new_freqs = np.insert(old_freqs, index[is_new], freqs[is_new])
+        new_dbFS = np.insert(new_dbFS, index[is_new], dbFS[is_new])
+        return new_freqs, new_dbFS
+    def get_sample_arrays(self):
+        '''Get the sorted frequencies and their dBFS values as arrays
+        '''
+        samples = list(self.iter_samples())
+        dtype = np.dtype(float)
+        freqs = np.fromiter((s.frequency for s in samples), dtype, len(samples))
+        dbFS = np.fromiter((s.dbFS for s in samples), dtype, len(samples))
+        return freqs, dbFS
+    def get_snapshot(self):
+        '''Get the latest published :class:`SpectrumSnapshot`
+
+        Safe to call from any thread without locking. While :attr:`live` is
+        set (a scanner is writing to the spectrum) this returns the last
+        snapshot published by the writer. Otherwise a new snapshot is built
+        if the data has changed.
+        '''
+        snapshot = self._snapshot
+        if self.live:
+            if snapshot is None:
+                snapshot = SpectrumSnapshot(-1, np.array([]), np.array([]))
+            return snapshot
+        if snapshot is None or snapshot.version != self.data_version:
+            snapshot = self.publish_snapshot()
+        return snapshot
     def save_to_dbstore(self):
-        db_store.add_scan(self)
+        '''Queue a save of the spectrum in the db store
+
+        Returns a :class:`~wwb_scanner.utils.dbstore.WriteFuture` (call its
+        ``result()`` method to wait for the save)
+        '''
+        return db_writer.save_scan(self)
     def update_dbstore(self, *attrs):
-        if self.eid is None:
-            return
+        '''Queue an update of the given attributes in the db store
+
+        Returns a :class:`~wwb_scanner.utils.dbstore.WriteFuture`, or None
+        if the spectrum has not been saved
+        '''
         if not len(attrs):
             attrs = ['name', 'color', 'timestamp_utc', 'step_size',
-                     'center_frequencies', 'scan_config_eid']
+                     'center_frequencies', 'resolution_regions',
+                     'scan_config_eid']
         d = {attr:getattr(self, attr) for attr in attrs}
-        db_store.update_scan(self.eid, **d)
+        if 'color' in d:
+            d['color'] = dict(d['color'])
+        return db_writer.update_scan(self, **d)
     @classmethod
     def from_dbstore(cls, dbdata=None, eid=None):
         if dbdata is None:
@@ -198,15 +375,36 @@ class Spectrum(JSONMixin):
         else:
             eid = dbdata.eid
         return cls.from_json(dbdata, eid=eid)
-    def _serialize(self):
+    def _serialize_attrs(self):
         attrs = ['name', 'color', 'timestamp_utc', 'step_size',
-                 'center_frequencies', 'scan_config_eid']
+                 'center_frequencies', 'resolution_regions',
+                 'scan_config_eid']
         d = {attr: getattr(self, attr) for attr in attrs}
-        samples = self.samples
-        d['samples'] = {k: samples[k]._serialize() for k in samples.keys()}
+        d['color'] = dict(d['color'])
+        return d
+    def _serialize(self):
+        d = self._serialize_attrs()
+        freqs, dbFS = self.get_sample_arrays()
+        fmt = self.samples_encoding
+        d['samples'] = {
+            'encoding': fmt,
+            'data': base64.b64encode(encode_samples(
+                freqs, dbFS, fmt,
+                db_resolution=self.samples_db_resolution,
+                freq_resolution=self.samples_freq_resolution,
+            )),
+        }
         return d
 
 class TimeBasedSpectrum(Spectrum):
+    incremental_snapshots = False
+    def add_samples(self, frequencies, **kwargs):
+        key, values = self._get_sample_values(kwargs)
+        ts = kwargs.get('timestamp')
+        for f, value in zip(list(frequencies), list(values)):
+            self._build_sample(spectrum=self, frequency=f, timestamp=ts, **{key: value})
+        self.set_data_updated()
+        return len(values)
     def _build_sample(self, **kwargs):
         sample = TimeBasedSample(**kwargs)
         if sample.frequency not in self.samples:
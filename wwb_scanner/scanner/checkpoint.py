@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import struct
+import datetime
+import threading
+
+import numpy as np
+
+from wwb_scanner.utils.dbstore import APP_PATH, to_json
+
+CHECKPOINTS_PATH = os.path.join(APP_PATH, 'checkpoints')
+CHECKPOINT_EXTENSION = 'wwbck'
+
+FILE_MAGIC = b'WWBCK'
+FILE_VERSION = 1
+# magic, version, length of the scan config (json)
+FILE_HEADER_STRUCT = struct.Struct('<5sBI')
+
+# center_frequency (Hz), timestamp, num_points, force_lower_freq
+RECORD_HEADER_STRUCT = struct.Struct('<ddI?3x')
+
+FREQ_DTYPE = np.dtype('<f8')
+POWER_DTYPE = np.dtype('<c16')
+
+class CheckpointRecord(object):
+    '''The stitched frequencies and powers of one sample set
+    '''
+    __slots__ = ('center_frequency', 'timestamp', 'force_lower_freq',
+                 'frequencies', 'powers')
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, kwargs.get(key))
+    def __repr__(self):
+        return '<CheckpointRecord: %s Hz, %s points>' % (
+            self.center_frequency, len(self.frequencies))
+
+class ScanCheckpoint(object):
+    '''Append-only file of the sample sets processed during a scan
+
+    The file starts with a :data:`FILE_HEADER_STRUCT` header and the scan
+    config (as json), followed by one record per sample set: a
+    :data:`RECORD_HEADER_STRUCT` header, the frequencies (float64, MHz) and
+    the powers (complex128) that were added to the spectrum. Each append
+    only writes its own record, and a record cut short by an interrupted
+    scan is dropped when the file is reopened.
+
+    Use :meth:`create` to start a checkpoint and :meth:`open` to load one
+    (for instance to resume the scan).
+    '''
+    def __init__(self, filename, **kwargs):
+        self.filename = filename
+        self.config = kwargs.get('config')
+        self.fsync = kwargs.get('fsync', False)
+        self.records = []
+        self.completed_frequencies = set()
+        self.fp = None
+        self.lock = threading.Lock()
+    @classmethod
+    def create(cls, config, filename=None, **kwargs):
+        if filename is None:
+            if not os.path.exists(CHECKPOINTS_PATH):
+                os.makedirs(CHECKPOINTS_PATH)
+            dt = datetime.datetime.now()
+            filename = os.path.join(CHECKPOINTS_PATH, 'scan_%s.%s' % (
+                dt.strftime('%Y%m%d_%H%M%S_%f'), CHECKPOINT_EXTENSION))
+        # The config is saved to the database (gaining a datetime and eid)
+        # after each completed scan. The eid belongs to that earlier scan
+        data = config._serialize()
+        data.pop('eid', None)
+        config_data = to_json(data)
+        kwargs['config'] = json.loads(config_data)
+        checkpoint = cls(filename, **kwargs)
+        checkpoint.fp = open(filename, 'wb')
+        checkpoint.fp.write(FILE_HEADER_STRUCT.pack(FILE_MAGIC, FILE_VERSION, len(config_data)))
+        checkpoint.fp.write(config_data)
+        checkpoint.fp.flush()
+        return checkpoint
+    @classmethod
+    def open(cls, filename, **kwargs):
+        '''Load an existing checkpoint and open it for appending
+        '''
+        checkpoint = cls(filename, **kwargs)
+        end_pos = checkpoint.read()
+        fp = checkpoint.fp = open(filename, 'r+b')
+        fp.truncate(end_pos)
+        fp.seek(end_pos)
+        return checkpoint
+    def read(self):
+        file_size = os.path.getsize(self.filename)
+        self.records = []
+        with open(self.filename, 'rb') as f:
+            magic, version, config_size = FILE_HEADER_STRUCT.unpack(
+                f.read(FILE_HEADER_STRUCT.size))
+            if magic != FILE_MAGIC:
+                raise ValueError('%s is not a scan checkpoint' % (self.filename))
+            if version > FILE_VERSION:
+                raise ValueError('Unsupported checkpoint version: %s' % (version))
+            self.config = json.loads(f.read(config_size))
+            pos = f.tell()
+            while pos + RECORD_HEADER_STRUCT.size <= file_size:
+                values = RECORD_HEADER_STRUCT.unpack(f.read(RECORD_HEADER_STRUCT.size))
+                center_frequency, timestamp, num_points, force_lower_freq = values
+                data_size = num_points * (FREQ_DTYPE.itemsize + POWER_DTYPE.itemsize)
+                if f.tell() + data_size > file_size:
+                    # Truncated by an interrupted scan
+                    break
+                freqs = np.fromfile(f, dtype=FREQ_DTYPE, count=num_points)
+                powers = np.fromfile(f, dtype=POWER_DTYPE, count=num_points)
+                self.add_record(CheckpointRecord(
+                    center_frequency=center_frequency,
+                    timestamp=timestamp,
+                    force_lower_freq=force_lower_freq,
+                    frequencies=freqs,
+                    powers=powers,
+                ))
+                pos = f.tell()
+        return pos
+    def add_record(self, record):
+        self.records.append(record)
+        self.completed_frequencies.add(record.center_frequency)
+    def append(self, center_frequency, frequencies, powers, force_lower_freq=False):
+        '''Append the stitched values of a sample set
+
+        params:
+            center_frequency: center frequency of the sample set (in Hz)
+            frequencies: frequencies added to the spectrum (in MHz)
+            powers: powers added to the spectrum
+            force_lower_freq: value passed to
+                :meth:`~wwb_scanner.scan_objects.spectrum.Spectrum.add_sample`
+        '''
+        freqs = np.asarray(frequencies, dtype=FREQ_DTYPE)
+        powers = np.asarray(powers, dtype=POWER_DTYPE)
+        ts = time.time()
+        header = RECORD_HEADER_STRUCT.pack(center_frequency, ts, freqs.size, force_lower_freq)
+        with self.lock:
+            fp = self.fp
+            fp.write(header)
+            fp.write(freqs.tostring())
+            fp.write(powers.tostring())
+            fp.flush()
+            if self.fsync:
+                os.fsync(fp.fileno())
+            self.completed_frequencies.add(center_frequency)
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+    def __len__(self):
+        return len(self.completed_frequencies)
+    def __iter__(self):
+        return iter(self.records)
+
+def find_latest_checkpoint(path=None):
+    '''Get the filename of the most recently written checkpoint (or None)
+    '''
+    if path is None:
+        path = CHECKPOINTS_PATH
+    if not os.path.exists(path):
+        return None
+    filenames = [os.path.join(path, fn) for fn in os.listdir(path)
+                 if fn.endswith('.%s' % (CHECKPOINT_EXTENSION))]
+    if not len(filenames):
+        return None
+    return max(filenames, key=os.path.getmtime)
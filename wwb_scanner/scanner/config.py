@@ -3,29 +3,47 @@ from wwb_scanner.utils.config import Config
 class ScanConfig(Config):
     DEFAULTS = dict(
         scan_range=[400., 900.],
+        scan_ranges=None,
+        devices=None,
+        excluded_ranges=None,
         save_raw_values=False,
+        raw_value_format='complex64',
+        export_metrics=False,
+        profile_cpu=False,
+        profile_memory=False,
+        shared_memory_name=None,
+        checkpoint_scans=True,
     )
     def __init__(self, initdict=None, **kwargs):
-        kwargs.setdefault('_child_conf_keys', ['device', 'sampling'])
+        kwargs.setdefault('_child_conf_keys', ['device', 'sampling', 'refine'])
         super(ScanConfig, self).__init__(initdict, **kwargs)
         if 'device' not in self._data:
             self['device'] = DeviceConfig()
         if 'sampling' not in self._data:
             self['sampling'] = SamplingConfig()
+        if 'refine' not in self._data:
+            self['refine'] = RefineConfig()
     def _deserialize_child(self, key, val, cls=None):
         if key == 'device':
             cls = DeviceConfig
         elif key == 'sampling':
             cls = SamplingConfig
+        elif key == 'refine':
+            cls = RefineConfig
         return super(ScanConfig, self)._deserialize_child(key, val, cls)
 
 class DeviceConfig(Config):
     DEFAULTS = dict(
         gain=30.,
         freq_correction=0,
+        device_index=0,
+        serial_number=None,
+        is_simulated=False,
+        session_idle_timeout=30.,
         is_remote=False,
         remote_hostname='127.0.0.1',
         remote_port=1235,
+        remote_backend='rtl_tcp',
     )
 
 class SamplingConfig(Config):
@@ -38,3 +56,13 @@ class SamplingConfig(Config):
         fft_size=1024,
         window_type='boxcar',
     )
+
+class RefineConfig(Config):
+    DEFAULTS = dict(
+        enabled=False,
+        coarse_fft_size=64,
+        coarse_sweeps_per_scan=2,
+        threshold_db=10.,
+        region_padding=.5,
+        min_region_gap=1.,
+    )
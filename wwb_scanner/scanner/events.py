@@ -0,0 +1,150 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+EVENT_ORDER = ['current_freq', 'sweep_processed', 'sample_set_processed',
+               'progress', 'scan_complete']
+
+logger = logging.getLogger(__name__)
+
+class ThreadScheduler(object):
+    '''Scheduler for :class:`EventBus` delivering events on one long-lived
+    dispatcher thread
+
+    Callbacks are called one at a time, in order of when they are due. The
+    (daemon) thread is started on first use.
+    '''
+    def __init__(self, name='EventDispatcher'):
+        self.name = name
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+    def __call__(self, callback, delay):
+        with self.condition:
+            heapq.heappush(self.queue, (time.time() + delay, next(self.counter), callback))
+            self._start()
+            self.condition.notify()
+    def _start(self):
+        # The thread is gone in a forked child process
+        if self.thread is not None and self.thread.is_alive():
+            return
+        t = self.thread = threading.Thread(target=self.run, name=self.name)
+        t.daemon = True
+        t.start()
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    timeout = None
+                    if self.queue:
+                        timeout = self.queue[0][0] - time.time()
+                        if timeout <= 0:
+                            break
+                    self.condition.wait(timeout)
+                callback = heapq.heappop(self.queue)[2]
+            try:
+                callback()
+            except Exception:
+                logger.exception('event callback failed')
+
+# Shared by the event buses of :class:`~wwb_scanner.scanner.main.ThreadedScanner`
+# and :class:`~wwb_scanner.scanner.shm.SharedSpectrumPublisher`
+thread_scheduler = ThreadScheduler()
+
+class EventBus(object):
+    '''Coalescing, rate limited delivery of scanner events
+
+    :meth:`emit` only stores the event and returns, so it never waits on
+    consumers. Events of the same name emitted before the next delivery
+    are coalesced: subscribers receive the keyword arguments of the most
+    recent one, plus ``event_count`` (the number of events it replaces).
+
+    Delivery happens in :meth:`dispatch_pending`, at most ``max_rate`` times
+    per second. It is either called by the consumer on its own thread
+    (polling), or through ``scheduler``: a callable taking
+    ``(callback, delay)`` that arranges for ``callback`` to be called on the
+    consumer's thread after ``delay`` seconds (such as
+    ``Clock.schedule_once`` in Kivy, or :data:`thread_scheduler`).
+
+    params:
+        max_rate: maximum deliveries per second (0 for no limit)
+        scheduler: optional callable as described above
+    '''
+    def __init__(self, **kwargs):
+        self.max_rate = kwargs.get('max_rate', 10.)
+        self.scheduler = kwargs.get('scheduler')
+        self.subscribers = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.dispatch_scheduled = False
+        self.last_dispatch = 0.
+    @property
+    def min_interval(self):
+        if not self.max_rate:
+            return 0.
+        return 1. / self.max_rate
+    def subscribe(self, name, callback):
+        with self.lock:
+            callbacks = self.subscribers.setdefault(name, [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+    def unsubscribe(self, name, callback=None):
+        with self.lock:
+            if callback is None:
+                self.subscribers.pop(name, None)
+                return
+            callbacks = self.subscribers.get(name, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+    def emit(self, name, **kwargs):
+        with self.lock:
+            if name not in self.subscribers:
+                return
+            event = self.pending.get(name)
+            if event is None:
+                self.pending[name] = [kwargs, 1]
+            else:
+                event[0] = kwargs
+                event[1] += 1
+            if self.dispatch_scheduled or self.scheduler is None:
+                return
+            self.dispatch_scheduled = True
+            delay = self.last_dispatch + self.min_interval - time.time()
+        self.scheduler(self.dispatch_pending, max(delay, 0.))
+    def dispatch_pending(self, *args, **kwargs):
+        '''Deliver pending events to subscribers
+
+        Returns False if called again before ``1 / max_rate`` seconds have
+        passed (unless ``force=True``), in which case delivery is
+        rescheduled (if a scheduler is set) or left for the next call.
+        '''
+        force = kwargs.get('force', False)
+        now = time.time()
+        with self.lock:
+            self.dispatch_scheduled = False
+            if not self.pending:
+                return True
+            delay = self.last_dispatch + self.min_interval - now
+            if delay > 0 and not force:
+                reschedule = self.scheduler is not None
+                self.dispatch_scheduled = reschedule
+            else:
+                reschedule = None
+                pending, self.pending = self.pending, {}
+                self.last_dispatch = now
+                subscribers = {k: list(v) for k, v in self.subscribers.items()}
+        if reschedule is not None:
+            if reschedule:
+                self.scheduler(self.dispatch_pending, delay)
+            return False
+        names = [n for n in EVENT_ORDER if n in pending]
+        names.extend(sorted(set(pending.keys()) - set(names)))
+        for name in names:
+            event_kwargs, count = pending[name]
+            event_kwargs = dict(event_kwargs, event_count=count)
+            for callback in subscribers.get(name, []):
+                callback(**event_kwargs)
+        return True
@@ -1,3 +1,4 @@
+import logging
 import threading
 
 import numpy as np
@@ -5,14 +6,33 @@ import numpy as np
 from wwb_scanner.core import JSONMixin
 from wwb_scanner.utils.dbstore import db_store
 from wwb_scanner.scanner.sdrwrapper import SdrWrapper
+from wwb_scanner.scanner.session import capability_cache
 from wwb_scanner.scanner.config import ScanConfig
+from wwb_scanner.scanner.plan import ScanPlan, get_actual_sample_rate
+from wwb_scanner.scanner.schedule import ScanSchedule
+from wwb_scanner.scanner.recording import IQRecorder
+from wwb_scanner.scanner.metrics import ScanMetrics
+from wwb_scanner.scanner.profiling import profile_scan
+from wwb_scanner.scanner.events import EventBus, thread_scheduler
+from wwb_scanner.scanner.stream import StreamHub
+from wwb_scanner.scanner.shm import SharedSpectrumPublisher
+from wwb_scanner.scanner.checkpoint import ScanCheckpoint, find_latest_checkpoint
 from wwb_scanner.scanner.sample_processing import (
     SampleCollection,
     calc_num_samples,
     WINDOW_TYPES,
+    DEFAULT_NPERSEG,
+)
+from wwb_scanner.scanner.refine import (
+    find_active_regions,
+    clip_regions,
+    invert_regions,
+    iter_region_centers,
 )
 from wwb_scanner.scan_objects import Spectrum
 
+logger = logging.getLogger(__name__)
+
 def mhz_to_hz(mhz):
     return mhz * 1000000.0
 def hz_to_mhz(hz):
@@ -28,6 +48,17 @@ class ScannerBase(JSONMixin):
         self._stopped = threading.Event()
         self._current_freq = None
         self._progress = 0.
+        self.sample_set_bounds = {}
+        self.metrics = ScanMetrics()
+        self.events = EventBus(
+            max_rate=kwargs.get('event_rate', 10.),
+            scheduler=kwargs.get('event_scheduler'),
+        )
+        self._stream_hub = None
+        self._profiler = None
+        self.checkpoint = None
+        self.completed_frequencies = set()
+        self.last_profile = None
         ckwargs = kwargs.get('config')
         if not ckwargs:
             ckwargs = db_store.get_scan_config()
@@ -36,6 +67,13 @@ class ScannerBase(JSONMixin):
         self.config = ScanConfig(ckwargs)
         self.device_config = self.config.device
         self.sampling_config = self.config.sampling
+        scan_plan = kwargs.get('scan_plan')
+        if isinstance(scan_plan, dict):
+            scan_plan = ScanPlan.from_json(scan_plan)
+        self.scan_plan = scan_plan
+        if scan_plan is not None:
+            scan_plan.apply_to_config(self.config)
+        self._schedule = kwargs.get('schedule')
         if 'spectrum' in kwargs:
             self.spectrum = Spectrum.from_json(kwargs['spectrum'])
         else:
@@ -43,6 +81,12 @@ class ScannerBase(JSONMixin):
         self.spectrum.scan_config = self.config
         if not kwargs.get('__from_json__'):
             self.sample_collection = SampleCollection(scanner=self)
+        self.save_future = None
+        self.shared_spectrum = None
+        shm_name = self.config.get('shared_memory_name')
+        if shm_name:
+            self.shared_spectrum = SharedSpectrumPublisher(name=shm_name)
+            self.shared_spectrum.attach(self)
     @property
     def current_freq(self):
         return self._current_freq
@@ -51,10 +95,12 @@ class ScannerBase(JSONMixin):
         self._current_freq = value
         if value is not None:
             f_min, f_max = self.config.scan_range
-            self.progress = (value - f_min) / (f_max - f_min)
+            progress = (value - f_min) / (f_max - f_min)
+            self.progress = min(max(progress, 0.), 1.)
+        self.events.emit('current_freq', value=value)
         self.on_current_freq(value)
     def on_current_freq(self, value):
-        print 'scanning %s' % (value)
+        logger.debug('scanning %s', value)
     @property
     def progress(self):
         return self._progress
@@ -63,39 +109,312 @@ class ScannerBase(JSONMixin):
         if value == self._progress:
             return
         self._progress = value
+        self.events.emit('progress', value=value)
+        if self._stream_hub is not None:
+            self._stream_hub.publish_progress(value)
         self.on_progress(value)
     def on_progress(self, value):
-        print '%s%%' % (int(value * 100))
+        logger.debug('%s%%', int(value * 100))
     def build_sample_sets(self):
         freq,  end_freq = self.config.scan_range
         sample_collection = self.sample_collection
+        scan_plan = self.scan_plan
+        if scan_plan is not None:
+            for freq in scan_plan.center_frequencies:
+                sample_collection.build_sample_set(
+                    mhz_to_hz(freq),
+                    nperseg=scan_plan.fft_size,
+                    sweeps_per_scan=scan_plan.sweeps_per_scan,
+                )
+            return
         while freq <= end_freq:
             sample_set = sample_collection.build_sample_set(mhz_to_hz(freq))
             freq += self.step_size
+    @property
+    def tile_width(self):
+        overlap = self.sampling_config.sweep_overlap_ratio
+        return hz_to_mhz(self.sample_rate * (1 - overlap))
+    def build_coarse_sample_sets(self):
+        refine_config = self.config.refine
+        f_min, f_max = self.config.scan_range
+        sample_collection = self.sample_collection
+        for freq in iter_region_centers([f_min, f_max], self.tile_width):
+            sample_collection.build_sample_set(
+                mhz_to_hz(freq),
+                nperseg=refine_config.coarse_fft_size,
+                sweeps_per_scan=refine_config.coarse_sweeps_per_scan,
+            )
+    def build_refined_sample_sets(self, regions):
+        width = self.tile_width
+        sample_collection = self.sample_collection
+        # Drop the sample sets built for the regions of earlier passes
+        sample_collection.sample_sets.clear()
+        self.sample_set_bounds.clear()
+        for region in regions:
+            for freq in iter_region_centers(region, width):
+                sample_set = sample_collection.build_sample_set(mhz_to_hz(freq))
+                bounds = [freq - width / 2., freq + width / 2.]
+                self.sample_set_bounds[sample_set.center_frequency] = bounds
+    def find_refine_regions(self, sample_collection):
+        refine_config = self.config.refine
+        sample_sets = [sample_collection.sample_sets[key]
+                       for key in sorted(sample_collection.sample_sets.keys())]
+        sample_sets = [s for s in sample_sets if s.powers is not None]
+        if not len(sample_sets):
+            return []
+        freqs = np.concatenate([s.frequencies for s in sample_sets])
+        powers = np.concatenate([s.powers for s in sample_sets])
+        regions = find_active_regions(
+            freqs, powers,
+            threshold_db=refine_config.threshold_db,
+            padding=refine_config.region_padding,
+            min_gap=refine_config.min_region_gap,
+        )
+        return clip_regions(regions, *self.config.scan_range)
+    @property
+    def schedule(self):
+        schedule = self._schedule
+        use_schedule = self.config.get('scan_ranges') or self.config.get('excluded_ranges')
+        if schedule is None and use_schedule:
+            schedule = self._schedule = ScanSchedule.from_config(
+                self.config, step_size=self.tile_width,
+            )
+        return schedule
+    def iter_scheduled_sample_sets(self):
+        schedule = self.schedule
+        width = schedule.step_size
+        sample_collection = self.sample_collection
+        self.sample_set_bounds.clear()
+        for freq in schedule.iter_cycle():
+            sample_set = sample_collection.build_sample_set(mhz_to_hz(freq))
+            bounds = [freq - width / 2., freq + width / 2.]
+            self.sample_set_bounds[sample_set.center_frequency] = bounds
+            yield sample_set
+    def run_scheduled_scan(self):
+        self.sample_collection.scan_sample_sets(self.iter_scheduled_sample_sets())
+        self.sample_set_bounds.clear()
+    def run_refined_scan(self):
+        fine_collection = self.sample_collection
+        coarse_collection = self.sample_collection = SampleCollection(scanner=self)
+        try:
+            self.build_coarse_sample_sets()
+            coarse_collection.scan_all_freqs()
+        finally:
+            self.sample_collection = fine_collection
+        if not self._running.is_set():
+            return
+        regions = self.find_refine_regions(coarse_collection)
+        self.spectrum.resolution_regions = self.build_resolution_regions(regions)
+        for start, end in regions:
+            self.spectrum.remove_samples_in_range(start, end)
+        self.build_refined_sample_sets(regions)
+        fine_collection.scan_all_freqs()
+        self.sample_set_bounds.clear()
+    def build_resolution_regions(self, regions):
+        refine_config = self.config.refine
+        f_min, f_max = self.config.scan_range
+        rs = self.sample_rate
+        resolution_regions = []
+        passes = [
+            ('coarse', invert_regions(regions, f_min, f_max),
+             refine_config.coarse_fft_size, refine_config.coarse_sweeps_per_scan),
+            ('fine', regions, DEFAULT_NPERSEG, self.sweeps_per_scan),
+        ]
+        for scan_pass, _regions, nperseg, sweeps_per_scan in passes:
+            for start, end in _regions:
+                resolution_regions.append(dict(
+                    start_freq=start,
+                    end_freq=end,
+                    resolution=hz_to_mhz(rs / nperseg),
+                    sweeps_per_scan=sweeps_per_scan,
+                    scan_pass=scan_pass,
+                ))
+        return sorted(resolution_regions, key=lambda r: r['start_freq'])
+    @profile_scan
     def run_scan(self):
-        self.build_sample_sets()
         running = self._running
-        running.set()
-        self.sample_collection.scan_all_freqs()
-        self.sample_collection.stopped.wait()
-        if running.is_set():
-            self.save_to_dbstore()
+        self.metrics.start()
+        self.open_checkpoint()
+        completed = False
+        try:
+            if self.config.refine.enabled:
+                running.set()
+                self.run_refined_scan()
+            elif self.schedule is not None:
+                running.set()
+                self.run_scheduled_scan()
+            else:
+                self.build_sample_sets()
+                running.set()
+                self.sample_collection.scan_all_freqs()
+                self.sample_collection.stopped.wait()
+            if running.is_set():
+                self.save_to_dbstore()
+                completed = True
+        finally:
+            self.close_checkpoint(completed)
         running.clear()
+        self.on_scan_complete()
         self._stopped.set()
+    def open_checkpoint(self):
+        '''Start a :class:`~wwb_scanner.scanner.checkpoint.ScanCheckpoint`
+        if ``checkpoint_scans`` is set in the config
+
+        Refined scans are not checkpointed. A checkpoint loaded by
+        :meth:`resume_scan` is appended to.
+        '''
+        if self.checkpoint is not None:
+            return
+        if not self.config.get('checkpoint_scans') or self.config.refine.enabled:
+            return
+        self.checkpoint = ScanCheckpoint.create(self.config)
+    def close_checkpoint(self, completed):
+        checkpoint = self.checkpoint
+        if checkpoint is None:
+            return
+        self.checkpoint = None
+        self.completed_frequencies = set()
+        if completed:
+            checkpoint.remove()
+        else:
+            checkpoint.close()
+            logger.info('scan incomplete, checkpoint saved to %s', checkpoint.filename)
+    def checkpoint_sample_set(self, sample_set, frequencies, powers, force_lower_freq):
+        if self.checkpoint is not None:
+            self.checkpoint.append(sample_set.center_frequency, frequencies,
+                                   powers, force_lower_freq)
+    def resume_scan(self, checkpoint=None):
+        '''Resume an interrupted scan from a checkpoint
+
+        The values saved in the checkpoint are added to the spectrum and
+        the center frequencies already scanned are skipped. New sample sets
+        are appended to the same checkpoint.
+
+        params:
+            checkpoint: a :class:`~wwb_scanner.scanner.checkpoint.ScanCheckpoint`
+                or its filename. Defaults to the most recent checkpoint
+        '''
+        if checkpoint is None:
+            checkpoint = find_latest_checkpoint()
+            if checkpoint is None:
+                raise ValueError('No checkpoint found')
+        if not isinstance(checkpoint, ScanCheckpoint):
+            checkpoint = ScanCheckpoint.open(checkpoint)
+        if checkpoint.config['scan_range'] != list(self.config.scan_range):
+            checkpoint.close()
+            raise ValueError('Checkpoint scan range %s does not match %s' % (
+                checkpoint.config['scan_range'], self.config.scan_range))
+        for record in checkpoint:
+            self.stitch_values(record.frequencies, record.powers,
+                               record.center_frequency, record.force_lower_freq)
+        checkpoint.records = []
+        self.checkpoint = checkpoint
+        self.completed_frequencies = checkpoint.completed_frequencies
+        logger.info('resuming scan from %s (%s sample sets completed)',
+                    checkpoint.filename, len(checkpoint))
+        self.run_scan()
     def stop_scan(self):
         self._running.clear()
         self.sample_collection.cancel()
         self._stopped.wait()
     def scan_freq(self, freq):
         pass
+    def on_sweep_processed(self, **kwargs):
+        self.events.emit('sweep_processed', **kwargs)
+    def on_sample_set_processed(self, sample_set):
+        powers = sample_set.powers
+        freqs = sample_set.frequencies
+        spectrum = self.spectrum
+        center_freq = sample_set.center_frequency
+        force_lower_freq = False
+        bounds = self.sample_set_bounds.get(center_freq)
+        if bounds is not None:
+            in_bounds = (freqs >= bounds[0]) & (freqs < bounds[1])
+            freqs, powers = freqs[in_bounds], powers[in_bounds]
+            force_lower_freq = True
+        metrics = self.metrics
+        metrics.increment('sample_sets')
+        if not len(freqs):
+            return
+        spectrum.live = True
+        with metrics.timer('stitch', center_freq):
+            num_existing = self.stitch_values(freqs, powers, center_freq, force_lower_freq)
+            spectrum.publish_snapshot(spectrum.snapshot_interval)
+        with metrics.timer('checkpoint', center_freq):
+            self.checkpoint_sample_set(sample_set, freqs, powers, force_lower_freq)
+        metrics.increment('bins_added', len(freqs))
+        metrics.increment('overlapping_bins', num_existing)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('added %s samples: range=%s - %s, num_existing=%s',
+                         len(freqs), min(freqs), max(freqs), num_existing)
+        self.publish_sample_set(sample_set, freqs, powers)
+        self.update_scan_progress(sample_set)
+    def stitch_values(self, frequencies, powers, center_freq, force_lower_freq=False):
+        spectrum = self.spectrum
+        num_existing = 0
+        for f, p in zip(frequencies, powers):
+            if f in spectrum.samples:
+                num_existing += 1
+            is_center = f == center_freq
+            spectrum.add_sample(frequency=f, iq=p, force_magnitude=True,
+                                force_lower_freq=force_lower_freq,
+                                is_center_frequency=is_center)
+        return num_existing
+    def publish_sample_set(self, sample_set, frequencies, powers):
+        self.events.emit('sample_set_processed', sample_set=sample_set,
+                         frequencies=frequencies, powers=powers)
+        if self._stream_hub is not None:
+            self._stream_hub.publish_sample_set(sample_set, frequencies, powers)
+    def update_scan_progress(self, sample_set):
+        self.current_freq = hz_to_mhz(sample_set.center_frequency)
+    def stream(self, **kwargs):
+        '''Get a :class:`~wwb_scanner.scanner.stream.ScanStream` of results
+
+        The scan is run in a background thread when the first stream is
+        iterated. Create all streams before iterating to have each one
+        receive every result.
+
+        params:
+            maxsize: maximum number of results queued for the stream
+            include_progress: if False, only sample set results are
+                produced
+            autostart: if False, the stream does not start a scan and
+                only receives results from scans run by other means (such
+                as a :class:`ThreadedScanner`)
+        '''
+        hub = self._stream_hub
+        if hub is None:
+            hub = self._stream_hub = StreamHub(self)
+        return hub.add_stream(**kwargs)
     def save_to_dbstore(self):
-        self.spectrum.save_to_dbstore()
+        # The write itself is done by the db writer thread. Callers that need
+        # the scan eid can wait on ``save_future``
+        with self.metrics.timer('db_enqueue'):
+            future = self.save_future = self.spectrum.save_to_dbstore()
+        future.add_done_callback(self._on_save_done)
+    def _on_save_done(self, future):
+        if future.duration is not None:
+            self.metrics.add_timing('db_write', future.duration)
+    def on_scan_complete(self):
+        metrics = self.metrics
+        metrics.stop()
+        self.spectrum.publish_snapshot()
+        self.spectrum.live = False
+        self.events.emit('scan_complete', spectrum=self.spectrum)
+        if self.config.get('export_metrics'):
+            if self.save_future is not None:
+                # Include the db_write timing
+                self.save_future.exception(timeout=10.)
+            filename = metrics.export()
+            logger.info('scan metrics written to %s', filename)
     def _serialize(self):
         d = dict(
             config=self.config._serialize(),
             spectrum=self.spectrum._serialize(),
             sample_collection=self.sample_collection._serialize(),
         )
+        if self.scan_plan is not None:
+            d['scan_plan'] = self.scan_plan._serialize()
         return d
     def _deserialize(self, **kwargs):
         data = kwargs.get('sample_collection')
@@ -110,6 +429,7 @@ class Scanner(ScannerBase):
     def __init__(self, **kwargs):
         super(Scanner, self).__init__(**kwargs)
         self.sdr_wrapper = SdrWrapper(scanner=self)
+        self.recorder = None
         self.gain = self.gain
     @property
     def sdr(self):
@@ -143,10 +463,11 @@ class Scanner(ScannerBase):
         step_size = getattr(self, '_step_size', None)
         if step_size is not None:
             return step_size
+        if self.scan_plan is not None:
+            return self.scan_plan.step_size
         c = self.sampling_config
         overlap = c.sweep_overlap_ratio
-        self.sdr.sample_rate = c.sample_rate
-        rs = self.sdr.sample_rate
+        rs = get_actual_sample_rate(c.sample_rate)
         self.sample_rate = rs
         step_size = self._step_size = hz_to_mhz(rs / 2. * overlap)
         return step_size
@@ -171,7 +492,9 @@ class Scanner(ScannerBase):
     def gains(self):
         gains = getattr(self, '_gains', None)
         if gains is None:
-            gains = self._gains = self.get_gains()
+            capabilities = capability_cache.get(self.device_config)
+            if capabilities is not None:
+                gains = self._gains = capabilities.get('gains')
         return gains
     def get_gains(self):
         self.sdr_wrapper.enable_scanner_updates = False
@@ -183,7 +506,7 @@ class Scanner(ScannerBase):
                 gains = self.sdr.get_gains()
         self.sdr_wrapper.enable_scanner_updates = True
         if gains is not None:
-            gains = [gain / 10. for gain in gains]
+            gains = self._gains = [gain / 10. for gain in gains]
         return gains
     def get_nearest_gain(self, gain):
         gains = self.gains
@@ -191,30 +514,25 @@ class Scanner(ScannerBase):
             return gain
         npgains = np.array(gains)
         return gains[np.abs(npgains - gain).argmin()]
+    @profile_scan
     def run_scan(self):
-        with self.sdr_wrapper:
-            super(Scanner, self).run_scan()
+        if self.config.save_raw_values:
+            self.recorder = IQRecorder.for_scan(self.config.get('raw_value_format'))
+        try:
+            with self.sdr_wrapper:
+                super(Scanner, self).run_scan()
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
     def scan_freq(self, freq):
         sample_set = self.sample_collection.scan_freq(freq)
         return sample_set
-    def on_sweep_processed(self, **kwargs):
-        pass
     def on_sample_set_processed(self, sample_set):
-        powers = sample_set.powers
-        freqs = sample_set.frequencies
-        spectrum = self.spectrum
-        center_freq = sample_set.center_frequency
-        print 'adding %s samples: range=%s - %s' % (len(freqs), min(freqs), max(freqs))
-        num_existing = 0
-        for f, p in zip(freqs, powers):
-            if f in spectrum.samples:
-                num_existing += 1
-            is_center = f == center_freq
-            spectrum.add_sample(frequency=f, iq=p, force_magnitude=True,
-                                force_lower_freq=False,
-                                is_center_frequency=is_center)
-        print('num_existing={}'.format(num_existing))
-        self.on_progress(self.progress)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.write_sample_set(sample_set, gain=self.gain)
+        super(Scanner, self).on_sample_set_processed(sample_set)
 
 class ThreadedScanner(threading.Thread, Scanner):
     def __init__(self, **kwargs):
@@ -229,11 +547,15 @@ class ThreadedScanner(threading.Thread, Scanner):
         self.stopped = threading.Event()
         self.need_update = threading.Event()
         self.need_update_lock = threading.Lock()
+        if self.events.scheduler is None:
+            self.events.scheduler = thread_scheduler
+        self.events.subscribe('current_freq', self.on_current_freq_event)
     def on_current_freq(self, value):
-        if self.plot is not None:
-            self.plot.update_plot()
         with self.need_update_lock:
             self.need_update.set()
+    def on_current_freq_event(self, **kwargs):
+        if self.plot is not None:
+            self.plot.update_plot()
     def run(self):
         scanning = self.scanning
         waiting = self.waiting
@@ -0,0 +1,152 @@
+import os
+import time
+import bisect
+import datetime
+import threading
+import contextlib
+
+from wwb_scanner.core import JSONMixin
+from wwb_scanner.utils.dbstore import APP_PATH
+
+METRICS_PATH = os.path.join(APP_PATH, 'metrics')
+
+STAGES = ['retune', 'capture_wait', 'callback_copy', 'sweep_psd', 'psd',
+          'stitch', 'checkpoint', 'db_enqueue', 'db_write']
+
+# Upper bounds (in seconds) of the histogram buckets, 10us to 10s
+HISTOGRAM_BOUNDS = [1e-5 * 10 ** (i / 2.) for i in range(13)]
+
+class Histogram(JSONMixin):
+    '''Fixed bucket histogram of durations (in seconds)
+    '''
+    def __init__(self, **kwargs):
+        self.bounds = kwargs.get('bounds', HISTOGRAM_BOUNDS)
+        self.buckets = kwargs.get('buckets')
+        if self.buckets is None:
+            self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = kwargs.get('count', 0)
+        self.total = kwargs.get('total', 0.)
+        self.min = kwargs.get('min')
+        self.max = kwargs.get('max')
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+    def _serialize(self):
+        return dict(
+            bounds=self.bounds,
+            buckets=self.buckets,
+            count=self.count,
+            total=self.total,
+            min=self.min,
+            max=self.max,
+        )
+
+class ScanMetrics(JSONMixin):
+    '''Timings and counters collected while scanning
+
+    Durations are recorded per stage (see :data:`STAGES`) both in total
+    (as a :class:`Histogram`) and per center frequency. Recording only
+    takes a lock and a few additions, so it is left enabled by default.
+
+    Counters:
+        sample_sets: number of sample sets processed
+        sweeps: number of sweeps captured
+        dropped_sweeps: sweeps delivered after a sample set was full
+        bins_added: number of frequency bins added to the spectrum
+        overlapping_bins: bins that replaced an existing frequency
+    '''
+    def __init__(self, **kwargs):
+        self.enabled = kwargs.get('enabled', True)
+        self.lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        with self.lock:
+            self.start_time = None
+            self.end_time = None
+            self.counters = {}
+            self.histograms = {}
+            self.frequency_timings = {}
+    def start(self):
+        self.reset()
+        self.start_time = time.time()
+    def stop(self):
+        self.end_time = time.time()
+    @property
+    def duration(self):
+        if self.start_time is None:
+            return None
+        end_time = self.end_time
+        if end_time is None:
+            end_time = time.time()
+        return end_time - self.start_time
+    def add_timing(self, stage, duration, center_frequency=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            h = self.histograms.get(stage)
+            if h is None:
+                h = self.histograms[stage] = Histogram()
+            h.add(duration)
+            if center_frequency is None:
+                return
+            timings = self.frequency_timings.get(center_frequency)
+            if timings is None:
+                timings = self.frequency_timings[center_frequency] = {}
+            timings[stage] = timings.get(stage, 0.) + duration
+    @contextlib.contextmanager
+    def timer(self, stage, center_frequency=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_timing(stage, time.time() - start, center_frequency)
+    def increment(self, counter, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+    def get_counter(self, counter):
+        return self.counters.get(counter, 0)
+    def get_stage_total(self, stage):
+        h = self.histograms.get(stage)
+        if h is None:
+            return 0.
+        return h.total
+    def export(self, filename=None):
+        if filename is None:
+            if not os.path.exists(METRICS_PATH):
+                os.makedirs(METRICS_PATH)
+            dt = datetime.datetime.now()
+            filename = os.path.join(METRICS_PATH, 'scan_%s.json' % (
+                dt.strftime('%Y%m%d_%H%M%S_%f')))
+        with open(filename, 'w') as f:
+            f.write(self.to_json(indent=2))
+        return filename
+    def _serialize(self):
+        with self.lock:
+            return dict(
+                start_time=self.start_time,
+                end_time=self.end_time,
+                duration=self.duration,
+                counters=dict(self.counters),
+                stages={k: v._serialize() for k, v in self.histograms.items()},
+                frequencies={str(k): dict(v) for k, v in self.frequency_timings.items()},
+            )
+    def _deserialize(self, **kwargs):
+        self.start_time = kwargs.get('start_time')
+        self.end_time = kwargs.get('end_time')
+        self.counters.update(kwargs.get('counters', {}))
+        for key, val in kwargs.get('stages', {}).items():
+            self.histograms[key] = Histogram(**val)
+        for key, val in kwargs.get('frequencies', {}).items():
+            self.frequency_timings[float(key)] = val
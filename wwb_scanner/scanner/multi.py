@@ -0,0 +1,168 @@
+import threading
+
+import numpy as np
+
+from wwb_scanner.scanner.main import ScannerBase, Scanner, mhz_to_hz
+from wwb_scanner.scanner.refine import iter_region_centers
+from wwb_scanner.scanner.profiling import profile_scan
+
+def partition_by_dwell(items, dwell_times, num_partitions):
+    '''Split items into contiguous partitions with balanced total dwell time
+    '''
+    num_partitions = max(min(num_partitions, len(items)), 1)
+    cumulative = np.cumsum(dwell_times)
+    total = cumulative[-1] if len(items) else 0.
+    partitions = [[] for i in range(num_partitions)]
+    for item, c, dwell in zip(items, cumulative, dwell_times):
+        i = int((c - dwell / 2.) / total * num_partitions) if total else 0
+        partitions[min(i, num_partitions - 1)].append(item)
+    return partitions
+
+class DeviceScanner(Scanner):
+    '''Scanner for one device of a :class:`MultiScanner`
+
+    Shares the coordinator's :class:`Spectrum` and scans only the center
+    frequencies assigned to it.
+    '''
+    def __init__(self, **kwargs):
+        self.coordinator = kwargs.get('coordinator')
+        self.assigned_frequencies = []
+        super(DeviceScanner, self).__init__(**kwargs)
+        self.spectrum = self.coordinator.spectrum
+    def build_sample_sets(self):
+        sample_collection = self.sample_collection
+        self.sample_set_bounds.clear()
+        for freq, bounds, kwargs in self.assigned_frequencies:
+            sample_set = sample_collection.build_sample_set(mhz_to_hz(freq), **kwargs)
+            self.sample_set_bounds[sample_set.center_frequency] = bounds
+    def on_sample_set_processed(self, sample_set):
+        with self.coordinator.spectrum_lock:
+            super(DeviceScanner, self).on_sample_set_processed(sample_set)
+        self.coordinator.on_device_sample_set_processed(self, sample_set)
+    def on_progress(self, value):
+        pass
+    def on_sweep_processed(self, **kwargs):
+        self.coordinator.on_sweep_processed(**kwargs)
+    def checkpoint_sample_set(self, *args):
+        self.coordinator.checkpoint_sample_set(*args)
+    def update_scan_progress(self, sample_set):
+        pass
+    def on_scan_complete(self):
+        self.metrics.stop()
+    def save_to_dbstore(self):
+        pass
+
+class MultiScanner(ScannerBase):
+    '''Coordinates several devices scanning partitions of one range
+
+    params:
+        devices: list of dicts with per-device settings (any
+            :class:`~wwb_scanner.scanner.config.DeviceConfig` key, such as
+            ``device_index``, ``serial_number``, ``is_remote``,
+            ``gain`` or ``freq_correction``). Defaults to the ``devices``
+            key of the scan config.
+    '''
+    def __init__(self, **kwargs):
+        super(MultiScanner, self).__init__(**kwargs)
+        devices = kwargs.get('devices')
+        if devices is None:
+            devices = self.config.get('devices')
+        if not devices:
+            devices = [{}]
+        self.config.devices = [dict(d) for d in devices]
+        self.spectrum_lock = threading.Lock()
+        self.device_scanners = [self.build_device_scanner(d) for d in self.config.devices]
+        self.device_threads = []
+        self.num_processed = 0
+        self.num_sample_sets = 0
+    def build_device_scanner(self, device_settings):
+        config = self.config._serialize()
+        config['device'].update(device_settings)
+        config['devices'] = None
+        config['scan_ranges'] = None
+        config['excluded_ranges'] = None
+        config['refine']['enabled'] = False
+        config['export_metrics'] = False
+        config['shared_memory_name'] = None
+        config['checkpoint_scans'] = False
+        return DeviceScanner(config=config, coordinator=self)
+    @property
+    def sample_rate(self):
+        return self.sampling_config.sample_rate
+    @property
+    def sweeps_per_scan(self):
+        return self.sampling_config.sweeps_per_scan
+    def iter_scan_frequencies(self):
+        scan_plan = self.scan_plan
+        if scan_plan is not None:
+            width = scan_plan.step_size
+            kwargs = dict(nperseg=scan_plan.fft_size,
+                          sweeps_per_scan=scan_plan.sweeps_per_scan)
+            freqs = scan_plan.center_frequencies
+        elif self.schedule is not None:
+            width = self.schedule.step_size
+            kwargs = {}
+            freqs = self.schedule.frequencies
+        else:
+            width = self.tile_width
+            kwargs = {}
+            freqs = iter_region_centers(self.config.scan_range, width)
+        for freq in freqs:
+            bounds = [freq - width / 2., freq + width / 2.]
+            yield freq, bounds, kwargs
+    def calc_dwell_time(self, kwargs):
+        sweeps = kwargs.get('sweeps_per_scan', self.sweeps_per_scan)
+        samples = sweeps * self.sampling_config.samples_per_sweep
+        return samples / self.sample_rate
+    def build_sample_sets(self):
+        completed = self.completed_frequencies
+        items = [item for item in self.iter_scan_frequencies()
+                 if mhz_to_hz(item[0]) not in completed]
+        dwell_times = [self.calc_dwell_time(item[2]) for item in items]
+        partitions = partition_by_dwell(items, dwell_times, len(self.device_scanners))
+        for device_scanner in self.device_scanners:
+            device_scanner.assigned_frequencies = []
+        for device_scanner, partition in zip(self.device_scanners, partitions):
+            device_scanner.assigned_frequencies = partition
+        self.num_sample_sets = len(items)
+        self.num_processed = 0
+    @profile_scan
+    def run_scan(self):
+        self.build_sample_sets()
+        running = self._running
+        running.set()
+        self._stopped.clear()
+        self.metrics.start()
+        self.open_checkpoint()
+        completed = False
+        try:
+            threads = self.device_threads = []
+            for device_scanner in self.device_scanners:
+                if not len(device_scanner.assigned_frequencies):
+                    continue
+                t = threading.Thread(target=device_scanner.run_scan)
+                t.daemon = True
+                threads.append(t)
+                t.start()
+            for t in threads:
+                t.join()
+            if running.is_set():
+                self.save_to_dbstore()
+                completed = True
+        finally:
+            self.close_checkpoint(completed)
+        running.clear()
+        self.on_scan_complete()
+        self._stopped.set()
+    def stop_scan(self):
+        self._running.clear()
+        for device_scanner in self.device_scanners:
+            if device_scanner._running.is_set():
+                device_scanner.stop_scan()
+        self._stopped.wait()
+    def on_device_sample_set_processed(self, device_scanner, sample_set):
+        with self.spectrum_lock:
+            self.num_processed += 1
+            progress = float(self.num_processed) / max(self.num_sample_sets, 1)
+        self.publish_sample_set(sample_set, sample_set.frequencies, sample_set.powers)
+        self.progress = progress
@@ -0,0 +1,272 @@
+import time
+import errno
+import socket
+import struct
+import logging
+import threading
+import collections
+import SocketServer
+
+import numpy as np
+
+from wwb_scanner.scanner.main import ThreadedScanner
+
+logger = logging.getLogger(__name__)
+
+FRAME_MAGIC = b'WWBS'
+FRAME_VERSION = 1
+FRAME_SAMPLE_SET = 1
+FRAME_SNAPSHOT = 2
+
+# magic, version, frame_type, sequence, center_frequency (MHz),
+# base_frequency (MHz), timestamp, num_points
+FRAME_HEADER_STRUCT = struct.Struct('<4sBB2xIdddI4x')
+
+class SpectrumFrame(object):
+    '''One frame of spectrum data
+
+    On the wire a frame is a :data:`FRAME_HEADER_STRUCT` header followed by
+    two little-endian float32 arrays of ``num_points`` values: frequency
+    offsets from ``base_frequency`` (in MHz) and powers (in dBFS). Sending
+    offsets keeps float32 precise to a few Hz.
+    '''
+    __slots__ = ('frame_type', 'sequence', 'center_frequency', 'timestamp',
+                 'frequencies', 'dbFS')
+    def __init__(self, **kwargs):
+        self.frame_type = kwargs.get('frame_type', FRAME_SAMPLE_SET)
+        self.sequence = kwargs.get('sequence', 0)
+        self.center_frequency = kwargs.get('center_frequency', 0.)
+        self.timestamp = kwargs.get('timestamp')
+        if self.timestamp is None:
+            self.timestamp = time.time()
+        self.frequencies = kwargs.get('frequencies')
+        self.dbFS = kwargs.get('dbFS')
+    @property
+    def is_snapshot(self):
+        return self.frame_type == FRAME_SNAPSHOT
+    def to_bytes(self):
+        freqs = np.asarray(self.frequencies, dtype=np.float64)
+        base_freq = freqs[0] if freqs.size else 0.
+        header = FRAME_HEADER_STRUCT.pack(
+            FRAME_MAGIC, FRAME_VERSION, self.frame_type, self.sequence,
+            self.center_frequency, base_freq, self.timestamp, freqs.size,
+        )
+        offsets = (freqs - base_freq).astype('<f4')
+        dbFS = np.asarray(self.dbFS).astype('<f4')
+        return b''.join([header, offsets.tostring(), dbFS.tostring()])
+    @classmethod
+    def read_from(cls, sock):
+        header = recv_exact(sock, FRAME_HEADER_STRUCT.size)
+        values = FRAME_HEADER_STRUCT.unpack(header)
+        magic, version, frame_type, sequence, fc, base_freq, ts, num_points = values
+        if magic != FRAME_MAGIC:
+            raise IOError('Invalid frame header')
+        data = recv_exact(sock, num_points * 8)
+        arrays = np.frombuffer(data, dtype='<f4').reshape(2, num_points)
+        return cls(
+            frame_type=frame_type,
+            sequence=sequence,
+            center_frequency=fc,
+            timestamp=ts,
+            frequencies=arrays[0].astype(np.float64) + base_freq,
+            dbFS=arrays[1].astype(np.float64),
+        )
+    def __repr__(self):
+        kind = 'snapshot' if self.is_snapshot else 'sample_set'
+        return '<SpectrumFrame %s: %s, %s points>' % (
+            self.sequence, kind, len(self.frequencies))
+
+def recv_exact(sock, num_bytes):
+    buf = bytearray(num_bytes)
+    view = memoryview(buf)
+    pos = 0
+    while pos < num_bytes:
+        n = sock.recv_into(view[pos:], num_bytes - pos)
+        if not n:
+            raise IOError('Connection closed')
+        pos += n
+    return bytes(buf)
+
+class ClientQueue(object):
+    '''Bounded frame queue for one subscriber
+
+    Sample set frames are kept in a deque of ``maxlen`` frames, so when a
+    client falls behind the oldest frames are dropped. Only the latest
+    snapshot frame is kept.
+    '''
+    def __init__(self, maxlen=32):
+        self.frames = collections.deque(maxlen=maxlen)
+        self.snapshot = None
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+    def put(self, data, is_snapshot=False):
+        with self.condition:
+            if is_snapshot:
+                if self.snapshot is not None:
+                    self.dropped += 1
+                self.snapshot = data
+            else:
+                if len(self.frames) == self.frames.maxlen:
+                    self.dropped += 1
+                self.frames.append(data)
+            self.condition.notify()
+    def get(self, timeout=.5):
+        with self.condition:
+            if self.snapshot is None and not len(self.frames) and not self.closed:
+                self.condition.wait(timeout)
+            if self.snapshot is not None:
+                data, self.snapshot = self.snapshot, None
+                return data
+            if len(self.frames):
+                return self.frames.popleft()
+            return None
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+class SpectrumStreamHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        client_queue = server.add_client()
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while not client_queue.closed and not server.stopping.is_set():
+                data = client_queue.get()
+                if data is None:
+                    continue
+                sock.sendall(data)
+        except socket.error as e:
+            if e.errno not in [errno.EPIPE, errno.ECONNRESET]:
+                logger.exception('spectrum stream client error')
+        finally:
+            server.remove_client(client_queue)
+
+class SpectrumStreamServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''Streams live scan results to any number of TCP subscribers
+
+    Runs a :class:`~wwb_scanner.scanner.main.ThreadedScanner` and sends
+    each processed sample set, plus a full spectrum snapshot every
+    ``snapshot_interval`` seconds, as binary :class:`SpectrumFrame` s.
+    Frames are encoded once and queued per client (see
+    :class:`ClientQueue`), so slow subscribers drop frames instead of
+    slowing the scan.
+
+    params:
+        address: (hostname, port) tuple. Use port 0 to pick a free port
+        scanner: a ThreadedScanner to stream from. If not given, one is
+            built from ``config`` (scanning continuously)
+        config: scan config for the scanner built by the server
+        snapshot_interval: seconds between snapshot frames
+        client_queue_size: sample set frames queued per client
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address=('127.0.0.1', 0), **kwargs):
+        SocketServer.TCPServer.__init__(self, address, SpectrumStreamHandler)
+        scanner = kwargs.get('scanner')
+        if scanner is None:
+            scanner = ThreadedScanner(config=kwargs.get('config'), run_once=False)
+        self.scanner = scanner
+        self.snapshot_interval = kwargs.get('snapshot_interval', 1.)
+        self.client_queue_size = kwargs.get('client_queue_size', 32)
+        self.clients = []
+        self.clients_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.sequence = 0
+        self.frames_sent = 0
+        self.threads = []
+        self.sample_set_stream = None
+    def add_client(self):
+        client_queue = ClientQueue(self.client_queue_size)
+        with self.clients_lock:
+            self.clients.append(client_queue)
+        return client_queue
+    def remove_client(self, client_queue):
+        client_queue.close()
+        with self.clients_lock:
+            if client_queue in self.clients:
+                self.clients.remove(client_queue)
+    def broadcast(self, frame):
+        with self.clients_lock:
+            self.sequence += 1
+            frame.sequence = self.sequence
+            clients = list(self.clients)
+        data = frame.to_bytes()
+        for client_queue in clients:
+            client_queue.put(data, frame.is_snapshot)
+        self.frames_sent += 1
+    def publish_sample_sets(self, stream):
+        try:
+            for result in stream:
+                if self.stopping.is_set():
+                    break
+                self.broadcast(SpectrumFrame(
+                    frame_type=FRAME_SAMPLE_SET,
+                    center_frequency=result.center_frequency,
+                    frequencies=result.frequencies,
+                    dbFS=result.powers,
+                ))
+        finally:
+            stream.close()
+    def publish_snapshots(self):
+        version = None
+        while not self.stopping.wait(self.snapshot_interval):
+            snapshot = self.scanner.spectrum.get_snapshot()
+            if snapshot.version == version or not len(snapshot):
+                continue
+            version = snapshot.version
+            self.broadcast(SpectrumFrame(
+                frame_type=FRAME_SNAPSHOT,
+                frequencies=snapshot.frequencies,
+                dbFS=snapshot.dbFS,
+            ))
+    def start(self):
+        stream = self.sample_set_stream = self.scanner.stream(
+            include_progress=False, autostart=False, maxsize=64)
+        targets = [
+            (self.serve_forever, ()),
+            (self.publish_sample_sets, (stream,)),
+            (self.publish_snapshots, ()),
+        ]
+        for target, args in targets:
+            t = threading.Thread(target=target, args=args)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        if not self.scanner.is_alive():
+            self.scanner.start()
+        return self.server_address
+    def stop(self):
+        self.stopping.set()
+        if self.sample_set_stream is not None:
+            self.sample_set_stream.close()
+        scanner = self.scanner
+        scanner.stopping.set()
+        scanner.waiting.set()
+        if scanner._running.is_set():
+            scanner.stop_scan()
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client_queue in clients:
+            client_queue.close()
+        self.shutdown()
+        self.server_close()
+
+class SpectrumStreamClient(object):
+    '''Reads :class:`SpectrumFrame` s from a :class:`SpectrumStreamServer`
+    '''
+    def __init__(self, hostname='127.0.0.1', port=1236, timeout=5.):
+        self.sock = socket.create_connection((hostname, port), timeout)
+    def read_frame(self):
+        return SpectrumFrame.read_from(self.sock)
+    def __iter__(self):
+        while True:
+            try:
+                yield self.read_frame()
+            except (IOError, socket.error):
+                return
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,127 @@
+import math
+import logging
+
+from wwb_scanner.core import JSONMixin
+from wwb_scanner.scanner.sample_processing import calc_num_samples
+
+logger = logging.getLogger(__name__)
+
+RTL_XTAL_FREQ = 28.8e6
+
+SAMPLE_RATES = [1.024e6, 1.4e6, 1.8e6, 1.92e6, 2.048e6, 2.4e6, 2.56e6, 2.88e6, 3.2e6]
+
+def get_actual_sample_rate(sample_rate):
+    '''Sample rate the RTL2832 will actually produce for the requested rate
+
+    Mirrors the resampler ratio rounding done by librtlsdr so plans can be
+    built without opening the device.
+    '''
+    ratio = int(RTL_XTAL_FREQ * 2 ** 22 / sample_rate) & 0x0ffffffc
+    real_ratio = ratio | ((ratio & 0x08000000) << 1)
+    return RTL_XTAL_FREQ * 2 ** 22 / real_ratio
+
+class ScanPlan(JSONMixin):
+    _attrs = ['scan_range', 'sample_rate', 'sweep_overlap_ratio', 'fft_size',
+              'sweeps_per_scan', 'samples_per_sweep', 'center_frequencies',
+              'retune_time', 'rbw']
+    def __init__(self, **kwargs):
+        for attr in self._attrs:
+            setattr(self, attr, kwargs.get(attr))
+        if self.center_frequencies is None:
+            self.center_frequencies = []
+    @property
+    def step_size(self):
+        return self.sample_rate * (1 - self.sweep_overlap_ratio) / 1e6
+    @property
+    def num_retunes(self):
+        return len(self.center_frequencies)
+    @property
+    def dwell_time(self):
+        return self.sweeps_per_scan * self.samples_per_sweep / self.sample_rate
+    @property
+    def predicted_duration(self):
+        return self.num_retunes * (self.retune_time + self.dwell_time)
+    def apply_to_config(self, config):
+        sampling = config.sampling
+        sampling.sample_rate = self.sample_rate
+        sampling.sweep_overlap_ratio = self.sweep_overlap_ratio
+        sampling.fft_size = self.fft_size
+        sampling.sweeps_per_scan = self.sweeps_per_scan
+        sampling.samples_per_sweep = self.samples_per_sweep
+        config.scan_range = list(self.scan_range)
+    def get_summary(self):
+        lines = [
+            'Scan plan: %s - %s MHz, %d retunes, rbw=%.1f Hz' % (
+                self.scan_range[0], self.scan_range[1], self.num_retunes, self.rbw),
+            '  sample_rate=%s, fft_size=%s, sweeps=%s x %s samples' % (
+                self.sample_rate, self.fft_size,
+                self.sweeps_per_scan, self.samples_per_sweep),
+            '  predicted duration: %.2f seconds' % (self.predicted_duration),
+        ]
+        return '\n'.join(lines)
+    def print_summary(self):
+        print(self.get_summary())
+    def _serialize(self):
+        return {attr: getattr(self, attr) for attr in self._attrs}
+
+class ScanPlanner(object):
+    '''Builds a :class:`ScanPlan` for a target resolution bandwidth
+
+    params:
+        scan_range: (list) frequency range to scan (in MHz)
+        rbw: desired resolution bandwidth (in Hz)
+        time_budget: maximum scan duration (in seconds), optional
+    '''
+    def __init__(self, **kwargs):
+        self.scan_range = kwargs.get('scan_range', [400., 900.])
+        self.rbw = kwargs.get('rbw', 8e3)
+        self.time_budget = kwargs.get('time_budget')
+        self.max_sample_rate = kwargs.get('max_sample_rate', 2.4e6)
+        self.sample_rates = kwargs.get('sample_rates', SAMPLE_RATES)
+        self.overlap_ratio = kwargs.get('overlap_ratio', .25)
+        self.retune_time = kwargs.get('retune_time', .05)
+        self.min_averages = kwargs.get('min_averages', 16)
+        self.min_samples_per_sweep = kwargs.get('min_samples_per_sweep', 8192)
+    def iter_candidates(self):
+        f_min, f_max = self.scan_range
+        span = (f_max - f_min) * 1e6
+        for rate in self.sample_rates:
+            if rate > self.max_sample_rate:
+                continue
+            rs = get_actual_sample_rate(rate)
+            fft_size = calc_num_samples(math.ceil(rs / self.rbw))
+            samples_per_sweep = calc_num_samples(max(fft_size, self.min_samples_per_sweep))
+            sweeps = int(math.ceil(float(fft_size * self.min_averages) / samples_per_sweep))
+            width = rs * (1 - self.overlap_ratio)
+            num_centers = max(int(math.ceil(span / width)), 1)
+            start = f_min * 1e6 + width / 2.
+            center_frequencies = [(start + i * width) / 1e6 for i in range(num_centers)]
+            yield ScanPlan(
+                scan_range=[f_min, f_max],
+                sample_rate=rs,
+                sweep_overlap_ratio=self.overlap_ratio,
+                fft_size=fft_size,
+                sweeps_per_scan=max(sweeps, 1),
+                samples_per_sweep=samples_per_sweep,
+                center_frequencies=center_frequencies,
+                retune_time=self.retune_time,
+                rbw=rs / fft_size,
+            )
+    def build_plan(self):
+        candidates = list(self.iter_candidates())
+        if not len(candidates):
+            raise ValueError('No usable sample rates below %s' % (self.max_sample_rate))
+        def sort_key(plan):
+            return (plan.num_retunes, plan.predicted_duration)
+        candidates.sort(key=sort_key)
+        if self.time_budget is not None:
+            in_budget = [p for p in candidates
+                         if p.predicted_duration <= self.time_budget]
+            if len(in_budget):
+                candidates = in_budget
+            else:
+                candidates.sort(key=lambda p: p.predicted_duration)
+                logger.warning('Time budget of %s seconds cannot be met', self.time_budget)
+        plan = candidates[0]
+        logger.info(plan.get_summary())
+        return plan
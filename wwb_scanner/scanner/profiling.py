@@ -0,0 +1,159 @@
+import os
+import logging
+import datetime
+import threading
+import functools
+import cProfile
+import pstats
+import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from wwb_scanner.utils.dbstore import APP_PATH
+
+PROFILES_PATH = os.path.join(APP_PATH, 'profiles')
+
+logger = logging.getLogger(__name__)
+
+class ScanProfiler(object):
+    '''Collects cProfile and/or tracemalloc data while a scan runs
+
+    Starting again after :meth:`stop` (or :meth:`pause`) adds to the
+    existing cProfile stats.
+    When stopped, the following files are written to ``path`` (named after
+    ``name``):
+
+        ``<name>.prof``: cProfile stats (load with :mod:`pstats` or a viewer
+            such as snakeviz)
+        ``<name>.snapshot``: tracemalloc snapshot taken at the end of the
+            scan
+        ``<name>.txt``: summary with the top functions by cumulative time
+            and the top allocators since the scan started
+
+    :mod:`tracemalloc` is only available on Python 3.4+ (or a patched
+    interpreter). Memory profiling is skipped when it can't be imported.
+
+    params:
+        cpu: enable cProfile
+        memory: enable tracemalloc
+        name: base filename for the output files
+        path: directory for the output files. Defaults to
+            :data:`PROFILES_PATH` (next to the database)
+        top_count: number of entries in the summary
+    '''
+    def __init__(self, **kwargs):
+        self.cpu = kwargs.get('cpu', True)
+        self.memory = kwargs.get('memory', False)
+        self.name = kwargs.get('name')
+        if self.name is None:
+            self.name = self.build_name()
+        self.path = kwargs.get('path', PROFILES_PATH)
+        self.top_count = kwargs.get('top_count', 25)
+        self.profile = None
+        self.start_snapshot = None
+        self.end_snapshot = None
+        self.tracing_started = False
+        self.filenames = []
+        self.summary = None
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        kwargs.setdefault('cpu', config.get('profile_cpu', False))
+        kwargs.setdefault('memory', config.get('profile_memory', False))
+        if not kwargs['cpu'] and not kwargs['memory']:
+            return None
+        return cls(**kwargs)
+    @staticmethod
+    def build_name(prefix='scan'):
+        dt = datetime.datetime.now()
+        return '%s_%s_%s' % (prefix, dt.strftime('%Y%m%d_%H%M%S_%f'),
+                             threading.current_thread().name)
+    def get_filename(self, ext):
+        return os.path.join(self.path, '%s.%s' % (self.name, ext))
+    def start(self):
+        if self.memory:
+            if tracemalloc is None:
+                logger.warning('tracemalloc not available, memory profiling disabled')
+                self.memory = False
+            else:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(10)
+                    self.tracing_started = True
+                self.start_snapshot = tracemalloc.take_snapshot()
+        if self.cpu:
+            if self.profile is None:
+                self.profile = cProfile.Profile()
+            self.profile.enable()
+    def pause(self):
+        '''Stop collecting cProfile stats without writing any files
+        '''
+        if self.profile is not None:
+            self.profile.disable()
+    def stop(self):
+        self.pause()
+        if self.memory:
+            self.end_snapshot = tracemalloc.take_snapshot()
+            if self.tracing_started:
+                tracemalloc.stop()
+                self.tracing_started = False
+        self.write_files()
+        return self.filenames
+    def write_files(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        filenames = self.filenames = []
+        if self.profile is not None:
+            filename = self.get_filename('prof')
+            self.profile.dump_stats(filename)
+            filenames.append(filename)
+        if self.end_snapshot is not None:
+            filename = self.get_filename('snapshot')
+            self.end_snapshot.dump(filename)
+            filenames.append(filename)
+        self.summary = self.get_summary()
+        filename = self.get_filename('txt')
+        with open(filename, 'w') as f:
+            f.write(self.summary)
+        filenames.append(filename)
+    def get_summary(self):
+        sections = []
+        if self.profile is not None:
+            s = StringIO.StringIO()
+            stats = pstats.Stats(self.profile, stream=s)
+            stats.sort_stats('cumulative').print_stats(self.top_count)
+            sections.append('Top functions by cumulative time\n\n%s' % (s.getvalue()))
+        if self.end_snapshot is not None:
+            lines = ['Top allocators since scan start', '']
+            stats = self.end_snapshot.compare_to(self.start_snapshot, 'lineno')
+            for stat in stats[:self.top_count]:
+                lines.append(str(stat))
+            sections.append('\n'.join(lines))
+        return '\n\n'.join(sections)
+
+def profile_scan(f):
+    '''Decorator for ``run_scan`` methods
+
+    Profiles the scan if ``profile_cpu`` or ``profile_memory`` is set in the
+    scanner's config. Nested calls (from a subclass calling its parent's
+    ``run_scan``) are only profiled once. The profiler of the last scan is
+    kept in the scanner's ``last_profile`` attribute.
+    '''
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self, '_profiler', None) is not None:
+            return f(self, *args, **kwargs)
+        profiler = ScanProfiler.from_config(self.config)
+        if profiler is None:
+            return f(self, *args, **kwargs)
+        self._profiler = profiler
+        profiler.start()
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            self._profiler = None
+            filenames = profiler.stop()
+            self.last_profile = profiler
+            logger.info('scan profile written to %s', ', '.join(filenames))
+    return wrapper
@@ -0,0 +1,162 @@
+import os
+import time
+import struct
+import datetime
+
+import numpy as np
+
+from wwb_scanner.utils.dbstore import APP_PATH
+from wwb_scanner.scanner.rtltcp import iq_bytes_to_complex, complex_to_iq_bytes
+
+RECORDINGS_PATH = os.path.join(APP_PATH, 'recordings')
+RECORDING_EXTENSION = 'wwbiq'
+
+FILE_MAGIC = b'WWBIQ'
+FILE_VERSION = 1
+FILE_HEADER_STRUCT = struct.Struct('<5sB')
+
+# center_frequency, sample_rate, gain, timestamp, num_sweeps,
+# samples_per_sweep, sample_format
+RECORD_HEADER_STRUCT = struct.Struct('<dddd2IB7x')
+
+SAMPLE_FORMATS = ['uint8', 'complex64']
+SAMPLE_DTYPES = {'uint8': np.dtype(np.uint8), 'complex64': np.dtype(np.complex64)}
+VALUES_PER_SAMPLE = {'uint8': 2, 'complex64': 1}
+
+class IQRecord(object):
+    '''One sample set stored in an :class:`IQRecording`
+
+    The samples are not read until :attr:`samples` is accessed and are
+    memory mapped from the file.
+    '''
+    def __init__(self, **kwargs):
+        self.recording = kwargs.get('recording')
+        self.offset = kwargs.get('offset')
+        self.center_frequency = kwargs.get('center_frequency')
+        self.sample_rate = kwargs.get('sample_rate')
+        self.gain = kwargs.get('gain')
+        self.timestamp = kwargs.get('timestamp')
+        self.num_sweeps = kwargs.get('num_sweeps')
+        self.samples_per_sweep = kwargs.get('samples_per_sweep')
+        self.sample_format = kwargs.get('sample_format')
+    @property
+    def data_size(self):
+        dtype = SAMPLE_DTYPES[self.sample_format]
+        n = self.num_sweeps * self.samples_per_sweep * VALUES_PER_SAMPLE[self.sample_format]
+        return n * dtype.itemsize
+    @property
+    def samples(self):
+        fmt = self.sample_format
+        n = self.num_sweeps * self.samples_per_sweep * VALUES_PER_SAMPLE[fmt]
+        data = np.memmap(self.recording.filename, dtype=SAMPLE_DTYPES[fmt],
+                         mode='r', offset=self.offset, shape=(n,))
+        if fmt == 'uint8':
+            data = iq_bytes_to_complex(data)
+        return data.reshape(self.num_sweeps, self.samples_per_sweep)
+    def __repr__(self):
+        return '<IQRecord: %s Hz, %s x %s>' % (
+            self.center_frequency, self.num_sweeps, self.samples_per_sweep)
+
+class IQRecording(object):
+    '''Reader for raw IQ recordings written by :class:`IQRecorder`
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = list(self.iter_headers())
+    def iter_headers(self):
+        file_size = os.path.getsize(self.filename)
+        with open(self.filename, 'rb') as f:
+            magic, version = FILE_HEADER_STRUCT.unpack(f.read(FILE_HEADER_STRUCT.size))
+            if magic != FILE_MAGIC:
+                raise ValueError('%s is not an IQ recording' % (self.filename))
+            if version > FILE_VERSION:
+                raise ValueError('Unsupported recording version: %s' % (version))
+            pos = FILE_HEADER_STRUCT.size
+            while pos + RECORD_HEADER_STRUCT.size <= file_size:
+                f.seek(pos)
+                values = RECORD_HEADER_STRUCT.unpack(f.read(RECORD_HEADER_STRUCT.size))
+                gain = values[2]
+                record = IQRecord(
+                    recording=self,
+                    offset=pos + RECORD_HEADER_STRUCT.size,
+                    center_frequency=values[0],
+                    sample_rate=values[1],
+                    gain=None if np.isnan(gain) else gain,
+                    timestamp=values[3],
+                    num_sweeps=values[4],
+                    samples_per_sweep=values[5],
+                    sample_format=SAMPLE_FORMATS[values[6]],
+                )
+                if record.offset + record.data_size > file_size:
+                    # Truncated by an interrupted scan
+                    break
+                yield record
+                pos = record.offset + record.data_size
+    @property
+    def sample_rate(self):
+        if not len(self.records):
+            return None
+        return self.records[0].sample_rate
+    def __len__(self):
+        return len(self.records)
+    def __iter__(self):
+        return iter(self.records)
+
+class IQRecorder(object):
+    '''Writes the raw samples of each sample set to a binary file
+
+    The file starts with a short header (:data:`FILE_HEADER_STRUCT`)
+    followed by one record per sample set. Each record has a header
+    (:data:`RECORD_HEADER_STRUCT`) and the samples of all sweeps, stored
+    either as interleaved ``uint8`` I/Q values (as sent by the device) or as
+    ``complex64``.
+    '''
+    def __init__(self, filename, sample_format='complex64'):
+        if sample_format not in SAMPLE_FORMATS:
+            raise ValueError('Unknown sample format: %s' % (sample_format))
+        self.filename = filename
+        self.sample_format = sample_format
+        self.fp = open(filename, 'wb')
+        self.fp.write(FILE_HEADER_STRUCT.pack(FILE_MAGIC, FILE_VERSION))
+    @classmethod
+    def for_scan(cls, sample_format=None):
+        if not os.path.exists(RECORDINGS_PATH):
+            os.makedirs(RECORDINGS_PATH)
+        dt = datetime.datetime.now()
+        filename = os.path.join(RECORDINGS_PATH, 'scan_%s.%s' % (
+            dt.strftime('%Y%m%d_%H%M%S_%f'), RECORDING_EXTENSION))
+        return cls(filename, sample_format or 'complex64')
+    def write_sample_set(self, sample_set, gain=None, timestamp=None):
+        raw = sample_set.raw
+        if raw is None:
+            return
+        rs = sample_set.scanner.sample_rate
+        self.write(raw, sample_set.center_frequency, rs, gain, timestamp)
+    def write(self, samples, center_frequency, sample_rate, gain=None, timestamp=None):
+        samples = np.asarray(samples)
+        if samples.ndim == 1:
+            samples = samples.reshape(1, -1)
+        if gain is None:
+            gain = np.nan
+        if timestamp is None:
+            timestamp = time.time()
+        num_sweeps, samples_per_sweep = samples.shape
+        header = RECORD_HEADER_STRUCT.pack(
+            center_frequency, sample_rate, gain, timestamp,
+            num_sweeps, samples_per_sweep,
+            SAMPLE_FORMATS.index(self.sample_format),
+        )
+        if self.sample_format == 'uint8':
+            data = complex_to_iq_bytes(samples.flatten())
+        else:
+            data = samples.astype(np.complex64).tostring()
+        self.fp.write(header)
+        self.fp.write(data)
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,66 @@
+import numpy as np
+
+def merge_regions(regions, min_gap=0.):
+    merged = []
+    for start, end in sorted(regions):
+        if len(merged) and start - merged[-1][1] <= min_gap:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+            continue
+        merged.append([start, end])
+    return merged
+
+def clip_regions(regions, f_min, f_max):
+    clipped = []
+    for start, end in regions:
+        start = max(start, f_min)
+        end = min(end, f_max)
+        if end > start:
+            clipped.append([start, end])
+    return clipped
+
+def invert_regions(regions, f_min, f_max):
+    gaps = []
+    freq = f_min
+    for start, end in regions:
+        if start > freq:
+            gaps.append([freq, start])
+        freq = max(freq, end)
+    if freq < f_max:
+        gaps.append([freq, f_max])
+    return gaps
+
+def subtract_regions(regions, excluded):
+    excluded = merge_regions(excluded)
+    result = []
+    for start, end in regions:
+        _excluded = clip_regions(excluded, start, end)
+        result.extend(invert_regions(_excluded, start, end))
+    return result
+
+def find_active_regions(freqs, powers, threshold_db=10., padding=.5, min_gap=1.):
+    '''Find frequency regions (in MHz) with energy above the noise floor
+
+    The noise floor is taken as the median level of the whole sweep, which
+    holds as long as most of the scanned band is empty.
+    '''
+    freqs = np.asarray(freqs)
+    if not freqs.size:
+        return []
+    db = 10. * np.log10(np.abs(powers))
+    active = db >= np.median(db) + threshold_db
+    if not active.any():
+        return []
+    f = freqs[active]
+    breaks = np.flatnonzero(np.diff(f) > min_gap)
+    starts = np.concatenate(([f[0]], f[breaks + 1]))
+    ends = np.concatenate((f[breaks], [f[-1]]))
+    regions = [[s - padding, e + padding] for s, e in zip(starts, ends)]
+    return merge_regions(regions, min_gap)
+
+def iter_region_centers(region, width):
+    start, end = region
+    freq = start + width / 2.
+    while freq - width / 2. < end:
+        yield freq
+        freq += width
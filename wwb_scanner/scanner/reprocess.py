@@ -0,0 +1,289 @@
+import os
+import sys
+import argparse
+import tempfile
+import multiprocessing
+import multiprocessing.util
+
+import numpy as np
+
+from wwb_scanner.scanner.main import ScannerBase, hz_to_mhz
+from wwb_scanner.scanner.recording import IQRecording
+from wwb_scanner.scanner.profiling import ScanProfiler, profile_scan
+from wwb_scanner.scanner.sample_processing import (
+    DEFAULT_NPERSEG,
+    WINDOW_TYPES,
+    calc_psd,
+)
+
+_worker_state = {}
+
+def _init_worker(filename, output_filename, output_shape, psd_kwargs, profile_name=None):
+    _worker_state.update(
+        recording=IQRecording(filename),
+        output=np.memmap(output_filename, dtype=np.float64, mode='r+', shape=output_shape),
+        psd_kwargs=psd_kwargs,
+        profiler=None,
+    )
+    if profile_name is not None:
+        profiler = _worker_state['profiler'] = ScanProfiler(
+            name='%s_worker%d' % (profile_name, os.getpid()),
+        )
+        # Pool workers don't run atexit handlers, but do run multiprocessing
+        # finalizers when they exit after the pool is closed
+        multiprocessing.util.Finalize(profiler, profiler.write_files, exitpriority=10)
+
+def _process_record(index):
+    profiler = _worker_state['profiler']
+    if profiler is not None:
+        profiler.start()
+    record = _worker_state['recording'].records[index]
+    f, powers = calc_psd(record.samples, record.center_frequency,
+                         record.sample_rate, **_worker_state['psd_kwargs'])
+    output = _worker_state['output']
+    output[index, 0] = f
+    output[index, 1] = np.abs(powers)
+    if profiler is not None:
+        profiler.pause()
+    return index
+
+class ReprocessScanner(ScannerBase):
+    '''Runs sample processing on a raw IQ recording instead of a device
+
+    Each record is memory mapped and processed in turn, so recordings
+    larger than the available memory can be used.
+
+    params:
+        recording: an :class:`~wwb_scanner.scanner.recording.IQRecording`
+            or the filename of one
+        nperseg: FFT size
+        window: window type (one of :attr:`WINDOW_TYPES`)
+        overlap_ratio: fraction of each tile to crop. Defaults to the
+            ``sweep_overlap_ratio`` of the scan config
+        save: if True, save the resulting spectrum to the database
+    '''
+    def __init__(self, **kwargs):
+        recording = kwargs.get('recording')
+        if not isinstance(recording, IQRecording):
+            recording = IQRecording(recording)
+        self.recording = recording
+        self.nperseg = kwargs.get('nperseg', DEFAULT_NPERSEG)
+        self.window = kwargs.get('window', 'hann')
+        self.save = kwargs.get('save', False)
+        if not kwargs.get('config'):
+            kwargs['config'] = self.build_config()
+        super(ReprocessScanner, self).__init__(**kwargs)
+        overlap_ratio = kwargs.get('overlap_ratio')
+        if overlap_ratio is not None:
+            self.sampling_config.sweep_overlap_ratio = overlap_ratio
+        self.sampling_config.sample_rate = self.recording.sample_rate
+    def build_config(self):
+        records = self.recording.records
+        config = {'sampling':{}, 'device':{}}
+        if not len(records):
+            return config
+        freqs = [r.center_frequency for r in records]
+        half_bw = records[0].sample_rate / 2.
+        config['scan_range'] = [hz_to_mhz(min(freqs) - half_bw),
+                                hz_to_mhz(max(freqs) + half_bw)]
+        config['sampling']['samples_per_sweep'] = records[0].samples_per_sweep
+        config['sampling']['sweeps_per_scan'] = records[0].num_sweeps
+        config['device']['gain'] = records[0].gain
+        return config
+    @property
+    def sample_rate(self):
+        return self.sampling_config.sample_rate
+    @property
+    def samples_per_sweep(self):
+        return self.sampling_config.samples_per_sweep
+    @property
+    def sweeps_per_scan(self):
+        return self.sampling_config.sweeps_per_scan
+    @property
+    def gain(self):
+        return self.device_config.get('gain')
+    def build_sample_set(self, record):
+        sample_set = self.sample_collection.build_sample_set(
+            record.center_frequency,
+            nperseg=self.nperseg,
+            window=self.window,
+            sweeps_per_scan=record.num_sweeps,
+        )
+        return sample_set
+    @profile_scan
+    def run_scan(self):
+        running = self._running
+        running.set()
+        self._stopped.clear()
+        self.metrics.start()
+        records = self.recording.records
+        for i, record in enumerate(records):
+            if not running.is_set():
+                break
+            sample_set = self.build_sample_set(record)
+            sample_set.raw = record.samples
+            sample_set.process_samples()
+            sample_set.raw = None
+            self.progress = (i + 1) / float(len(records))
+        if running.is_set() and self.save:
+            self.save_to_dbstore()
+        running.clear()
+        self.on_scan_complete()
+        self._stopped.set()
+    def stop_scan(self):
+        self._running.clear()
+        self._stopped.wait()
+    def update_scan_progress(self, sample_set):
+        pass
+
+class ParallelReprocessScanner(ReprocessScanner):
+    '''Reprocesses a recording using a pool of worker processes
+
+    Workers memory map the recording themselves and write their results
+    to a shared output file, so only record indices are sent between
+    processes. Results are merged into the spectrum in recording order
+    regardless of which worker finishes first.
+
+    params:
+        processes: number of worker processes. Defaults to the number of
+            CPU cores
+        chunk_size: number of records handed to a worker at a time
+    '''
+    def __init__(self, **kwargs):
+        super(ParallelReprocessScanner, self).__init__(**kwargs)
+        self.processes = kwargs.get('processes') or multiprocessing.cpu_count()
+        self.chunk_size = kwargs.get('chunk_size', 1)
+        self.pool = None
+    @property
+    def num_bins(self):
+        crop = int((self.nperseg * self.sampling_config.sweep_overlap_ratio) / 2)
+        return self.nperseg - crop * 2
+    @profile_scan
+    def run_scan(self):
+        running = self._running
+        running.set()
+        self._stopped.clear()
+        self.metrics.start()
+        records = self.recording.records
+        output_shape = (len(records), 2, self.num_bins)
+        fd, output_filename = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        pool = None
+        completed = False
+        try:
+            output = np.memmap(output_filename, dtype=np.float64, mode='w+', shape=output_shape)
+            psd_kwargs = dict(
+                nperseg=self.nperseg,
+                window=self.window,
+                overlap_ratio=self.sampling_config.sweep_overlap_ratio,
+            )
+            profile_name = None
+            if self._profiler is not None and self._profiler.cpu:
+                profile_name = self._profiler.name
+            pool = self.pool = multiprocessing.Pool(
+                self.processes,
+                initializer=_init_worker,
+                initargs=(self.recording.filename, output_filename, output_shape,
+                          psd_kwargs, profile_name),
+            )
+            results = pool.imap(_process_record, range(len(records)), self.chunk_size)
+            for i in results:
+                if not running.is_set():
+                    break
+                self.merge_record(records[i], output[i, 0], output[i, 1])
+                self.progress = (i + 1) / float(len(records))
+            completed = running.is_set()
+        finally:
+            if pool is not None:
+                # Closing (instead of terminating) lets the workers exit
+                # normally and write their profiles
+                if completed:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+            self.pool = None
+            output = None
+            os.remove(output_filename)
+        if running.is_set() and self.save:
+            self.save_to_dbstore()
+        running.clear()
+        self.on_scan_complete()
+        self._stopped.set()
+    def merge_record(self, record, frequencies, powers):
+        sample_set = self.build_sample_set(record)
+        sample_set.frequencies = np.array(frequencies)
+        sample_set.powers = np.array(powers)
+        self.on_sample_set_processed(sample_set)
+
+def reprocess_recording(filename, **kwargs):
+    '''Reprocess a raw IQ recording and return the resulting
+    :class:`~wwb_scanner.scan_objects.Spectrum`
+
+    Keyword arguments are passed to :class:`ReprocessScanner`, or to
+    :class:`ParallelReprocessScanner` if ``processes`` is anything but 1
+    (``None`` uses all CPU cores).
+    '''
+    kwargs['recording'] = filename
+    if kwargs.get('processes', 1) != 1:
+        cls = ParallelReprocessScanner
+    else:
+        cls = ReprocessScanner
+    scanner = cls(**kwargs)
+    scanner.run_scan()
+    return scanner.spectrum
+
+class CLIProgress(object):
+    def __init__(self):
+        self.last_value = None
+    def __call__(self, value):
+        value = int(value * 100)
+        if value == self.last_value:
+            return
+        self.last_value = value
+        sys.stderr.write('\r%3d%%' % (value))
+        if value == 100:
+            sys.stderr.write('\n')
+        sys.stderr.flush()
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Reprocess raw IQ recordings')
+    p.add_argument('filename', help='IQ recording to process')
+    p.add_argument('-n', '--nperseg', type=int, default=DEFAULT_NPERSEG,
+                   help='FFT size')
+    p.add_argument('-w', '--window', default='hann', choices=WINDOW_TYPES,
+                   help='Window type')
+    p.add_argument('-r', '--overlap-ratio', type=float, dest='overlap_ratio',
+                   help='Fraction of each tile to crop')
+    p.add_argument('-p', '--processes', type=int, default=None,
+                   help='Number of worker processes (default: number of CPU cores)')
+    p.add_argument('-o', '--output', help='Export the spectrum to this file')
+    p.add_argument('--save', action='store_true',
+                   help='Save the spectrum to the database')
+    p.add_argument('--profile', action='store_true',
+                   help='Write cProfile stats for the scan and each worker')
+    p.add_argument('--profile-memory', action='store_true', dest='profile_memory',
+                   help='Write tracemalloc snapshots (Python 3.4+)')
+    args = p.parse_args(argv)
+    kwargs = dict(
+        recording=args.filename,
+        nperseg=args.nperseg,
+        window=args.window,
+        overlap_ratio=args.overlap_ratio,
+        processes=args.processes,
+        save=args.save,
+    )
+    if args.processes == 1:
+        scanner = ReprocessScanner(**kwargs)
+    else:
+        scanner = ParallelReprocessScanner(**kwargs)
+    scanner.config.profile_cpu = args.profile
+    scanner.config.profile_memory = args.profile_memory
+    scanner.on_progress = CLIProgress()
+    scanner.run_scan()
+    if args.output:
+        scanner.spectrum.export_to_file(filename=args.output)
+    return scanner.spectrum
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,129 @@
 import subprocess
 
+import numpy as np
+
 from wwb_scanner.scanner.main import ScannerBase, hz_to_mhz
+from wwb_scanner.scanner.profiling import profile_scan
+
+def parse_rtl_power_line(line):
+    '''Parse one row of rtl_power CSV output
+
+    Returns a tuple of ``(frequencies, powers)`` arrays with frequencies in
+    MHz, or ``None`` if the line is not a data row.
+    '''
+    fields = line.split(',', 6)
+    if len(fields) < 7:
+        return None
+    hz_low = float(fields[2])
+    hz_step = float(fields[4])
+    powers = np.fromstring(fields[6], sep=',')
+    freqs = hz_low + np.arange(powers.size) * hz_step
+    return hz_to_mhz(freqs), powers
 
 class RtlPowerScanner(ScannerBase):
+    '''Scanner backend using the ``rtl_power`` utility
+
+    ``rtl_power`` is run without a shell and its output is parsed row by
+    row as it arrives.
+
+    params:
+        rtl_power_path: path to the rtl_power executable
+        bin_size: FFT bin size (in Hz)
+        crop_ratio: fraction of each hop to discard (0 - 1)
+        fir_size: downsampling FIR filter size (0 or 4)
+        continuous: if True, keep sweeping every ``interval`` seconds until
+            :meth:`stop_scan` is called
+        interval: integration interval (in seconds)
+    '''
+    def __init__(self, **kwargs):
+        super(RtlPowerScanner, self).__init__(**kwargs)
+        self.rtl_power_path = kwargs.get('rtl_power_path', 'rtl_power')
+        self.bin_size = kwargs.get('bin_size', 8e3)
+        self.crop_ratio = kwargs.get('crop_ratio', .5)
+        self.fir_size = kwargs.get('fir_size', 4)
+        self.continuous = kwargs.get('continuous', False)
+        self.interval = kwargs.get('interval', 10)
+        self.process = None
+        self.sweep_count = 0
+    @property
+    def gain(self):
+        return self.device_config.get('gain')
+    def build_command(self):
+        f_min, f_max = self.config.scan_range
+        device_config = self.device_config
+        cmd = [
+            self.rtl_power_path,
+            '-f', '%fM:%fM:%d' % (f_min, f_max, int(self.bin_size)),
+            '-c', '%s%%' % (int(self.crop_ratio * 100)),
+            '-F', str(self.fir_size),
+            '-d', str(device_config.get('device_index', 0)),
+        ]
+        if self.gain is not None:
+            cmd.extend(['-g', str(self.gain)])
+        if device_config.get('freq_correction'):
+            cmd.extend(['-p', str(device_config.freq_correction)])
+        if self.continuous:
+            cmd.extend(['-i', str(self.interval)])
+        else:
+            cmd.append('-1')
+        cmd.append('-')
+        return cmd
+    @profile_scan
     def run_scan(self):
-        fir_size = 4
-        crop_size = 50
-        cmd_str = 'rtl_power -f %fM:%fM:%fM -c %s%% -g %s -F %s -1 -'
-        cmd_str = cmd_str % (
-            self.scan_range[0],
-            self.scan_range[1],
-            self.step_size / 2.,
-            crop_size,
-            self.gain,
-            fir_size,
-        )
-        self.result = subprocess.check_output(cmd_str, shell=True)
+        running = self._running
+        running.set()
+        self._stopped.clear()
+        self.metrics.start()
+        self.sweep_count = 0
+        self._last_freq = None
+        try:
+            proc = self.process = subprocess.Popen(self.build_command(),
+                                                   stdout=subprocess.PIPE)
+            try:
+                for line in iter(proc.stdout.readline, b''):
+                    if not running.is_set():
+                        break
+                    self.process_line(line)
+            finally:
+                if proc.poll() is None:
+                    proc.terminate()
+                returncode = proc.wait()
+                proc.stdout.close()
+                self.process = None
+            # A non-zero status after stop_scan is from terminate()
+            if returncode != 0 and running.is_set():
+                raise RuntimeError('rtl_power exited with status %s' % (returncode))
+            if running.is_set():
+                self.save_to_dbstore()
+        finally:
+            running.clear()
+            self.on_scan_complete()
+            self._stopped.set()
+    def stop_scan(self):
+        self._running.clear()
+        proc = self.process
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+        self._stopped.wait()
+    def process_line(self, line):
+        parsed = parse_rtl_power_line(line)
+        if parsed is None:
+            return
+        freqs, powers = parsed
+        if not freqs.size:
+            return
+        if self._last_freq is not None and freqs[0] < self._last_freq:
+            self.on_sweep_complete()
+        self._last_freq = freqs[-1]
+        metrics = self.metrics
         spectrum = self.spectrum
-        for line in self.result.splitlines():
-            values = line.split(',')
-            f = hz_to_mhz(float(values[2]))
-            step = hz_to_mhz(float(values[4]))
-            for p in values[6:]:
-                spectrum.add_sample(frequency=f, magnitude=float(p))
-                f += step
+        spectrum.live = True
+        with metrics.timer('stitch'):
+            spectrum.add_samples(freqs, dbFS=powers, force_magnitude=True)
+            spectrum.publish_snapshot(spectrum.snapshot_interval)
+        metrics.increment('bins_added', freqs.size)
+        self.on_sweep_processed(frequencies=freqs, powers=powers)
+        self.current_freq = freqs[-1]
+    def on_sweep_complete(self):
+        self.sweep_count += 1
+        self.metrics.increment('sweeps')
@@ -0,0 +1,461 @@
+import time
+import errno
+import socket
+import struct
+import logging
+import threading
+import SocketServer
+
+import numpy as np
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+
+from wwb_scanner.scanner.plan import get_actual_sample_rate
+from wwb_scanner.scanner.simulated import SimulatedSdr, R820T_GAINS
+
+logger = logging.getLogger(__name__)
+
+CMD_SET_FREQ = 0x01
+CMD_SET_SAMPLE_RATE = 0x02
+CMD_SET_GAIN_MODE = 0x03
+CMD_SET_GAIN = 0x04
+CMD_SET_FREQ_CORRECTION = 0x05
+CMD_SET_AGC_MODE = 0x08
+
+TUNER_TYPES = ['UNKNOWN', 'E4000', 'FC0012', 'FC0013', 'FC2580', 'R820T', 'R828D']
+
+HEADER_STRUCT = struct.Struct('>4sII')
+COMMAND_STRUCT = struct.Struct('>BI')
+
+def iq_bytes_to_complex(data):
+    iq = np.frombuffer(data, dtype=np.uint8).astype(np.float32)
+    iq -= 127.5
+    iq /= 127.5
+    return iq.view(np.complex64)
+
+def complex_to_iq_bytes(samples):
+    iq = np.empty(samples.size * 2, dtype=np.float32)
+    iq[0::2] = samples.real
+    iq[1::2] = samples.imag
+    iq *= 127.5
+    iq += 127.5
+    return np.clip(iq, 0, 255).astype(np.uint8).tostring()
+
+def get_socket_queued_bytes(sock):
+    '''Number of bytes received by ``sock`` and not yet read (0 if this
+    can't be determined on the platform)
+    '''
+    if fcntl is None:
+        return 0
+    try:
+        data = fcntl.ioctl(sock.fileno(), termios.FIONREAD, struct.pack('I', 0))
+    except (IOError, socket.error):
+        return 0
+    return struct.unpack('I', data)[0]
+
+class RingBuffer(object):
+    '''Fixed size byte ring filled by one writer thread
+
+    Positions are absolute byte counts so readers can tell how much data
+    they have missed if the writer laps them. IQ pairs always start at even
+    positions, so the read position is only ever moved to even positions.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.data = np.zeros(size, dtype=np.uint8)
+        self.view = memoryview(self.data)
+        self.write_pos = 0
+        self.read_pos = 0
+        self.dropped = 0
+        self.condition = threading.Condition()
+    @property
+    def available(self):
+        return self.write_pos - self.read_pos
+    def get_write_view(self, max_bytes):
+        start = self.write_pos % self.size
+        return self.view[start:start + min(max_bytes, self.size - start)]
+    def commit(self, num_bytes):
+        with self.condition:
+            self.write_pos += num_bytes
+            overrun = self.write_pos - self.read_pos - self.size
+            if overrun > 0:
+                overrun += overrun % 2
+                self.read_pos += overrun
+                self.dropped += overrun
+            self.condition.notify_all()
+    def discard(self, num_bytes=0):
+        with self.condition:
+            read_pos = self.write_pos + num_bytes
+            self.read_pos = read_pos + read_pos % 2
+    def align_write(self):
+        '''Move the write position to an even byte count
+
+        Called before the writer starts a new stream (such as after a
+        reconnect) that may follow an incomplete IQ pair.
+        '''
+        with self.condition:
+            if self.write_pos % 2:
+                self.write_pos += 1
+                if self.read_pos < self.write_pos:
+                    self.read_pos = self.write_pos
+    def read(self, num_bytes, timeout=None):
+        if num_bytes > self.size:
+            raise ValueError('Read of %s bytes exceeds buffer size' % (num_bytes))
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.condition:
+            while self.write_pos - self.read_pos < num_bytes:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                self.condition.wait(remaining)
+            start = self.read_pos % self.size
+            end = start + num_bytes
+            if end <= self.size:
+                out = self.data[start:end].copy()
+            else:
+                out = np.concatenate([self.data[start:], self.data[:end - self.size]])
+            self.read_pos += num_bytes
+        return out
+
+class RtlTcpClient(object):
+    '''Buffered client for the rtl_tcp protocol
+
+    A reader thread keeps the connection drained in large blocks into a
+    preallocated :class:`RingBuffer`. Control commands are queued and sent
+    together before the next read, and a dropped connection is re-opened
+    with the current tuning restored.
+
+    Exposes the subset of the :class:`rtlsdr.RtlSdr` interface used by
+    :class:`~wwb_scanner.scanner.sample_processing.SampleSet`.
+    '''
+    def __init__(self, **kwargs):
+        self.hostname = kwargs.get('hostname', '127.0.0.1')
+        self.port = kwargs.get('port', 1234)
+        self.buffer_size = kwargs.get('buffer_size', 1 << 23)
+        self.block_size = kwargs.get('block_size', 1 << 18)
+        self.read_timeout = kwargs.get('read_timeout', 5.)
+        self.settle_time = kwargs.get('settle_time', .01)
+        self.reconnect_interval = kwargs.get('reconnect_interval', 1.)
+        self.ring = RingBuffer(self.buffer_size)
+        self.sock = None
+        self.tuner_type = None
+        self.gain_count = None
+        self.device_opened = False
+        self.read_async_canceling = False
+        self._sample_rate = 2.048e6
+        self._center_freq = 100e6
+        self._gain = None
+        self._freq_correction = 0
+        self._pending_commands = []
+        self._command_lock = threading.Lock()
+        self._connected = threading.Event()
+        self._closing = threading.Event()
+        self._async_cancel = threading.Event()
+        self.reconnect_count = 0
+        self.connect()
+        self.reader_thread = threading.Thread(target=self._reader_loop)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+    def connect(self):
+        sock = socket.create_connection((self.hostname, self.port), self.read_timeout)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.block_size * 4)
+        header = self._recv_exact(sock, HEADER_STRUCT.size)
+        magic, tuner_type, gain_count = HEADER_STRUCT.unpack(header)
+        if magic != 'RTL0':
+            sock.close()
+            raise IOError('Invalid rtl_tcp header from %s:%s' % (self.hostname, self.port))
+        if tuner_type < len(TUNER_TYPES):
+            self.tuner_type = TUNER_TYPES[tuner_type]
+        self.gain_count = gain_count
+        self.sock = sock
+        self.device_opened = True
+        self._queue_state()
+        self.flush_commands()
+        self._connected.set()
+    @staticmethod
+    def _recv_exact(sock, num_bytes):
+        data = b''
+        while len(data) < num_bytes:
+            chunk = sock.recv(num_bytes - len(data))
+            if not chunk:
+                raise IOError('Connection closed')
+            data += chunk
+        return data
+    def _queue_state(self):
+        with self._command_lock:
+            self._pending_commands = []
+        self.queue_command(CMD_SET_SAMPLE_RATE, int(self._sample_rate))
+        self.queue_command(CMD_SET_FREQ, int(self._center_freq))
+        if self._gain is None:
+            self.queue_command(CMD_SET_GAIN_MODE, 0)
+        else:
+            self.queue_command(CMD_SET_GAIN_MODE, 1)
+            self.queue_command(CMD_SET_GAIN, int(round(self._gain * 10)))
+        if self._freq_correction:
+            self.queue_command(CMD_SET_FREQ_CORRECTION, self._freq_correction & 0xffffffff)
+    def _reader_loop(self):
+        ring = self.ring
+        while not self._closing.is_set():
+            if not self._connected.is_set():
+                self._reconnect()
+                continue
+            try:
+                view = ring.get_write_view(self.block_size)
+                num_bytes = self.sock.recv_into(view)
+                if not num_bytes:
+                    raise IOError('Connection closed')
+            except socket.timeout:
+                continue
+            except (IOError, socket.error):
+                if self._closing.is_set():
+                    break
+                self._connected.clear()
+                continue
+            ring.commit(num_bytes)
+    def _reconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+        self.ring.align_write()
+        try:
+            self.connect()
+        except (IOError, socket.error):
+            self._closing.wait(self.reconnect_interval)
+            return
+        self.reconnect_count += 1
+        self.ring.discard()
+    def queue_command(self, cmd, param):
+        with self._command_lock:
+            self._pending_commands = [c for c in self._pending_commands if c[0] != cmd]
+            self._pending_commands.append((cmd, param))
+    def flush_commands(self):
+        with self._command_lock:
+            commands = self._pending_commands
+            self._pending_commands = []
+        if not len(commands) or self.sock is None:
+            return False
+        data = b''.join([COMMAND_STRUCT.pack(cmd, param) for cmd, param in commands])
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self._connected.clear()
+            return False
+        # Samples already waiting in the socket were captured before the
+        # change and are skipped as well
+        settle_bytes = int(self._sample_rate * self.settle_time) * 2
+        settle_bytes += get_socket_queued_bytes(self.sock)
+        self.ring.discard(settle_bytes)
+        return True
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+    @sample_rate.setter
+    def sample_rate(self, value):
+        self._sample_rate = get_actual_sample_rate(value)
+        self.queue_command(CMD_SET_SAMPLE_RATE, int(value))
+    def get_sample_rate(self):
+        return self.sample_rate
+    @property
+    def center_freq(self):
+        return self._center_freq
+    @center_freq.setter
+    def center_freq(self, value):
+        self.set_center_freq(value)
+    def set_center_freq(self, value):
+        self._center_freq = value
+        self.queue_command(CMD_SET_FREQ, int(value))
+    def get_center_freq(self):
+        return self._center_freq
+    @property
+    def gain(self):
+        return self._gain
+    @gain.setter
+    def gain(self, value):
+        if value == 'auto':
+            value = None
+        self._gain = value
+        if value is None:
+            self.queue_command(CMD_SET_GAIN_MODE, 0)
+        else:
+            self.queue_command(CMD_SET_GAIN_MODE, 1)
+            self.queue_command(CMD_SET_GAIN, int(round(value * 10)))
+    @property
+    def freq_correction(self):
+        return self._freq_correction
+    @freq_correction.setter
+    def freq_correction(self, value):
+        self._freq_correction = int(value)
+        self.queue_command(CMD_SET_FREQ_CORRECTION, int(value) & 0xffffffff)
+    def get_gains(self):
+        if self.tuner_type in ['R820T', 'R828D']:
+            return list(R820T_GAINS)
+        return None
+    def read_bytes(self, num_bytes):
+        self.flush_commands()
+        data = self.ring.read(num_bytes, timeout=self.read_timeout)
+        if data is None:
+            raise IOError('Timed out reading from %s:%s' % (self.hostname, self.port))
+        return data
+    def read_samples(self, num_samples=1024):
+        return iq_bytes_to_complex(self.read_bytes(num_samples * 2))
+    def read_samples_async(self, callback, num_samples=1024, context=None):
+        self._async_cancel.clear()
+        self.read_async_canceling = False
+        while not self._async_cancel.is_set():
+            callback(self.read_samples(num_samples), context)
+        self.read_async_canceling = False
+    def cancel_read_async(self):
+        self.read_async_canceling = True
+        self._async_cancel.set()
+    def close(self):
+        self._closing.set()
+        self.cancel_read_async()
+        self.device_opened = False
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+        self.reader_thread.join(self.read_timeout)
+
+class FileIQSource(object):
+    '''Replays a raw uint8 IQ recording (as written by ``rtl_sdr``) in a loop
+    '''
+    tuner_type = 'R820T'
+    def __init__(self, filename):
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        self.pos = 0
+        self.sample_rate = 2.048e6
+        self.center_freq = 100e6
+        self.gain = 0.
+        self.freq_correction = 0
+    def read_bytes(self, num_bytes):
+        data = self.data
+        out = []
+        while num_bytes > 0:
+            chunk = data[self.pos:self.pos + num_bytes]
+            out.append(chunk.tostring())
+            num_bytes -= chunk.size
+            self.pos = (self.pos + chunk.size) % data.size
+        return b''.join(out)
+
+class RtlTcpRequestHandler(SocketServer.BaseRequestHandler):
+    def setup(self):
+        self.closed = threading.Event()
+    def handle(self):
+        server = self.server
+        source = server.build_source()
+        tuner_type = TUNER_TYPES.index(getattr(source, 'tuner_type', 'R820T'))
+        self.request.sendall(HEADER_STRUCT.pack('RTL0', tuner_type, len(R820T_GAINS)))
+        cmd_thread = threading.Thread(target=self.read_commands, args=(source,))
+        cmd_thread.daemon = True
+        cmd_thread.start()
+        block_samples = server.block_samples
+        start_ts = time.time()
+        samples_sent = 0
+        try:
+            while not self.closed.is_set() and not server.stopping.is_set():
+                if isinstance(source, FileIQSource):
+                    data = source.read_bytes(block_samples * 2)
+                else:
+                    data = complex_to_iq_bytes(source.generate_samples(block_samples))
+                self.request.sendall(data)
+                samples_sent += block_samples
+                if server.realtime:
+                    delay = samples_sent / source.sample_rate - (time.time() - start_ts)
+                    if delay > 0:
+                        time.sleep(delay)
+        except socket.error as e:
+            if e.errno not in [errno.EPIPE, errno.ECONNRESET]:
+                logger.exception('rtl_tcp client connection error')
+        finally:
+            self.closed.set()
+    def read_commands(self, source):
+        sock = self.request
+        size = COMMAND_STRUCT.size
+        try:
+            while not self.closed.is_set():
+                data = RtlTcpClient._recv_exact(sock, size)
+                cmd, param = COMMAND_STRUCT.unpack(data)
+                if cmd == CMD_SET_FREQ:
+                    source.center_freq = param
+                elif cmd == CMD_SET_SAMPLE_RATE:
+                    source.sample_rate = param
+                elif cmd == CMD_SET_GAIN:
+                    source.gain = param / 10.
+                elif cmd == CMD_SET_FREQ_CORRECTION:
+                    if param & 0x80000000:
+                        param -= 1 << 32
+                    source.freq_correction = param
+                self.server.commands_received += 1
+        except (IOError, socket.error):
+            self.closed.set()
+
+class RtlTcpServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''Local rtl_tcp protocol server fed by a synthetic or recorded IQ source
+
+    Intended for measuring and testing remote capture on one machine.
+
+    params:
+        address: (hostname, port) tuple. Use port 0 to pick a free port
+        filename: raw uint8 IQ file to replay. If not given, samples are
+            generated by :class:`~wwb_scanner.scanner.simulated.SimulatedSdr`
+        signals: signal list passed to SimulatedSdr
+        realtime: pace output to the requested sample rate
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address=('127.0.0.1', 0), **kwargs):
+        SocketServer.TCPServer.__init__(self, address, RtlTcpRequestHandler)
+        self.filename = kwargs.get('filename')
+        self.signals = kwargs.get('signals')
+        self.realtime = kwargs.get('realtime', True)
+        self.block_samples = kwargs.get('block_samples', 16384)
+        self.stopping = threading.Event()
+        self.commands_received = 0
+        self.serve_thread = None
+    def build_source(self):
+        if self.filename is not None:
+            return FileIQSource(self.filename)
+        return SimulatedSdr(signals=self.signals)
+    def start(self):
+        self.serve_thread = threading.Thread(target=self.serve_forever)
+        self.serve_thread.daemon = True
+        self.serve_thread.start()
+        return self.server_address
+    def stop(self):
+        self.stopping.set()
+        self.shutdown()
+        self.server_close()
+
+def measure_throughput(client, duration=2., num_samples=65536):
+    '''Read from a client for ``duration`` seconds and report its performance
+    '''
+    latencies = []
+    total = 0
+    dropped = client.ring.dropped
+    start_ts = time.time()
+    while time.time() - start_ts < duration:
+        ts = time.time()
+        client.read_samples(num_samples)
+        latencies.append(time.time() - ts)
+        total += num_samples
+    elapsed = time.time() - start_ts
+    return dict(
+        samples_per_second=total / elapsed,
+        mean_read_latency=sum(latencies) / len(latencies),
+        max_read_latency=max(latencies),
+        dropped_bytes=client.ring.dropped - dropped,
+        reconnects=client.reconnect_count,
+    )
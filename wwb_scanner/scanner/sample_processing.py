@@ -1,12 +1,37 @@
 import time
+import logging
 import threading
+import collections
 import numpy as np
-from scipy.signal.windows import __all__ as WINDOW_TYPES
-from scipy.signal import welch, get_window
 
 from wwb_scanner.core import JSONMixin
 
-WINDOW_TYPES = [s for s in WINDOW_TYPES if s != 'get_window']
+class WindowTypes(collections.Sequence):
+    '''Names of the window functions in :mod:`scipy.signal.windows`
+
+    scipy is only imported when the list is first used.
+    '''
+    _names = None
+    def get_names(self):
+        names = self._names
+        if names is None:
+            from scipy.signal.windows import __all__ as names
+            names = self._names = [s for s in names if s != 'get_window']
+        return names
+    def __getitem__(self, i):
+        return self.get_names()[i]
+    def __len__(self):
+        return len(self.get_names())
+    def __add__(self, other):
+        return self.get_names() + list(other)
+    def __repr__(self):
+        return repr(self.get_names())
+
+WINDOW_TYPES = WindowTypes()
+
+DEFAULT_NPERSEG = 256
+
+logger = logging.getLogger(__name__)
 
 def next_2_to_pow(val):
     val -= 1
@@ -31,14 +56,55 @@ def sort_psd(f, Pxx, onesided=False):
         Pxx *= 2
     return f, Pxx
 
+def translate_freq(samples, freq, rs):
+    # Adapted from https://github.com/vsergeev/luaradio/blob/master/radio/blocks/signal/frequencytranslator.lua
+    omega = 2 * np.pi * (freq / rs)
+    phase_rot = np.mod(np.arange(samples.shape[-1]) * omega, 2 * np.pi)
+    xlator = np.zeros(phase_rot.size, dtype=samples.dtype)
+    xlator.real = np.cos(phase_rot)
+    xlator.imag = np.sin(phase_rot)
+    samples *= xlator
+    return samples
+
+def calc_psd(samples, center_frequency, sample_rate, nperseg=DEFAULT_NPERSEG,
+             window='hann', overlap_ratio=0.):
+    '''Estimate the power spectral density of one tile of raw samples
+
+    Returns a tuple of ``(frequencies, powers)`` with frequencies in MHz.
+    The outer ``overlap_ratio`` of the band is cropped.
+    '''
+    from scipy.signal import welch, get_window
+    rs = sample_rate
+    fc = center_frequency
+    samples = np.array(samples, dtype='complex').flatten()
+    samples = translate_freq(samples, fc * -1, rs)
+    win = get_window(window, nperseg)
+    f, powers = welch(samples, fs=rs,
+                      window=win, nperseg=nperseg, scaling='density')
+
+    iPxx = np.fft.ifft(powers)
+    iPxx = translate_freq(iPxx, fc, rs)
+    powers = np.fft.fft(iPxx)
+
+    f, powers = sort_psd(f, powers)
+    crop = int((f.size * overlap_ratio) / 2)
+    if crop:
+        f, powers = f[crop:crop*-1], powers[crop:crop*-1]
+    f += fc
+    f /= 1e6
+    return f, powers
+
 class SampleSet(JSONMixin):
     __slots__ = ('scanner', 'center_frequency', 'raw', 'current_sweep',
-                 '_frequencies', 'powers', 'collection', 'process_thread')
+                 '_frequencies', 'powers', 'collection', 'process_thread',
+                 '_sweeps_per_scan', '_nperseg', '_window', '_wait_start')
     def __init__(self, **kwargs):
         for key in self.__slots__:
-            if key == '_frequencies':
-                key = 'frequencies'
-            setattr(self, key, kwargs.get(key))
+            val = kwargs.get(key)
+            if key.startswith('_'):
+                key = key.lstrip('_')
+                val = kwargs.get(key, val)
+            setattr(self, key, val)
         if self.scanner is None and self.collection is not None:
             self.scanner = self.collection.scanner
     @property
@@ -52,34 +118,75 @@ class SampleSet(JSONMixin):
         self._frequencies = value
     @property
     def sweeps_per_scan(self):
-        return self.scanner.sweeps_per_scan
+        v = self._sweeps_per_scan
+        if v is None:
+            v = self.scanner.sweeps_per_scan
+        return v
+    @sweeps_per_scan.setter
+    def sweeps_per_scan(self, value):
+        self._sweeps_per_scan = value
     @property
     def samples_per_sweep(self):
         return self.scanner.samples_per_sweep
+    @property
+    def nperseg(self):
+        v = self._nperseg
+        if v is None:
+            v = DEFAULT_NPERSEG
+        return v
+    @nperseg.setter
+    def nperseg(self, value):
+        self._nperseg = value
+    @property
+    def window(self):
+        v = self._window
+        if v is None:
+            v = 'hann'
+        return v
+    @window.setter
+    def window(self, value):
+        self._window = value
+    @property
+    def resolution(self):
+        return self.scanner.sample_rate / self.nperseg / 1e6
     def read_samples(self):
         scanner = self.scanner
         freq = self.center_frequency
-        sweeps_per_scan = scanner.sweeps_per_scan
+        sweeps_per_scan = self.sweeps_per_scan
         samples_per_sweep = scanner.samples_per_sweep
         sdr = scanner.sdr
-        sdr.set_center_freq(freq)
+        with scanner.metrics.timer('retune', freq):
+            sdr.set_center_freq(freq)
         self.raw = np.zeros((sweeps_per_scan, samples_per_sweep), 'complex')
         self.powers = np.zeros((sweeps_per_scan, samples_per_sweep), 'float64')
+        self._wait_start = time.time()
         sdr.read_samples_async(self.samples_callback, num_samples=samples_per_sweep)
     def samples_callback(self, iq, context):
+        metrics = self.scanner.metrics
+        freq = self.center_frequency
+        now = time.time()
+        if self._wait_start is not None:
+            metrics.add_timing('capture_wait', now - self._wait_start, freq)
         current_sweep = getattr(self, 'current_sweep', None)
         if current_sweep is None:
             current_sweep = self.current_sweep = 0
         if current_sweep >= self.raw.shape[0]:
+            if current_sweep > self.raw.shape[0]:
+                metrics.increment('dropped_sweeps')
+            self.current_sweep += 1
+            self._wait_start = None
             self.on_sample_read_complete()
             return
         try:
             self.raw[current_sweep] = iq
+            metrics.add_timing('callback_copy', time.time() - now, freq)
+            metrics.increment('sweeps')
             self.process_sweep(current_sweep)
         except:
             self.on_sample_read_complete()
             raise
         self.current_sweep += 1
+        self._wait_start = time.time()
         if current_sweep > self.raw.shape[0]:
             self.on_sample_read_complete()
     def on_sample_read_complete(self):
@@ -90,9 +197,11 @@ class SampleSet(JSONMixin):
     def launch_process_thread(self):
         self.process_thread = ProcessThread(self)
     def process_sweep(self, sweep):
+        from scipy.signal import welch
         scanner = self.scanner
         freq = self.center_frequency
-        f, powers = welch(self.raw[sweep], fs=scanner.sample_rate)
+        with scanner.metrics.timer('sweep_psd', freq):
+            f, powers = welch(self.raw[sweep], fs=scanner.sample_rate)
         f += freq
         f /= 1e6
         powers = 10. * np.log10(powers)
@@ -100,67 +209,41 @@ class SampleSet(JSONMixin):
                                            powers=powers,
                                            frequencies=f)
     def translate_freq(self, samples, freq):
-        # Adapted from https://github.com/vsergeev/luaradio/blob/master/radio/blocks/signal/frequencytranslator.lua
-        rs = self.scanner.sample_rate
-        omega = 2 * np.pi * (freq / rs)
-        def iter_phase():
-            p = 0
-            i = 0
-            while i < samples.shape[-1]:
-                yield p
-                p += omega
-                p -= 2 * np.pi
-                i += 1
-        phase_rot = np.fromiter(iter_phase(), dtype=np.float)
-        phase_rot = np.unwrap(phase_rot)
-        xlator = np.zeros(phase_rot.size, dtype=samples.dtype)
-        xlator.real = np.cos(phase_rot)
-        xlator.imag = np.sin(phase_rot)
-        samples *= xlator
-        return samples
+        return translate_freq(samples, freq, self.scanner.sample_rate)
     def process_samples(self):
-        rs = self.scanner.sample_rate
-        fc = self.center_frequency
-        samples = self.raw.flatten()
-        samples = self.translate_freq(samples, fc * -1)
-        overlap_ratio = self.scanner.sampling_config.sweep_overlap_ratio
-        nperseg = 256
-        win = get_window('hann', nperseg)
-        f, powers = welch(samples, fs=rs,
-                          window=win, nperseg=nperseg, scaling='density')
-
-        iPxx = np.fft.ifft(powers)
-        iPxx = self.translate_freq(iPxx, fc)
-        powers = np.fft.fft(iPxx)
-
-        f, powers = sort_psd(f, powers)
-        crop = int((f.size * overlap_ratio) / 2)
-        f, powers = f[crop:crop*-1], powers[crop:crop*-1]
-        f += fc
-        f /= 1e6
+        scanner = self.scanner
+        with scanner.metrics.timer('psd', self.center_frequency):
+            f, powers = calc_psd(
+                self.raw, self.center_frequency, scanner.sample_rate,
+                nperseg=self.nperseg,
+                window=self.window,
+                overlap_ratio=scanner.sampling_config.sweep_overlap_ratio,
+            )
         self.powers = powers
         if not np.array_equal(f, self.frequencies):
-            print 'freq not equal: %s, %s' % (self.frequencies.size, f.size)
+            logger.debug('freq not equal: %s, %s', self.frequencies.size, f.size)
             self.frequencies = f
         self.collection.on_sample_set_processed(self)
     def calc_expected_freqs(self):
+        from scipy.signal import welch
         freq = self.center_frequency
         scanner = self.scanner
         rs = scanner.sample_rate
-        num_samples = scanner.samples_per_sweep * scanner.sweeps_per_scan
+        num_samples = scanner.samples_per_sweep * self.sweeps_per_scan
         overlap_ratio = scanner.sampling_config.sweep_overlap_ratio
         fake_samples = np.zeros(num_samples, 'complex')
-        f_expected, Pxx = welch(fake_samples, fs=rs, nperseg=256)
+        f_expected, Pxx = welch(fake_samples, fs=rs, nperseg=self.nperseg)
         f_expected, Pxx = sort_psd(f_expected, Pxx)
         crop = int((f_expected.size * overlap_ratio) / 2)
-        f_expected, Pxx = f_expected[crop:crop*-1], Pxx[crop:crop*-1]
+        if crop:
+            f_expected, Pxx = f_expected[crop:crop*-1], Pxx[crop:crop*-1]
         f_expected += freq
         f_expected /= 1e6
         return f_expected
     def _serialize(self):
         d = {}
         for key in self.__slots__:
-            if key in ['scanner', 'collection']:
+            if key in ['scanner', 'collection', 'raw', 'process_thread', '_wait_start']:
                 continue
             val = getattr(self, key)
             d[key] = val
@@ -175,8 +258,9 @@ class SampleCollection(JSONMixin):
         self.sample_sets = {}
     def add_sample_set(self, sample_set):
         self.sample_sets[sample_set.center_frequency] = sample_set
-    def build_sample_set(self, freq):
-        sample_set = SampleSet(collection=self, center_frequency=freq)
+    def build_sample_set(self, freq, **kwargs):
+        kwargs.update(collection=self, center_frequency=freq)
+        sample_set = SampleSet(**kwargs)
         self.add_sample_set(sample_set)
         return sample_set
     def scan_freq(self, freq):
@@ -187,11 +271,16 @@ class SampleCollection(JSONMixin):
         sample_set.read_samples()
         return sample_set
     def scan_all_freqs(self):
+        sample_sets = self.sample_sets
+        self.scan_sample_sets(sample_sets[key] for key in sorted(sample_sets.keys()))
+    def scan_sample_sets(self, sample_sets):
+        completed = getattr(self.scanner, 'completed_frequencies', None)
         self.scanning.set()
-        for key in sorted(self.sample_sets.keys()):
+        for sample_set in sample_sets:
             if not self.scanning.is_set():
                 break
-            sample_set = self.sample_sets[key]
+            if completed and sample_set.center_frequency in completed:
+                continue
             sample_set.read_samples()
         self.scanning.clear()
         self.stopped.set()
@@ -0,0 +1,121 @@
+import time
+
+from wwb_scanner.scanner.refine import (
+    merge_regions,
+    subtract_regions,
+    iter_region_centers,
+)
+
+class ScheduleEntry(object):
+    __slots__ = ('frequency', 'priority', 'revisit_interval', 'last_scanned',
+                 'cycle')
+    def __init__(self, **kwargs):
+        self.frequency = kwargs.get('frequency')
+        self.priority = kwargs.get('priority', 0)
+        self.revisit_interval = kwargs.get('revisit_interval')
+        self.last_scanned = None
+        self.cycle = -1
+    def is_due(self, now, cycle):
+        if self.cycle < cycle:
+            return True
+        if self.revisit_interval is None:
+            return False
+        return now - self.last_scanned >= self.revisit_interval
+    def __repr__(self):
+        return '<ScheduleEntry %s MHz (priority=%s)>' % (self.frequency, self.priority)
+
+class ScanSchedule(object):
+    '''Orders center frequencies over several ranges by priority
+
+    params:
+        scan_ranges: list of ranges to scan. Each item may be a
+            ``[start, end]`` pair (in MHz) or a dict with ``start``,
+            ``end``, ``priority`` and ``revisit_interval`` (in seconds)
+        excluded_ranges: list of ``[start, end]`` pairs (in MHz) to skip
+        step_size: bandwidth (in MHz) covered by each center frequency
+    '''
+    def __init__(self, **kwargs):
+        self.step_size = kwargs.get('step_size')
+        self.scan_ranges = [self._parse_range(r) for r in kwargs.get('scan_ranges', [])]
+        self.excluded_ranges = [list(r) for r in kwargs.get('excluded_ranges') or []]
+        self.cycle = -1
+        self.entries = self.build_entries()
+    @classmethod
+    def from_config(cls, config, step_size):
+        return cls(
+            scan_ranges=config.get('scan_ranges') or [config.scan_range],
+            excluded_ranges=config.get('excluded_ranges'),
+            step_size=step_size,
+        )
+    @staticmethod
+    def _parse_range(scan_range):
+        if isinstance(scan_range, dict):
+            d = dict(scan_range)
+        else:
+            start, end = scan_range
+            d = dict(start=start, end=end)
+        d.setdefault('priority', 0)
+        d.setdefault('revisit_interval', None)
+        return d
+    @property
+    def frequencies(self):
+        return sorted(e.frequency for e in self.entries)
+    @property
+    def bounds(self):
+        f = self.frequencies
+        if not len(f):
+            return None
+        half_step = self.step_size / 2.
+        return [f[0] - half_step, f[-1] + half_step]
+    def build_entries(self):
+        covered = []
+        entries = []
+        seen = set()
+        scan_ranges = sorted(self.scan_ranges, key=lambda r: -r['priority'])
+        for scan_range in scan_ranges:
+            regions = [[scan_range['start'], scan_range['end']]]
+            regions = subtract_regions(regions, self.excluded_ranges + covered)
+            covered = merge_regions(covered + regions)
+            for region in regions:
+                for freq in iter_region_centers(region, self.step_size):
+                    key = int(round(freq * 1e6))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    entries.append(ScheduleEntry(
+                        frequency=freq,
+                        priority=scan_range['priority'],
+                        revisit_interval=scan_range['revisit_interval'],
+                    ))
+        return entries
+    def next_entry(self, now=None, allow_revisit=True):
+        if now is None:
+            now = time.time()
+        cycle = self.cycle
+        if not any(e.cycle < cycle for e in self.entries):
+            return None
+        if allow_revisit:
+            due = [e for e in self.entries if e.is_due(now, cycle)]
+        else:
+            due = [e for e in self.entries if e.cycle < cycle]
+        def sort_key(e):
+            return (-e.priority, e.cycle, e.last_scanned or 0, e.frequency)
+        return min(due, key=sort_key)
+    def iter_cycle(self):
+        '''Yield center frequencies (in MHz) until every entry has been scanned
+
+        Entries with a ``revisit_interval`` are interleaved again whenever
+        their interval has elapsed, ahead of lower priority entries. A revisit
+        is always followed by an entry not yet scanned in the cycle so the
+        cycle is guaranteed to finish.
+        '''
+        self.cycle += 1
+        allow_revisit = True
+        while True:
+            entry = self.next_entry(allow_revisit=allow_revisit)
+            if entry is None:
+                break
+            allow_revisit = entry.cycle < self.cycle
+            entry.cycle = self.cycle
+            entry.last_scanned = time.time()
+            yield entry.frequency
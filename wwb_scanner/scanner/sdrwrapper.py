@@ -1,11 +1,11 @@
+import logging
 import threading
-import traceback
 
-from rtlsdr import RtlSdr
-try:
-    from rtlsdr import RtlSdrTcpClient
-except ImportError:
-    RtlSdrTcpClient = None
+from wwb_scanner.scanner.simulated import SimulatedSdr
+from wwb_scanner.scanner.rtltcp import RtlTcpClient
+from wwb_scanner.scanner.session import DeviceSession, capability_cache
+
+logger = logging.getLogger(__name__)
 
 class SdrWrapper(object):
     def __init__(self, **kwargs):
@@ -15,6 +15,7 @@ class SdrWrapper(object):
         self.device_open = threading.Event()
         self.device_wait = threading.Event()
         self.device_lock = threading.RLock()
+        self.session = None
     def set_sdr_values(self):
         if not self.enable_scanner_updates:
             return
@@ -44,43 +45,69 @@ class SdrWrapper(object):
                 setattr(scanner, key, sdr_val)
     def open_sdr(self):
         with self.device_lock:
-            if self.sdr is not None:
-                if not self.sdr.device_opened:
-                    self.sdr.close()
-                    self.sdr = None
-                    self.device_open.clear()
-                else:
-                    self.device_open.wait()
-            if self.sdr is None:
-                if self.scanner.device_config.is_remote:
-                    self.sdr = self._open_sdr_remote()
-                else:
-                    self.sdr = self._open_sdr_local()
+            if self.session is None:
+                device_config = self.scanner.device_config
+                self.session = DeviceSession.get_session(device_config)
+                self.sdr = self.session.acquire(self._open_sdr)
                 if self.sdr is not None:
                     self.set_sdr_values()
                     self.device_open.set()
         return self.sdr
+    def _open_sdr(self):
+        device_config = self.scanner.device_config
+        if device_config.is_remote:
+            sdr = self._open_sdr_remote()
+        elif device_config.get('is_simulated'):
+            sdr = self._open_sdr_simulated()
+        else:
+            sdr = self._open_sdr_local()
+        if sdr is not None:
+            capability_cache.update_from_sdr(device_config, sdr)
+        return sdr
     def _open_sdr_local(self):
+        device_config = self.scanner.device_config
+        serial_number = device_config.get('serial_number')
+        from rtlsdr import RtlSdr
         try:
-            sdr = RtlSdr()
+            if serial_number is not None:
+                device_index = RtlSdr.get_device_index_by_serial(serial_number)
+            else:
+                device_index = device_config.get('device_index', 0)
+            sdr = RtlSdr(device_index)
         except IOError:
             sdr = None
         return sdr
+    def _open_sdr_simulated(self):
+        device_config = self.scanner.device_config
+        return SimulatedSdr(
+            signals=device_config.get('simulated_signals'),
+            realtime=device_config.get('simulated_realtime', False),
+            serial_number=device_config.get('serial_number') or '00000001',
+        )
     def _open_sdr_remote(self):
+        device_config = self.scanner.device_config
         try:
-            if RtlSdrTcpClient is None:
-                raise Exception('Tcp client not available')
-            sdr = RtlSdrTcpClient(hostname=self.scanner.device_config.remote_hostname,
-                                  port=self.scanner.device_config.remote_port)
+            if device_config.get('remote_backend', 'rtl_tcp') == 'rtl_tcp':
+                sdr = RtlTcpClient(hostname=device_config.remote_hostname,
+                                   port=device_config.remote_port)
+            else:
+                try:
+                    from rtlsdr import RtlSdrTcpClient
+                except ImportError:
+                    raise Exception('Tcp client not available')
+                sdr = RtlSdrTcpClient(hostname=device_config.remote_hostname,
+                                      port=device_config.remote_port)
             sdr.get_sample_rate()
         except:
-            traceback.print_exc()
+            logger.exception('Could not connect to remote device')
             sdr = None
         return sdr
     def close_sdr(self):
         with self.device_lock:
-            if self.sdr is not None:
-                self.sdr.close()
+            if self.session is not None:
+                if self.sdr is not None:
+                    self.session.release()
+                self.session = None
                 self.sdr = None
                 self.device_open.clear()
     def __enter__(self):
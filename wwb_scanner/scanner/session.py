@@ -0,0 +1,163 @@
+import atexit
+import threading
+
+from wwb_scanner.utils.dbstore import db_store
+from wwb_scanner.scanner.plan import SAMPLE_RATES, get_actual_sample_rate
+
+def get_device_key(device_config):
+    if device_config.get('is_remote'):
+        return 'remote:%s:%s' % (device_config.get('remote_hostname'),
+                                 device_config.get('remote_port'))
+    if device_config.get('is_simulated'):
+        return 'simulated:%s' % (device_config.get('serial_number') or '00000001')
+    if device_config.get('serial_number') is not None:
+        return 'serial:%s' % (device_config.get('serial_number'))
+    return 'index:%s' % (device_config.get('device_index', 0))
+
+class DeviceSession(object):
+    '''Keeps a device open across scans
+
+    Sessions are shared per device (see :func:`get_device_key`) and
+    reference counted. When the last user releases a session the device
+    stays open for ``idle_timeout`` seconds before it is closed, so repeated
+    scans don't reopen the device every pass.
+    '''
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+    def __init__(self, **kwargs):
+        self.device_key = kwargs.get('device_key')
+        self.idle_timeout = kwargs.get('idle_timeout', 30.)
+        self.sdr = None
+        self.ref_count = 0
+        self.lock = threading.RLock()
+        self.idle_timer = None
+    @classmethod
+    def get_session(cls, device_config):
+        key = get_device_key(device_config)
+        with cls._sessions_lock:
+            session = cls._sessions.get(key)
+            if session is None:
+                session = cls._sessions[key] = cls(device_key=key)
+        session.idle_timeout = device_config.get('session_idle_timeout', 30.)
+        return session
+    @classmethod
+    def close_all(cls):
+        with cls._sessions_lock:
+            sessions = list(cls._sessions.values())
+        timers = [s.idle_timer for s in sessions if s.idle_timer is not None]
+        for session in sessions:
+            session.close()
+        # Let cancelled timers finish before the interpreter shuts down
+        for t in timers:
+            t.join(1.)
+    def acquire(self, opener):
+        with self.lock:
+            self._cancel_idle_timer()
+            if self.sdr is not None and not getattr(self.sdr, 'device_opened', True):
+                self._close_sdr()
+            if self.sdr is None:
+                self.sdr = opener()
+                if self.sdr is None:
+                    return None
+            self.ref_count += 1
+            return self.sdr
+    def release(self):
+        with self.lock:
+            if self.ref_count == 0:
+                return
+            self.ref_count -= 1
+            if self.ref_count > 0 or self.sdr is None:
+                return
+            if not self.idle_timeout:
+                self._close_sdr()
+                return
+            t = self.idle_timer = threading.Timer(self.idle_timeout, self.on_idle_timeout)
+            t.daemon = True
+            t.start()
+    def on_idle_timeout(self):
+        with self.lock:
+            if self.ref_count > 0:
+                return
+            self.idle_timer = None
+            self._close_sdr()
+    def close(self):
+        with self.lock:
+            self._cancel_idle_timer()
+            self.ref_count = 0
+            self._close_sdr()
+    def _cancel_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+    def _close_sdr(self):
+        if self.sdr is not None:
+            self.sdr.close()
+            self.sdr = None
+
+atexit.register(DeviceSession.close_all)
+
+class CapabilityCache(object):
+    '''Persisted per-device capabilities, keyed by serial number
+
+    Lets a :class:`~wwb_scanner.scanner.main.Scanner` know the supported
+    gains and sample rates of a device without opening it. Lookups
+    (including misses) are cached until the stored capabilities change.
+    '''
+    def __init__(self):
+        self._cache = {}
+    def get(self, device_config):
+        return self._lookup(device_config.get('serial_number'),
+                            get_device_key(device_config))
+    def _lookup(self, serial, device_key):
+        key = (serial, device_key)
+        if key in self._cache:
+            return self._cache[key]
+        data = self._cache[key] = db_store.get_device_capabilities(
+            serial=serial, device_key=device_key)
+        return data
+    def update_from_sdr(self, device_config, sdr):
+        data = dict(
+            device_key=get_device_key(device_config),
+            serial=self.get_serial(device_config, sdr),
+            tuner_type=self.get_tuner_type(sdr),
+            gains=self.get_gains(sdr),
+            sample_rates=[get_actual_sample_rate(r) for r in SAMPLE_RATES],
+        )
+        existing = self._lookup(data['serial'], data['device_key'])
+        if existing is not None and all(existing.get(k) == v for k, v in data.items()):
+            return data
+        db_store.set_device_capabilities(data)
+        self._cache.clear()
+        return data
+    def get_serial(self, device_config, sdr):
+        serial = device_config.get('serial_number')
+        if serial is not None:
+            return serial
+        serial = getattr(sdr, 'serial_number', None)
+        if serial is not None:
+            return serial
+        if device_config.get('is_remote'):
+            return None
+        try:
+            serials = sdr.get_device_serial_addresses()
+            return serials[device_config.get('device_index', 0)]
+        except Exception:
+            return None
+    def get_tuner_type(self, sdr):
+        tuner_type = getattr(sdr, 'tuner_type', None)
+        if tuner_type is not None:
+            return tuner_type
+        try:
+            return sdr.get_tuner_type()
+        except Exception:
+            return None
+    def get_gains(self, sdr):
+        try:
+            gains = sdr.get_gains()
+        except Exception:
+            return None
+        if gains is None:
+            return None
+        return [gain / 10. for gain in gains]
+
+capability_cache = CapabilityCache()
@@ -0,0 +1,278 @@
+import os
+import mmap
+import time
+import struct
+
+import numpy as np
+
+from wwb_scanner.utils.dbstore import APP_PATH
+from wwb_scanner.scanner.events import thread_scheduler
+
+if os.path.isdir('/dev/shm'):
+    SHM_PATH = '/dev/shm'
+else:
+    SHM_PATH = os.path.join(APP_PATH, 'shm')
+
+SHM_MAGIC = b'WWBSHM01'
+SHM_VERSION = 1
+
+# magic, version, capacity, sequence, timestamp, scan_range start/end (MHz),
+# num_points
+HEADER_STRUCT = struct.Struct('<8sIIQdddI4x')
+SEQUENCE_OFFSET = 16
+DEFAULT_CAPACITY = 65536
+
+def get_shm_filename(name, path=None):
+    if path is None:
+        path = SHM_PATH
+    return os.path.join(path, 'wwb_scanner_%s.spectrum' % (name))
+
+def calc_region_size(capacity):
+    # frequencies (float64), current and max hold (float32)
+    return HEADER_STRUCT.size + capacity * (8 + 4 + 4)
+
+class SharedSpectrum(object):
+    '''Data read from a :class:`SharedSpectrumReader`
+    '''
+    __slots__ = ('sequence', 'timestamp', 'scan_range', 'frequencies',
+                 'dbFS', 'max_hold')
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, kwargs.get(key))
+    def __len__(self):
+        return len(self.frequencies)
+
+class SharedSpectrumRegion(object):
+    '''Memory mapped file holding a spectrum and its max hold
+
+    Layout: a :data:`HEADER_STRUCT` header followed by ``capacity``
+    frequencies (float64, MHz), current values and max hold values
+    (float32, dBFS). Only the first ``num_points`` of each are valid.
+
+    Writes are guarded with a seqlock: the writer makes the sequence odd
+    before changing the data and even again afterwards. Readers retry if
+    the sequence was odd or changed while they copied.
+    '''
+    def __init__(self, filename, mode='r'):
+        self.filename = filename
+        self.mode = mode
+        self.fd = None
+        self.mm = None
+        self.capacity = 0
+    def open(self, capacity=None):
+        self.close()
+        if self.mode == 'w':
+            flags = os.O_RDWR | os.O_CREAT
+            self.fd = os.open(self.filename, flags, 0o644)
+            size = calc_region_size(capacity)
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+            access = mmap.ACCESS_WRITE
+        else:
+            self.fd = os.open(self.filename, os.O_RDONLY)
+            size = os.fstat(self.fd).st_size
+            access = mmap.ACCESS_READ
+        self.mm = mmap.mmap(self.fd, size, access=access)
+        self.sequence_view = np.frombuffer(self.mm, np.uint64, 1, SEQUENCE_OFFSET)
+        if self.mode == 'w':
+            # Keep the sequence of an existing region so readers holding
+            # an older sequence see the change
+            self.capacity = capacity
+            HEADER_STRUCT.pack_into(self.mm, 0, SHM_MAGIC, SHM_VERSION, capacity,
+                                    self.sequence, 0., 0., 0., 0)
+        else:
+            self.capacity = self.read_header()[2]
+        self.build_views()
+    def build_views(self):
+        capacity = self.capacity
+        offset = HEADER_STRUCT.size
+        self.frequencies = np.frombuffer(self.mm, np.float64, capacity, offset)
+        offset += capacity * 8
+        self.dbFS = np.frombuffer(self.mm, np.float32, capacity, offset)
+        offset += capacity * 4
+        self.max_hold = np.frombuffer(self.mm, np.float32, capacity, offset)
+    @property
+    def sequence(self):
+        if self.mm is None:
+            return 0
+        return int(self.sequence_view[0])
+    def read_header(self):
+        values = HEADER_STRUCT.unpack_from(self.mm, 0)
+        if values[0] != SHM_MAGIC:
+            raise IOError('%s is not a shared spectrum region' % (self.filename))
+        return values
+    def close(self):
+        if self.mm is not None:
+            self.frequencies = self.dbFS = self.max_hold = None
+            self.sequence_view = None
+            try:
+                self.mm.close()
+            except BufferError:
+                # Views handed out to callers are still alive; let the
+                # mapping be released with them
+                pass
+            self.mm = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class SharedSpectrumPublisher(object):
+    '''Publishes the live spectrum of a scanner to a shared memory region
+
+    Other processes can map the region with :class:`SharedSpectrumReader`
+    and poll it at their own rate.
+
+    params:
+        name: region name. The file is created in :data:`SHM_PATH`
+        path: directory for the region file (overrides :data:`SHM_PATH`)
+        capacity: initial number of points. The region is grown when a
+            larger spectrum is published
+    '''
+    def __init__(self, **kwargs):
+        self.name = kwargs.get('name', 'default')
+        path = kwargs.get('path')
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+        elif path is None and not os.path.exists(SHM_PATH):
+            os.makedirs(SHM_PATH)
+        self.filename = get_shm_filename(self.name, path)
+        self.region = SharedSpectrumRegion(self.filename, 'w')
+        self.region.open(kwargs.get('capacity', DEFAULT_CAPACITY))
+        if self.region.sequence & 1:
+            # Left mid-write by a previous publisher
+            self.region.sequence_view[0] += 1
+        self.scanner = None
+        self.version = None
+        self.hold_frequencies = None
+        self.hold_values = None
+    def attach(self, scanner):
+        '''Publish snapshots of ``scanner`` as its sample sets are processed
+        '''
+        self.scanner = scanner
+        events = scanner.events
+        if events.scheduler is None:
+            events.scheduler = thread_scheduler
+        events.subscribe('sample_set_processed', self.on_scanner_update)
+        events.subscribe('scan_complete', self.on_scanner_update)
+    def detach(self):
+        if self.scanner is None:
+            return
+        events = self.scanner.events
+        events.unsubscribe('sample_set_processed', self.on_scanner_update)
+        events.unsubscribe('scan_complete', self.on_scanner_update)
+        self.scanner = None
+    def on_scanner_update(self, **kwargs):
+        scanner = self.scanner
+        if scanner is None:
+            return
+        snapshot = scanner.spectrum.get_snapshot()
+        if snapshot.version == self.version:
+            return
+        self.version = snapshot.version
+        self.publish(snapshot.frequencies, snapshot.dbFS, scanner.config.scan_range)
+    def update_max_hold(self, frequencies, dbFS):
+        max_hold = np.array(dbFS, dtype=np.float32)
+        prev_freqs = self.hold_frequencies
+        if prev_freqs is not None and len(prev_freqs):
+            if np.array_equal(prev_freqs, frequencies):
+                np.maximum(max_hold, self.hold_values, out=max_hold)
+            else:
+                idx = np.searchsorted(prev_freqs, frequencies)
+                idx = np.clip(idx, 0, prev_freqs.size - 1)
+                matched = prev_freqs[idx] == frequencies
+                max_hold[matched] = np.maximum(max_hold[matched], self.hold_values[idx[matched]])
+        self.hold_frequencies = np.array(frequencies)
+        self.hold_values = max_hold
+        return max_hold
+    def publish(self, frequencies, dbFS, scan_range=None):
+        region = self.region
+        n = len(frequencies)
+        max_hold = self.update_max_hold(frequencies, dbFS)
+        if scan_range is None:
+            scan_range = [frequencies[0], frequencies[-1]] if n else [0., 0.]
+        seq = region.sequence
+        region.sequence_view[0] = seq + 1
+        if n > region.capacity:
+            region.open(max(n, region.capacity * 2))
+        region.frequencies[:n] = frequencies
+        region.dbFS[:n] = dbFS
+        region.max_hold[:n] = max_hold
+        HEADER_STRUCT.pack_into(region.mm, 0, SHM_MAGIC, SHM_VERSION, region.capacity,
+                                seq + 1, time.time(), scan_range[0], scan_range[1], n)
+        region.sequence_view[0] = seq + 2
+    def close(self, remove=True):
+        self.detach()
+        self.region.close()
+        if remove and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+class SharedSpectrumReader(object):
+    '''Reads spectra published by :class:`SharedSpectrumPublisher`
+
+    params:
+        name: region name used by the publisher
+        path: directory of the region file (overrides :data:`SHM_PATH`)
+    '''
+    def __init__(self, **kwargs):
+        self.filename = get_shm_filename(kwargs.get('name', 'default'), kwargs.get('path'))
+        self.region = SharedSpectrumRegion(self.filename, 'r')
+        self.region.open()
+        self.last_sequence = None
+    @property
+    def sequence(self):
+        return self.region.sequence
+    def read(self, copy=True, timeout=1.):
+        '''Read the current spectrum
+
+        With ``copy=False`` the arrays are views into the shared region and
+        are only valid while :meth:`is_current` returns True for the
+        returned sequence.
+
+        Returns None if nothing has been published, and raises
+        :class:`IOError` if no consistent read was possible within
+        ``timeout`` seconds.
+        '''
+        region = self.region
+        end_ts = time.time() + timeout
+        while True:
+            seq1 = region.sequence
+            if not seq1 & 1:
+                values = region.read_header()
+                capacity, num_points = values[2], values[7]
+                if capacity != region.capacity:
+                    region.open()
+                    continue
+                if seq1 == 0:
+                    return None
+                freqs = region.frequencies[:num_points]
+                dbFS = region.dbFS[:num_points]
+                max_hold = region.max_hold[:num_points]
+                if copy:
+                    freqs, dbFS, max_hold = freqs.copy(), dbFS.copy(), max_hold.copy()
+                if region.sequence == seq1:
+                    self.last_sequence = seq1
+                    return SharedSpectrum(
+                        sequence=seq1,
+                        timestamp=values[4],
+                        scan_range=[values[5], values[6]],
+                        frequencies=freqs,
+                        dbFS=dbFS,
+                        max_hold=max_hold,
+                    )
+            if time.time() > end_ts:
+                raise IOError('Timed out reading %s' % (self.filename))
+            time.sleep(.0005)
+    def is_current(self, sequence):
+        return self.region.sequence == sequence
+    def has_update(self):
+        seq = self.region.sequence
+        return seq != 0 and not seq & 1 and seq != self.last_sequence
+    def wait_for_update(self, timeout=None, poll_interval=.01):
+        end_ts = None if timeout is None else time.time() + timeout
+        while not self.has_update():
+            if end_ts is not None and time.time() > end_ts:
+                return None
+            time.sleep(poll_interval)
+        return self.read()
+    def close(self):
+        self.region.close()
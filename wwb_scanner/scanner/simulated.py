@@ -0,0 +1,92 @@
+import time
+import threading
+
+import numpy as np
+
+from wwb_scanner.scanner.plan import get_actual_sample_rate
+
+R820T_GAINS = [0, 9, 14, 27, 37, 77, 87, 125, 144, 157, 166, 197, 207, 229,
+               254, 280, 297, 328, 338, 364, 372, 386, 402, 421, 434, 439,
+               445, 480, 496]
+
+DEFAULT_SIGNALS = [
+    dict(frequency=479.65e6, level=-20.),
+    dict(frequency=514.2e6, level=-35.),
+    dict(frequency=584.475e6, level=-25.),
+    dict(frequency=657.3e6, level=-30.),
+]
+
+class SimulatedSdr(object):
+    '''Stand-in for :class:`rtlsdr.RtlSdr` producing synthetic IQ samples
+
+    Generates complex gaussian noise plus a set of CW carriers so scans can
+    be run without hardware.
+
+    params:
+        signals: list of dicts with ``frequency`` (in Hz) and ``level``
+            (in dBFS)
+        noise_floor: noise level (in dBFS)
+        realtime: if True, reads block for as long as the samples would
+            take to arrive from a real device
+        serial_number: reported device serial
+    '''
+    tuner_type = 'R820T'
+    def __init__(self, **kwargs):
+        self.signals = kwargs.get('signals') or DEFAULT_SIGNALS
+        self.noise_floor = kwargs.get('noise_floor', -60.)
+        self.realtime = kwargs.get('realtime', False)
+        self.serial_number = kwargs.get('serial_number', '00000001')
+        self._sample_rate = 2.048e6
+        self.center_freq = 100e6
+        self.gain = 0.
+        self.freq_correction = 0
+        self.device_opened = True
+        self.read_async_canceling = False
+        self._cancel = threading.Event()
+        self._phase = 0.
+        self._rng = np.random.RandomState(kwargs.get('seed'))
+    @property
+    def sample_rate(self):
+        return self._sample_rate
+    @sample_rate.setter
+    def sample_rate(self, value):
+        self._sample_rate = get_actual_sample_rate(value)
+    def get_sample_rate(self):
+        return self.sample_rate
+    def set_center_freq(self, freq):
+        self.center_freq = freq
+    def get_center_freq(self):
+        return self.center_freq
+    def get_gains(self):
+        return list(R820T_GAINS)
+    def generate_samples(self, num_samples):
+        rs = self.sample_rate
+        fc = self.center_freq
+        noise_amp = 10 ** (self.noise_floor / 20.) / np.sqrt(2)
+        rng = self._rng
+        samples = rng.normal(0, noise_amp, num_samples) + 1j * rng.normal(0, noise_amp, num_samples)
+        t = (np.arange(num_samples) + self._phase) / rs
+        for signal in self.signals:
+            offset = signal['frequency'] - fc
+            if abs(offset) >= rs / 2.:
+                continue
+            amp = 10 ** (signal['level'] / 20.)
+            samples += amp * np.exp(2j * np.pi * offset * t)
+        self._phase += num_samples
+        return samples
+    def read_samples(self, num_samples=1024):
+        if self.realtime:
+            time.sleep(num_samples / self.sample_rate)
+        return self.generate_samples(num_samples)
+    def read_samples_async(self, callback, num_samples=1024, context=None):
+        self._cancel.clear()
+        self.read_async_canceling = False
+        while not self._cancel.is_set():
+            callback(self.read_samples(num_samples), context)
+        self.read_async_canceling = False
+    def cancel_read_async(self):
+        self.read_async_canceling = True
+        self._cancel.set()
+    def close(self):
+        self.cancel_read_async()
+        self.device_opened = False
@@ -0,0 +1,162 @@
+import threading
+import Queue
+
+import numpy as np
+
+class StreamResult(object):
+    '''One item produced by a :class:`ScanStream`
+
+    Attributes:
+        kind: ``'sample_set'`` or ``'progress'``
+        center_frequency: center frequency of the sample set (in MHz)
+        frequencies: frequencies (in MHz) added by the sample set
+        powers: power (in dBFS) for each frequency
+        progress: scan progress (0 - 1)
+    '''
+    __slots__ = ('kind', 'center_frequency', 'frequencies', 'powers', 'progress')
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, kwargs.get(key))
+    def __repr__(self):
+        if self.kind == 'progress':
+            return '<StreamResult: progress=%s>' % (self.progress)
+        return '<StreamResult: %s MHz, %s bins>' % (
+            self.center_frequency, len(self.frequencies))
+
+class ScanStream(object):
+    '''Iterator over the results of a scan
+
+    Created by :meth:`ScannerBase.stream`. Each stream has its own bounded
+    queue: when a consumer falls behind, the scan thread waits for it
+    (progress results are dropped instead). The scan itself runs in a
+    background thread, started when a stream is first iterated. Streams
+    that were open when a scan started only receive that scan.
+
+    Consumers running in an event loop can read without blocking it by
+    calling :meth:`get` in an executor. Calling :meth:`close` (for instance
+    when the consuming task is cancelled) stops the scan once no other
+    streams are open.
+    '''
+    def __init__(self, **kwargs):
+        self.hub = kwargs.get('hub')
+        self.include_progress = kwargs.get('include_progress', True)
+        self.autostart = kwargs.get('autostart', True)
+        self.queue = Queue.Queue(kwargs.get('maxsize', 16))
+        self.closed = threading.Event()
+        self.finished = False
+        self.started = False
+    def put(self, item, block=True):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, block, .1)
+                return True
+            except Queue.Full:
+                if not block:
+                    return False
+        return False
+    def get(self, timeout=None):
+        '''Get the next result
+
+        Raises :class:`StopIteration` when the scan has finished or the
+        stream was closed.
+        '''
+        if self.finished or self.closed.is_set():
+            raise StopIteration()
+        if self.autostart and not self.started:
+            self.hub.start()
+        item = self.queue.get(True, timeout)
+        if item is None:
+            self.finished = True
+            # Don't let the scan thread wait on a queue nobody reads
+            self.closed.set()
+            self.hub.remove_stream(self)
+            raise StopIteration()
+        return item
+    def __iter__(self):
+        return self
+    def next(self):
+        return self.get()
+    __next__ = next
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.wake()
+        self.hub.remove_stream(self)
+    def wake(self):
+        # Put the end marker in the queue (without blocking) so a consumer
+        # waiting in get() returns
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except Queue.Empty:
+                    pass
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+class StreamHub(object):
+    '''Distributes scan results from a scanner to its :class:`ScanStream` s
+    '''
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.streams = []
+        self.lock = threading.Lock()
+        self.scan_thread = None
+    def add_stream(self, **kwargs):
+        kwargs['hub'] = self
+        stream = ScanStream(**kwargs)
+        with self.lock:
+            self.streams.append(stream)
+        return stream
+    def remove_stream(self, stream):
+        with self.lock:
+            if stream in self.streams:
+                self.streams.remove(stream)
+            stop = not len(self.streams)
+        if stop and self.scanner._running.is_set():
+            self.scanner.stop_scan()
+    def start(self):
+        with self.lock:
+            for stream in self.streams:
+                stream.started = True
+            if self.scan_thread is not None:
+                return
+            t = self.scan_thread = threading.Thread(target=self.run_scan)
+            t.daemon = True
+        t.start()
+    def run_scan(self):
+        try:
+            with self.lock:
+                if not self.streams:
+                    # Every stream was closed before the scan started
+                    return
+            self.scanner.run_scan()
+        finally:
+            self.publish(None)
+            with self.lock:
+                self.scan_thread = None
+    def publish(self, item):
+        with self.lock:
+            streams = list(self.streams)
+        for stream in streams:
+            stream.put(item)
+    def publish_sample_set(self, sample_set, frequencies, powers):
+        self.publish(StreamResult(
+            kind='sample_set',
+            center_frequency=sample_set.center_frequency / 1e6,
+            frequencies=frequencies,
+            powers=10. * np.log10(np.abs(powers)),
+        ))
+    def publish_progress(self, value):
+        item = StreamResult(kind='progress', progress=value)
+        with self.lock:
+            streams = list(self.streams)
+        for stream in streams:
+            if stream.include_progress:
+                stream.put(item, block=False)
@@ -130,29 +130,42 @@ class ScrolledTreeNode(TreeViewLabel):
 
 class PlotsLoadRecent(Action):
     name = 'plots.load_recent'
+    page_size = 100
     def do_action(self, app):
         self.app = app
-        scan_data = db_store.get_all_scans()
         scroll_view = ScrolledTree()
         tree_view = scroll_view.tree
         self.tree_view = tree_view
-        for eid, scan in scan_data.items():
-            dt = datetime.datetime.fromtimestamp(scan['timestamp_utc'])
-            name = str(scan.get('name'))
-            txt = ' - '.join([name, str(dt)])
-            scan_node = tree_view.add_node(ScrolledTreeNode(text=txt))
-            scan_node.eid = eid
+        self.num_loaded = 0
+        self.num_scans = db_store.count_scans()
         load_btn = Button(text='Load')
+        more_btn = self.more_btn = Button(text='More')
         cancel_btn = Button(text='Cancel')
         hbox = BoxLayout(orientation='horizontal', size_hint_y=.1)
         hbox.add_widget(load_btn)
+        hbox.add_widget(more_btn)
         hbox.add_widget(cancel_btn)
         vbox = BoxLayout(orientation='vertical')
         vbox.add_widget(scroll_view)
         vbox.add_widget(hbox)
         cancel_btn.bind(on_release=self.on_cancel)
         load_btn.bind(on_release=self.on_load)
+        more_btn.bind(on_release=self.load_page)
+        self.load_page()
         app.root.show_popup(title='Load Scan', content=vbox, size_hint=(.9, .9))
+    def load_page(self, *args):
+        scans = db_store.query_scans(offset=self.num_loaded, limit=self.page_size)
+        tree_view = self.tree_view
+        for scan in scans:
+            dt = datetime.datetime.fromtimestamp(scan['timestamp_utc'])
+            name = str(scan.get('name'))
+            txt = ' - '.join([name, str(dt)])
+            if scan['start_freq'] is not None:
+                txt = '%s (%.1f - %.1f MHz)' % (txt, scan['start_freq'], scan['end_freq'])
+            scan_node = tree_view.add_node(ScrolledTreeNode(text=txt))
+            scan_node.eid = scan['eid']
+        self.num_loaded += len(scans)
+        self.more_btn.disabled = self.num_loaded >= self.num_scans
     def on_cancel(self, *args):
         self.app.root.close_popup()
         self.tree_view = None
@@ -11,6 +11,7 @@ from kivy.properties import (
 )
 
 from wwb_scanner.core import JSONMixin
+from wwb_scanner.utils.dbstore import db_store
 from wwb_scanner.ui.kivyui import plots
 from wwb_scanner.ui.kivyui import scan
 from wwb_scanner.ui.kivyui import actions
@@ -58,6 +59,10 @@ class RootWidget(BoxLayout, JSONMixin):
 class RTLSDRScannerApp(App):
     def build(self):
         return RootWidget()
+    def on_start(self):
+        db_store.start_retention()
+    def on_stop(self):
+        db_store.stop_retention()
     def on_action_button_release(self, btn):
         btn.parent.parent.dismiss()
         Action.trigger_by_name(btn.action, self)
@@ -388,6 +388,7 @@ class SpectrumPlot(Widget, JSONMixin):
     spectrum = ObjectProperty(None)
     spectrum_graph = ObjectProperty(None)
     def __init__(self, **kwargs):
+        self.data_version = None
         super(SpectrumPlot, self).__init__(**kwargs)
         self.bind(pos=self._trigger_update, size=self._trigger_update)
     def on_spectrum(self, *args):
@@ -443,19 +444,18 @@ class SpectrumPlot(Widget, JSONMixin):
             xy = [freq_to_x(freq), db_to_y(db)]
             self.points.extend(xy)
     def update_data(self):
-        if not self.spectrum.data_updated.is_set():
+        snapshot = self.spectrum.get_snapshot()
+        if snapshot.version == self.data_version:
             return
-        self.build_data()
+        self.build_data(snapshot)
         self.spectrum_graph.calc_plot_scale()
         self.draw_plot()
-    def build_data(self):
-        spectrum = self.spectrum
-        dtype = np.dtype(float)
-        with spectrum.data_update_lock:
-            x = np.fromiter(spectrum.iter_frequencies(), dtype)
-            y = np.fromiter((s.dbFS for s in spectrum.iter_samples()), dtype)
-            self.xy_data = {'x':x, 'y':y}
-            spectrum.data_updated.clear()
+    def build_data(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.spectrum.get_snapshot()
+        self.xy_data = {'x':snapshot.frequencies, 'y':snapshot.dbFS}
+        self.data_version = snapshot.version
+        self.spectrum.data_updated.clear()
     def calc_plot_scale(self):
         d = {}
         for key, data in self.xy_data.items():
@@ -1,3 +1,4 @@
+import logging
 import threading
 
 from kivy.event import EventDispatcher
@@ -18,6 +19,13 @@ from wwb_scanner.core import JSONMixin
 from wwb_scanner.scanner import Scanner
 from wwb_scanner.scan_objects import Spectrum
 
+logger = logging.getLogger(__name__)
+
+UI_EVENT_RATE = 5.
+
+def kivy_event_scheduler(callback, delay):
+    Clock.schedule_once(lambda dt: callback(), delay)
+
 
 class ScanControls(BoxLayout, JSONMixin):
     gain_dropdown = ObjectProperty(None)
@@ -122,6 +130,8 @@ class ScanGainDropDown(DropDown):
     def get_gains(self, *args, **kwargs):
         scanner = Scanner()
         gains = scanner.gains
+        if gains is None:
+            gains = scanner.get_gains()
         if gains is None:
             self.gains.append(0.)
             return
@@ -232,13 +242,14 @@ class ScanProgress(EventDispatcher):
                     if conf_name not in scan_config:
                         scan_config[conf_name] = {}
                     scan_config[conf_name][key] = val
-        self.scanner = Scanner(config=scan_config)
-        self.scanner.on_progress = self.on_scanner_progress
-        self.scanner.on_sweep_processed = self.on_sweep_processed
+        self.scanner = Scanner(config=scan_config,
+                               event_rate=UI_EVENT_RATE,
+                               event_scheduler=kivy_event_scheduler)
+        events = self.scanner.events
+        events.subscribe('progress', self.update_progress)
+        events.subscribe('sweep_processed', self.on_sweep_processed)
         self.scan_thread = ScanThread(scanner=self.scanner, callback=self.on_scanner_finished)
         self.run_scan()
-    def on_scanner_progress(self, value):
-        Clock.schedule_once(self.update_progress)
     def on_sweep_processed(self, **kwargs):
         freqs = kwargs.get('frequencies')
         powers = kwargs.get('powers')
@@ -252,7 +263,7 @@ class ScanProgress(EventDispatcher):
         try:
             self.scan_controls.current_freq = fc
         except:
-            print type(fc), repr(fc)
+            logger.exception('invalid center frequency: %r (%s)', fc, type(fc))
             self.cancel_scan()
             raise
         for f, val in zip(freqs, powers):
@@ -269,13 +280,11 @@ class ScanProgress(EventDispatcher):
         sg = self.scan_controls.live_spectrum_graph
         sg.spectrum_plot_container.clear_widgets()
         sg.add_plot(spectrum=self.current_spectrum)
-    def update_progress(self, *args, **kwargs):
+    def update_progress(self, **kwargs):
         if self.scanner is None:
             return
-        progress = float(self.scanner.progress)
-        self.status_bar.progress = progress
-        if int(progress * 100) % 2 == 0:
-            self.show_scan()
+        self.status_bar.progress = float(kwargs.get('value'))
+        self.show_scan()
     def run_scan(self):
         Clock.schedule_once(self._run_scan)
     def _run_scan(self, *args, **kwargs):
@@ -1,9 +1,13 @@
+import logging
+
 import numpy as np
 import matplotlib.pyplot as plt
 
 from wwb_scanner.scan_objects.spectrum import compare_spectra
 from wwb_scanner.file_handlers import BaseImporter
 
+logger = logging.getLogger(__name__)
+
 class BasePlot(object):
     def __init__(self, **kwargs):
         self.filename = kwargs.get('filename')
@@ -35,21 +39,21 @@ class BasePlot(object):
         #self.timer = figure.canvas.new_timer(interval=100)
         #self.timer.add_callback(self.on_timer)
     def on_timer(self):
-        print 'timer'
+        logger.debug('timer')
         spectrum = self.spectrum
         with spectrum.data_update_lock:
             if spectrum.data_updated.is_set():
-                print 'update plot'
+                logger.debug('update plot')
                 self.update_plot()
                 spectrum.data_updated.clear()
     def build_data(self):
-        dtype = np.dtype(float)
-        if not len(self.spectrum.samples):
+        snapshot = self.spectrum.get_snapshot()
+        if not len(snapshot):
             x = self.x = np.array(0.)
             y = self.y = np.array(0.)
         else:
-            x = self.x = np.fromiter(self.spectrum.iter_frequencies(), dtype)
-            y = self.y = np.fromiter((s.magnitude for s in self.spectrum.iter_samples()), dtype)
+            x = self.x = snapshot.frequencies
+            y = self.y = snapshot.magnitude
             if not hasattr(self, 'plot'):
                 self.spectrum.data_updated.clear()
         return x, y
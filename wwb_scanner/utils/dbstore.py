@@ -1,77 +1,851 @@
 import os
+import json
+import time
+import atexit
+import logging
 import datetime
+import threading
+import contextlib
+import sqlite3
 
-from tinydb import TinyDB, where
+import numpy as np
+
+from wwb_scanner.utils.samplecodec import (
+    encode_samples, decode_samples, DEFAULT_FORMAT, DB_RESOLUTION, FREQ_RESOLUTION,
+)
+from wwb_scanner.utils.retention import RetentionPolicy, RetentionManager, RetentionWorker
 
 APP_PATH = os.path.expanduser('~/wwb_scanner_data')
 
-DB_PATH = os.path.join(APP_PATH, 'db.json')
+DB_PATH = os.path.join(APP_PATH, 'db.sqlite3')
+LEGACY_DB_PATH = os.path.join(APP_PATH, 'db.json')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Spectrum attributes stored in their own (indexed) columns. Anything else
+# goes in the json ``data`` column
+SCAN_COLUMNS = ['name', 'timestamp_utc', 'scan_config_eid']
+
+# Number of points in the preview trace kept in the scan catalog
+PREVIEW_POINTS = 128
+
+CATALOG_COLUMNS = ['eid', 'name', 'timestamp_utc', 'scan_config_eid', 'color',
+                   'start_freq', 'end_freq', 'num_samples']
+CATALOG_SORT_KEYS = ['eid', 'name', 'timestamp_utc', 'start_freq', 'end_freq',
+                     'num_samples']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scan_configs (
+    eid INTEGER PRIMARY KEY AUTOINCREMENT,
+    datetime REAL,
+    name TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scan_configs_datetime ON scan_configs (datetime);
+CREATE INDEX IF NOT EXISTS scan_configs_name ON scan_configs (name);
+
+CREATE TABLE IF NOT EXISTS {scan_table} (
+    eid INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    timestamp_utc REAL,
+    scan_config_eid INTEGER,
+    data TEXT NOT NULL,
+    samples_format TEXT,
+    num_samples INTEGER,
+    samples BLOB
+);
+CREATE INDEX IF NOT EXISTS {scan_table}_timestamp ON {scan_table} (timestamp_utc);
+CREATE INDEX IF NOT EXISTS {scan_table}_name ON {scan_table} (name);
+CREATE INDEX IF NOT EXISTS {scan_table}_config ON {scan_table} (scan_config_eid);
+
+CREATE TABLE IF NOT EXISTS scan_catalog (
+    eid INTEGER PRIMARY KEY,
+    name TEXT,
+    timestamp_utc REAL,
+    scan_config_eid INTEGER,
+    color TEXT,
+    start_freq REAL,
+    end_freq REAL,
+    num_samples INTEGER,
+    preview BLOB
+);
+CREATE INDEX IF NOT EXISTS scan_catalog_timestamp ON scan_catalog (timestamp_utc);
+CREATE INDEX IF NOT EXISTS scan_catalog_name ON scan_catalog (name);
+CREATE INDEX IF NOT EXISTS scan_catalog_config ON scan_catalog (scan_config_eid);
+
+CREATE TABLE IF NOT EXISTS scan_summaries (
+    eid INTEGER PRIMARY KEY AUTOINCREMENT,
+    day REAL NOT NULL,
+    resolution REAL NOT NULL,
+    start_freq REAL,
+    end_freq REAL,
+    num_scans INTEGER,
+    scan_eids TEXT,
+    samples_format TEXT,
+    num_samples INTEGER,
+    samples BLOB
+);
+CREATE UNIQUE INDEX IF NOT EXISTS scan_summaries_day ON scan_summaries (day, resolution);
+
+CREATE TABLE IF NOT EXISTS device_capabilities (
+    eid INTEGER PRIMARY KEY AUTOINCREMENT,
+    serial TEXT,
+    device_key TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS device_capabilities_serial ON device_capabilities (serial);
+CREATE INDEX IF NOT EXISTS device_capabilities_key ON device_capabilities (device_key);
+'''
+
+logger = logging.getLogger(__name__)
+
+def datetime_to_timestamp(dt):
+    if isinstance(dt, datetime.datetime):
+        return (dt - EPOCH).total_seconds()
+    return dt
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return datetime_to_timestamp(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('%r is not JSON serializable' % (obj))
+
+def to_json(data):
+    return json.dumps(data, default=_json_default)
+
+def build_preview(dbFS, num_points=PREVIEW_POINTS):
+    '''Decimate dBFS values to at most ``num_points`` (keeping the peak of
+    each group) for the scan catalog
+    '''
+    dbFS = np.asarray(dbFS, dtype=float)
+    if dbFS.size > num_points:
+        edges = np.linspace(0, dbFS.size, num_points + 1).astype(int)[:-1]
+        dbFS = np.maximum.reduceat(dbFS, edges)
+    return dbFS.astype('<f4')
+
+def legacy_samples_to_arrays(samples):
+    '''Convert the per-sample dicts stored by the TinyDB store to arrays
+    '''
+    if isinstance(samples, dict):
+        items = samples.values()
+    else:
+        items = samples or []
+    freqs = []
+    dbFS = []
+    for data in items:
+        if 'dbFS' in data and data['dbFS'] is not None:
+            value = data['dbFS']
+        elif data.get('magnitude') is not None:
+            value = 10. * np.log10(data['magnitude'])
+        elif data.get('iq') is not None:
+            i, q = data['iq']
+            value = 10. * np.log10(np.abs(float(i) + 1j * float(q)))
+        else:
+            continue
+        freqs.append(float(data['frequency']))
+        dbFS.append(value)
+    freqs = np.array(freqs, dtype=float)
+    dbFS = np.array(dbFS, dtype=float)
+    order = np.argsort(freqs)
+    return freqs[order], dbFS[order]
+
+class DBElement(dict):
+    '''A stored document with its ``eid``
+    '''
+    def __init__(self, data, eid):
+        super(DBElement, self).__init__(data)
+        self.eid = eid
 
 class DBStore(object):
-    TABLES = ['scan_configs', 'scans_performed', 'scans_imported']
-    def __init__(self):
-        if not os.path.exists(os.path.dirname(DB_PATH)):
-            os.makedirs(os.path.dirname(DB_PATH))
-        self.db = TinyDB(DB_PATH)
+    '''Scan and config storage in an SQLite database
+
+    Each scan is one row with indexed ``name``, ``timestamp_utc`` and
+    ``scan_config_eid`` columns and its samples in a single blob (encoded
+    with :func:`~wwb_scanner.utils.samplecodec.encode_samples` in
+    ``samples_format``, quantized and compressed by default), so saving
+    a scan only writes its own row. Summary metadata for each scan is kept
+    in a separate catalog table (see :meth:`query_scans`), so listing scans
+    never reads sample data. The database uses WAL mode and may be shared between
+    threads.
+
+    Operations commit on their own, unless made inside :meth:`batch`.
+
+    Older scans can be downsampled and archived with :meth:`apply_retention`
+    or :meth:`start_retention` (see
+    :class:`~wwb_scanner.utils.retention.RetentionManager`).
+
+    An existing TinyDB file (``db.json``) is migrated when the database is
+    first created, then renamed to ``db.json.migrated``.
+
+    params:
+        db_path: path of the database file. Defaults to :data:`DB_PATH`
+        samples_format: encoding of new scan samples (one of
+            :data:`~wwb_scanner.utils.samplecodec.SAMPLE_FORMATS`)
+        db_resolution: dBFS quantization step (in dB) for ``'q16z'``
+        freq_resolution: frequency quantization step (in Hz) for ``'q16z'``
+    '''
+    TABLES = ['scan_configs', 'scans_performed', 'scans_imported',
+              'device_capabilities']
+    SCAN_TABLES = ['scans_performed', 'scans_imported']
+    def __init__(self, db_path=None, legacy_path=None, samples_format=DEFAULT_FORMAT,
+                 db_resolution=DB_RESOLUTION, freq_resolution=FREQ_RESOLUTION):
+        if db_path is None:
+            db_path = DB_PATH
+        if legacy_path is None:
+            legacy_path = LEGACY_DB_PATH
+        self.db_path = db_path
+        self.samples_format = samples_format
+        self.db_resolution = db_resolution
+        self.freq_resolution = freq_resolution
+        if not os.path.exists(os.path.dirname(db_path)):
+            os.makedirs(os.path.dirname(db_path))
+        is_new = not os.path.exists(db_path)
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.retention_worker = None
+        self._retention_policy = None
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # Only takes effect for new databases (see RetentionManager.compact_step)
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.create_tables()
+        if is_new and os.path.exists(legacy_path):
+            self.migrate_legacy(legacy_path)
+        self.build_catalog()
+    def create_tables(self):
+        with self.lock:
+            self.conn.executescript(SCHEMA.format(scan_table=self.SCAN_TABLES[0]))
+            self.conn.executescript(SCHEMA.format(scan_table=self.SCAN_TABLES[1]))
+    def build_catalog(self):
+        '''Add catalog entries for scans that don't have one
+        '''
+        rows = self.query(
+            'SELECT eid FROM scans_performed WHERE eid NOT IN '
+            '(SELECT eid FROM scan_catalog)')
+        if not len(rows):
+            return
+        with self.batch():
+            for (eid,) in rows:
+                scan = self.get_scan(eid)
+                samples = scan.pop('samples')
+                self._write_catalog(eid, scan, samples['frequency'], samples['dbFS'])
+        logger.info('added %s scans to the catalog', len(rows))
+    @contextlib.contextmanager
+    def batch(self):
+        '''Context manager to run several operations in one transaction
+        '''
+        with self.lock:
+            self.batch_depth += 1
+            try:
+                yield self
+            except:
+                self.batch_depth -= 1
+                if not self.batch_depth:
+                    self.conn.rollback()
+                raise
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.conn.commit()
+    def execute(self, sql, params=()):
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            if not self.batch_depth:
+                self.conn.commit()
+            return cursor
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+    def query_one(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+    def _build_element(self, row):
+        if row is None:
+            return None
+        eid, data = row
+        return DBElement(json.loads(data), eid)
     def add_scan_config(self, config, force_insert=False):
         if config.get('datetime') is None:
             config.datetime = datetime.datetime.utcnow()
-        table = self.db.table('scan_configs')
         if config.get('eid') is not None:
-            dbconfig = table.get(eid=config.eid)
+            dbconfig = self.get_scan_config(eid=config.eid)
         else:
-            dbconfig = table.get(where('datetime') == config.datetime)
+            dbconfig = self.get_scan_config(datetime=config.datetime)
+        data = config._serialize()
+        data.pop('eid', None)
+        values = (datetime_to_timestamp(config.datetime), config.get('name'), to_json(data))
         if dbconfig is not None:
             if force_insert:
-                eids = [dbconfig.eid]
-                table.update(config._serialize(), eids=eids)
+                self.execute(
+                    'UPDATE scan_configs SET datetime=?, name=?, data=? WHERE eid=?',
+                    values + (dbconfig.eid,))
             eid = dbconfig.eid
         else:
-            eid = table.insert(config._serialize())
+            eid = self.execute(
+                'INSERT INTO scan_configs (datetime, name, data) VALUES (?, ?, ?)',
+                values).lastrowid
         config.eid = eid
     def get_scan_config(self, **kwargs):
-        table = self.db.table('scan_configs')
+        sql = 'SELECT eid, data FROM scan_configs'
         if kwargs.get('datetime'):
-            dbconfig = table.get(where('datetime')==kwargs.get('datetime'))
+            row = self.query_one(sql + ' WHERE datetime=?',
+                                 (datetime_to_timestamp(kwargs.get('datetime')),))
         elif kwargs.get('eid'):
-            dbconfig = table.get(eid=kwargs.get('eid'))
+            row = self.query_one(sql + ' WHERE eid=?', (kwargs.get('eid'),))
         elif kwargs.get('name'):
-            dbconfig = table.get(where('name')==kwargs.get('name'))
-        elif table._last_id > 0:
-            dbconfig = table.get(eid=table._last_id)
-        else:
-            dbconfig = None
-        return dbconfig
-    def add_scan(self, spectrum, scan_config=None):
-        if scan_config is None:
-            scan_config = spectrum.scan_config
-        if scan_config is not None:
-            if scan_config.get('eid') is None:
-                self.add_scan_config(scan_config)
-            spectrum.scan_config_eid = scan_config.eid
-        data = spectrum._serialize()
-        table = self.db.table('scans_performed')
-        if spectrum.eid is not None:
-            eid = spectrum.eid
-            table.update(data, eids=[eid])
+            row = self.query_one(sql + ' WHERE name=? ORDER BY eid LIMIT 1',
+                                 (kwargs.get('name'),))
         else:
-            eid = table.insert(data)
+            row = self.query_one(sql + ' ORDER BY eid DESC LIMIT 1')
+        return self._build_element(row)
+    def _split_scan_data(self, data):
+        columns = {key: data.pop(key, None) for key in SCAN_COLUMNS}
+        return columns, data
+    def add_scan(self, spectrum, scan_config=None, data=None, samples=None):
+        '''Save a spectrum
+
+        params:
+            spectrum: the :class:`~wwb_scanner.scan_objects.spectrum.Spectrum`
+            scan_config: config to store with the scan. Defaults to the
+                spectrum's config
+            data: spectrum attributes to store (defaults to
+                ``spectrum._serialize_attrs()``)
+            samples: tuple of ``(frequencies, dbFS)`` arrays (defaults to
+                ``spectrum.get_sample_arrays()``)
+        '''
+        if data is None:
+            data = spectrum._serialize_attrs()
+        if samples is None:
+            samples = spectrum.get_sample_arrays()
+        with self.batch():
+            if scan_config is None:
+                scan_config = spectrum.scan_config
+            if scan_config is not None:
+                if scan_config.get('eid') is None:
+                    self.add_scan_config(scan_config)
+                spectrum.scan_config_eid = scan_config.eid
+                data = dict(data, scan_config_eid=scan_config.eid)
+            freqs, dbFS = samples
+            eid = self._write_scan('scans_performed', spectrum.eid, data, freqs, dbFS)
             spectrum.eid = eid
         return eid
+    def encode_samples(self, freqs, dbFS):
+        return encode_samples(freqs, dbFS, self.samples_format,
+                              db_resolution=self.db_resolution,
+                              freq_resolution=self.freq_resolution)
+    def _write_scan(self, table, eid, data, freqs, dbFS):
+        columns, data = self._split_scan_data(dict(data))
+        values = [columns[key] for key in SCAN_COLUMNS]
+        values.append(to_json(data))
+        samples = self.encode_samples(freqs, dbFS)
+        values.extend([self.samples_format, len(freqs), sqlite3.Binary(samples)])
+        keys = SCAN_COLUMNS + ['data', 'samples_format', 'num_samples', 'samples']
+        if eid is not None and self.query_one(
+                'SELECT eid FROM %s WHERE eid=?' % (table), (eid,)) is not None:
+            assignments = ', '.join('%s=?' % (key) for key in keys)
+            self.execute('UPDATE %s SET %s WHERE eid=?' % (table, assignments),
+                         values + [eid])
+        else:
+            if eid is not None:
+                keys = ['eid'] + keys
+                values = [eid] + values
+            sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                table, ', '.join(keys), ', '.join(['?'] * len(keys)))
+            eid = self.execute(sql, values).lastrowid
+        if table == 'scans_performed':
+            data.update(columns)
+            self._write_catalog(eid, data, freqs, dbFS)
+        return eid
+    def _write_catalog(self, eid, data, freqs, dbFS):
+        num_samples = len(freqs)
+        self.execute(
+            'INSERT OR REPLACE INTO scan_catalog (eid, name, timestamp_utc, '
+            'scan_config_eid, color, start_freq, end_freq, num_samples, preview) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                eid, data.get('name'), data.get('timestamp_utc'),
+                data.get('scan_config_eid'), to_json(data.get('color')),
+                float(np.min(freqs)) if num_samples else None,
+                float(np.max(freqs)) if num_samples else None,
+                num_samples,
+                sqlite3.Binary(build_preview(dbFS).tostring()),
+            ))
+    def _build_filters(self, **kwargs):
+        clauses = []
+        params = []
+        if kwargs.get('name'):
+            clauses.append('name LIKE ?')
+            params.append('%%%s%%' % (kwargs['name']))
+        if kwargs.get('scan_config_eid') is not None:
+            clauses.append('scan_config_eid = ?')
+            params.append(kwargs['scan_config_eid'])
+        time_range = kwargs.get('time_range')
+        if time_range is not None:
+            clauses.append('timestamp_utc >= ? AND timestamp_utc < ?')
+            params.extend([datetime_to_timestamp(t) for t in time_range])
+        freq_range = kwargs.get('freq_range')
+        if freq_range is not None:
+            clauses.append('start_freq <= ? AND end_freq >= ?')
+            params.extend([freq_range[1], freq_range[0]])
+        if not clauses:
+            return '', params
+        return ' WHERE %s' % (' AND '.join(clauses)), params
+    def query_scans(self, **kwargs):
+        '''Get scan metadata from the catalog without loading any samples
+
+        params:
+            offset: number of results to skip
+            limit: maximum number of results (None for all)
+            order_by: one of :data:`CATALOG_SORT_KEYS`
+            descending: sort order (newest first by default)
+            name: only scans with names containing this string
+            scan_config_eid: only scans made with this config
+            time_range: (start, end) timestamps or datetimes (UTC)
+            freq_range: (start, end) in MHz, for scans overlapping it
+            include_preview: add a ``preview`` array (the dBFS values
+                decimated to :data:`PREVIEW_POINTS`)
+
+        Returns a list of dicts with the :data:`CATALOG_COLUMNS` keys
+        '''
+        order_by = kwargs.get('order_by', 'timestamp_utc')
+        if order_by not in CATALOG_SORT_KEYS:
+            raise ValueError('Cannot sort by %s' % (order_by))
+        direction = 'DESC' if kwargs.get('descending', True) else 'ASC'
+        include_preview = kwargs.get('include_preview', False)
+        columns = list(CATALOG_COLUMNS)
+        if include_preview:
+            columns.append('preview')
+        where, params = self._build_filters(**kwargs)
+        sql = 'SELECT %s FROM scan_catalog%s ORDER BY %s %s, eid %s' % (
+            ', '.join(columns), where, order_by, direction, direction)
+        limit = kwargs.get('limit')
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            params.extend([limit, kwargs.get('offset', 0)])
+        results = []
+        for row in self.query(sql, params):
+            d = dict(zip(columns, row))
+            d['color'] = json.loads(d['color']) if d['color'] else None
+            if include_preview:
+                d['preview'] = np.frombuffer(bytes(d['preview']), dtype='<f4')
+            results.append(d)
+        return results
+    def count_scans(self, **kwargs):
+        '''Number of scans matching the filters of :meth:`query_scans`
+        '''
+        where, params = self._build_filters(**kwargs)
+        return self.query_one('SELECT COUNT(*) FROM scan_catalog%s' % (where), params)[0]
     def get_all_scans(self):
-        table = self.db.table('scans_performed')
-        scans = table.all()
-        scan_data = {}
-        for scan in scans:
-            excluded = ['samples', 'center_frequencies']
-            scan_data[scan.eid] = {key:scan[key] for key in scan.keys()
-                                    if key not in excluded}
-        return scan_data
+        return {d['eid']: d for d in self.query_scans(order_by='eid', descending=False)}
     def get_scan(self, eid):
-        table = self.db.table('scans_performed')
-        return table.get(eid=eid)
+        row = self.query_one(
+            'SELECT name, timestamp_utc, scan_config_eid, data, samples_format, samples '
+            'FROM scans_performed WHERE eid=?', (eid,))
+        if row is None:
+            return None
+        name, timestamp_utc, scan_config_eid, data, samples_format, samples = row
+        d = json.loads(data)
+        d.update(name=name, timestamp_utc=timestamp_utc,
+                 scan_config_eid=scan_config_eid,
+                 samples=decode_samples(samples_format, samples))
+        return DBElement(d, eid)
     def update_scan(self, eid, **kwargs):
-        table = self.db.table('scans_performed')
-        table.update(kwargs, eids=[eid])
+        with self.batch():
+            columns = {key: kwargs.pop(key) for key in SCAN_COLUMNS if key in kwargs}
+            if kwargs:
+                row = self.query_one('SELECT data FROM scans_performed WHERE eid=?', (eid,))
+                if row is None:
+                    return
+                data = json.loads(row[0])
+                data.update(kwargs)
+                columns['data'] = to_json(data)
+            if not columns:
+                return
+            keys = sorted(columns.keys())
+            assignments = ', '.join('%s=?' % (key) for key in keys)
+            self.execute('UPDATE scans_performed SET %s WHERE eid=?' % (assignments),
+                         [columns[key] for key in keys] + [eid])
+            catalog = {key: columns[key] for key in SCAN_COLUMNS if key in columns}
+            if 'color' in kwargs:
+                catalog['color'] = to_json(kwargs['color'])
+            if catalog:
+                keys = sorted(catalog.keys())
+                assignments = ', '.join('%s=?' % (key) for key in keys)
+                self.execute('UPDATE scan_catalog SET %s WHERE eid=?' % (assignments),
+                             [catalog[key] for key in keys] + [eid])
+    def get_summary(self, eid=None, day=None, resolution=None, decode=True):
+        '''Get a daily max-hold summary written by
+        :class:`~wwb_scanner.utils.retention.RetentionManager`
+
+        params:
+            eid: the summary eid
+            day: timestamp (UTC) of the start of the day (if no ``eid``)
+            resolution: the summary resolution (if no ``eid``)
+            decode: if False, ``samples`` is left as the encoded bytes
+
+        Returns a :class:`DBElement` (or None)
+        '''
+        sql = ('SELECT eid, day, resolution, start_freq, end_freq, num_scans, '
+               'scan_eids, samples_format, samples, '
+               'length(samples) + length(scan_eids) AS size FROM scan_summaries')
+        if eid is not None:
+            row = self.query_one(sql + ' WHERE eid=?', (eid,))
+        else:
+            row = self.query_one(sql + ' WHERE day=? AND resolution=?', (day, resolution))
+        if row is None:
+            return None
+        keys = ['eid', 'day', 'resolution', 'start_freq', 'end_freq', 'num_scans',
+                'scan_eids', 'samples_format', 'samples', 'size']
+        d = dict(zip(keys, row))
+        d['scan_eids'] = json.loads(d['scan_eids'])
+        if decode:
+            d['samples'] = decode_samples(d['samples_format'], d['samples'])
+        else:
+            d['samples'] = bytes(d['samples'])
+        return DBElement(d, d['eid'])
+    def query_summaries(self, time_range=None):
+        '''Get the metadata (without samples) of the daily summaries, oldest
+        first
+
+        params:
+            time_range: optional (start, end) timestamps or datetimes (UTC)
+        '''
+        sql = ('SELECT eid, day, resolution, start_freq, end_freq, num_scans, '
+               'num_samples FROM scan_summaries')
+        params = []
+        if time_range is not None:
+            sql += ' WHERE day >= ? AND day < ?'
+            params.extend([datetime_to_timestamp(t) for t in time_range])
+        keys = ['eid', 'day', 'resolution', 'start_freq', 'end_freq', 'num_scans',
+                'num_samples']
+        return [dict(zip(keys, row)) for row in self.query(sql + ' ORDER BY day', params)]
+    @property
+    def retention_policy_path(self):
+        return os.path.join(os.path.dirname(self.db_path), 'retention.json')
+    @property
+    def retention_policy(self):
+        '''The :class:`~wwb_scanner.utils.retention.RetentionPolicy`, loaded
+        from ``retention.json`` next to the database (or the defaults)
+        '''
+        policy = self._retention_policy
+        if policy is None:
+            policy = self._retention_policy = RetentionPolicy.load(self.retention_policy_path)
+        return policy
+    @retention_policy.setter
+    def retention_policy(self, policy):
+        self._retention_policy = policy
+        policy.save(self.retention_policy_path)
+    def apply_retention(self, policy=None, **kwargs):
+        '''Apply a retention policy now and return a
+        :class:`~wwb_scanner.utils.retention.RetentionReport`
+
+        params:
+            policy: defaults to :attr:`retention_policy`
+            step_interval: seconds to sleep between steps
+        '''
+        if policy is None:
+            policy = self.retention_policy
+        report = RetentionManager(self, policy).run(**kwargs)
+        logger.info('retention: %s', report)
+        return report
+    def start_retention(self, policy=None):
+        '''Apply a retention policy periodically in a background thread
+
+        Returns the :class:`~wwb_scanner.utils.retention.RetentionWorker`
+        '''
+        if self.retention_worker is not None:
+            return self.retention_worker
+        if policy is None:
+            policy = self.retention_policy
+        worker = self.retention_worker = RetentionWorker(RetentionManager(self, policy))
+        worker.start()
+        return worker
+    def stop_retention(self):
+        worker = self.retention_worker
+        if worker is None:
+            return
+        self.retention_worker = None
+        worker.stop()
+    def get_device_capabilities(self, serial=None, device_key=None):
+        sql = 'SELECT eid, data FROM device_capabilities'
+        data = None
+        if serial is not None:
+            data = self._build_element(self.query_one(sql + ' WHERE serial=?', (serial,)))
+        if data is None and device_key is not None:
+            data = self._build_element(self.query_one(
+                sql + ' WHERE device_key=?', (device_key,)))
+        return data
+    def set_device_capabilities(self, data):
+        with self.batch():
+            existing = None
+            if data.get('serial') is not None:
+                existing = self.get_device_capabilities(serial=data['serial'])
+            if existing is None:
+                existing = self.get_device_capabilities(device_key=data['device_key'])
+            if existing is not None:
+                existing.update(data)
+                self.execute(
+                    'UPDATE device_capabilities SET serial=?, device_key=?, data=? '
+                    'WHERE eid=?',
+                    (existing.get('serial'), existing.get('device_key'),
+                     to_json(existing), existing.eid))
+                return existing.eid
+            return self.execute(
+                'INSERT INTO device_capabilities (serial, device_key, data) VALUES (?, ?, ?)',
+                (data.get('serial'), data.get('device_key'), to_json(data))).lastrowid
+    def migrate_legacy(self, legacy_path):
+        '''Copy all documents from a TinyDB json file (keeping their eids)
+        '''
+        with open(legacy_path, 'r') as f:
+            legacy = json.load(f)
+        counts = {}
+        with self.batch():
+            for eid, data in legacy.get('scan_configs', {}).items():
+                self.execute(
+                    'INSERT INTO scan_configs (eid, datetime, name, data) VALUES (?, ?, ?, ?)',
+                    (int(eid), data.get('datetime'), data.get('name'), to_json(data)))
+            for table in self.SCAN_TABLES:
+                for eid, data in legacy.get(table, {}).items():
+                    freqs, dbFS = legacy_samples_to_arrays(data.pop('samples', None))
+                    self._write_scan(table, int(eid), data, freqs, dbFS)
+            for eid, data in legacy.get('device_capabilities', {}).items():
+                self.execute(
+                    'INSERT INTO device_capabilities (eid, serial, device_key, data) '
+                    'VALUES (?, ?, ?, ?)',
+                    (int(eid), data.get('serial'), data.get('device_key'), to_json(data)))
+            for table in self.TABLES:
+                counts[table] = len(legacy.get(table, {}))
+        os.rename(legacy_path, '%s.migrated' % (legacy_path))
+        logger.info('migrated %s to %s: %s', legacy_path, self.db_path, counts)
+    def close(self):
+        self.stop_retention()
+        with self.lock:
+            self.conn.close()
+
+class WriteFuture(object):
+    '''Result of a write queued in a :class:`DBWriter`
+
+    Attributes:
+        duration: seconds spent in the transaction that made the write
+            (None until it is done)
+    '''
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.duration = None
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+    def set_exception(self, exc):
+        self._exception = exc
+        self._set_done()
+    def _set_done(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._run_callback(fn)
+    def _run_callback(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            logger.exception('WriteFuture callback failed')
+    def add_done_callback(self, fn):
+        '''Call ``fn(future)`` when the write is done
+
+        If it is already done, ``fn`` is called immediately.
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        self._run_callback(fn)
+    def done(self):
+        return self._done.is_set()
+    def result(self, timeout=None):
+        '''Wait for the write and return its result (the scan eid)
+
+        Raises the exception from the write if it failed, or
+        :class:`RuntimeError` if ``timeout`` seconds pass first.
+        '''
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for db write')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+    def exception(self, timeout=None):
+        self._done.wait(timeout)
+        return self._exception
+
+class DBWriter(object):
+    '''Write-behind queue for scan saves and updates
+
+    Writes are done on a background thread. Pending writes for the same
+    spectrum are coalesced: a newer save replaces an older one, updates
+    are merged, and an update to a spectrum waiting to be saved is folded
+    into the save. An update made while the spectrum's first save is being
+    written is queued and made once the save has its eid. Writes queued within ``batch_delay`` seconds of each
+    other are made in one transaction. Pending writes are flushed at
+    interpreter exit.
+
+    The values to write are captured when a write is queued, so the
+    spectrum can keep changing afterwards.
+
+    params:
+        store: the :class:`DBStore` to write to
+        batch_delay: seconds to wait for more writes before committing
+    '''
+    def __init__(self, store, batch_delay=.1):
+        self.store = store
+        self.batch_delay = batch_delay
+        self.pending = {}
+        self.order = []
+        self.in_flight = set()
+        self.condition = threading.Condition()
+        self.busy = False
+        self.thread = None
+    def save_scan(self, spectrum):
+        '''Queue a save of ``spectrum``. Returns a :class:`WriteFuture`
+        '''
+        snapshot = spectrum.publish_snapshot()
+        op = dict(
+            kind='save',
+            data=spectrum._serialize_attrs(),
+            samples=(snapshot.frequencies, snapshot.dbFS),
+        )
+        return self._submit(spectrum, op)
+    def update_scan(self, spectrum, **kwargs):
+        '''Queue an update of the given spectrum attributes
+
+        Returns a :class:`WriteFuture`, or None if the spectrum was never
+        saved (or queued to be saved).
+        '''
+        return self._submit(spectrum, dict(kind='update', data=kwargs))
+    def _submit(self, spectrum, op):
+        key = id(spectrum)
+        with self.condition:
+            existing = self.pending.get(key)
+            if existing is None:
+                if op['kind'] == 'update' and spectrum.eid is None:
+                    if key not in self.in_flight:
+                        return None
+                op.update(spectrum=spectrum, future=WriteFuture())
+                self.pending[key] = op
+                self.order.append(key)
+            elif op['kind'] == 'save':
+                existing.update(kind='save', data=op['data'], samples=op['samples'])
+                op = existing
+            else:
+                existing['data'].update(op['data'])
+                op = existing
+            self._start()
+            self.condition.notify()
+            return op['future']
+    def _start(self):
+        if self.thread is not None:
+            return
+        t = self.thread = threading.Thread(target=self.run, name='DBWriter')
+        t.daemon = True
+        t.start()
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.order:
+                    self.condition.wait()
+                self.busy = True
+            time.sleep(self.batch_delay)
+            with self.condition:
+                ops = [self.pending.pop(key) for key in self.order]
+                self.in_flight = set(self.order)
+                self.order = []
+            self.write(ops)
+            with self.condition:
+                self.in_flight = set()
+                self.busy = False
+                self.condition.notify_all()
+    def write(self, ops):
+        store = self.store
+        results = []
+        start_ts = time.time()
+        try:
+            with store.batch():
+                for op in ops:
+                    spectrum = op['spectrum']
+                    if op['kind'] == 'save':
+                        eid = store.add_scan(spectrum, data=op['data'], samples=op['samples'])
+                    else:
+                        # Queued while the first save was in flight
+                        eid = spectrum.eid
+                        if eid is None:
+                            results.append(RuntimeError('Scan was never saved'))
+                            continue
+                        store.update_scan(eid, **op['data'])
+                    results.append(eid)
+        except Exception as e:
+            logger.exception('db write failed')
+            duration = time.time() - start_ts
+            for op in ops:
+                op['future'].duration = duration
+                op['future'].set_exception(e)
+            return
+        duration = time.time() - start_ts
+        for op, eid in zip(ops, results):
+            op['future'].duration = duration
+            if isinstance(eid, Exception):
+                op['future'].set_exception(eid)
+            else:
+                op['future'].set_result(eid)
+    def flush(self, timeout=None):
+        '''Wait until all queued writes are done
+
+        Returns False if ``timeout`` seconds passed first
+        '''
+        end_ts = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.order or self.busy:
+                if end_ts is None:
+                    self.condition.wait(1.)
+                    continue
+                remaining = end_ts - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+class LazyDBStore(object):
+    '''Stand-in for a :class:`DBStore` that only opens it on first use
+
+    Attribute access is passed to the store, so importing modules that use
+    :data:`db_store` does not create :data:`APP_PATH` or open the database.
+    '''
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._store = None
+        self._store_lock = threading.Lock()
+    @property
+    def is_open(self):
+        return self._store is not None
+    def get_store(self):
+        store = self._store
+        if store is None:
+            with self._store_lock:
+                if self._store is None:
+                    self._store = DBStore(**self._kwargs)
+                store = self._store
+        return store
+    def __getattr__(self, attr):
+        return getattr(self.get_store(), attr)
+    def __setattr__(self, attr, value):
+        if attr.startswith('_'):
+            super(LazyDBStore, self).__setattr__(attr, value)
+        else:
+            setattr(self.get_store(), attr, value)
 
-db_store = DBStore()
+db_store = LazyDBStore()
+db_writer = DBWriter(db_store)
+atexit.register(db_writer.flush)
@@ -1,34 +1,139 @@
 import base64
 import json
+import zlib
 import numpy as np
 
-## From http://stackoverflow.com/questions/27909658/
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+## Originally from http://stackoverflow.com/questions/27909658/
+
+# Arrays at least this large (in bytes) are zlib compressed if that makes
+# them smaller. None disables compression
+COMPRESS_THRESHOLD = 65536
+COMPRESS_LEVEL = 1
+
+def encode_ndarray(obj, compress_threshold=COMPRESS_THRESHOLD):
+    '''Encode an array as a json compatible dict
+
+    The dict holds the dtype (including byte order), the shape and the raw
+    bytes (base64), zlib compressed if ``compression`` is set. Arrays of
+    python objects are stored as lists.
+    '''
+    if obj.dtype.hasobject:
+        return dict(__ndarray__=obj.tolist(), dtype='object', shape=list(obj.shape))
+    if obj.dtype.fields is not None:
+        dtype = obj.dtype.descr
+    else:
+        dtype = obj.dtype.str
+    data = np.ascontiguousarray(obj).tostring()
+    d = dict(dtype=dtype, shape=list(obj.shape))
+    if compress_threshold is not None and len(data) >= compress_threshold:
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        if len(compressed) < len(data):
+            data = compressed
+            d['compression'] = 'zlib'
+    d['__ndarray__'] = base64.b64encode(data)
+    return d
+
+def _build_dtype(dtype):
+    if not isinstance(dtype, list):
+        return np.dtype(str(dtype))
+    fields = []
+    for field in dtype:
+        name, field_dtype = str(field[0]), field[1]
+        if isinstance(field_dtype, list):
+            field_dtype = _build_dtype(field_dtype)
+        else:
+            field_dtype = str(field_dtype)
+        if len(field) > 2:
+            fields.append((name, field_dtype, tuple(field[2])))
+        else:
+            fields.append((name, field_dtype))
+    return np.dtype(fields)
+
+def decode_ndarray(dct):
+    '''Decode a dict built by :func:`encode_ndarray`
+
+    Arrays are built with :func:`numpy.frombuffer` on the decoded bytes and
+    so are read-only. Dicts written by older versions (holding a pickled
+    array) are also loaded.
+    '''
+    if 'dtype' not in dct:
+        # Pickled array written by older versions
+        data = base64.b64decode(dct['__ndarray__'])
+        return np.loads(data)
+    shape = tuple(dct['shape'])
+    if dct['dtype'] == 'object':
+        a = np.empty(len(dct['__ndarray__']), dtype=object)
+        a[:] = dct['__ndarray__']
+        return a.reshape(shape)
+    data = base64.b64decode(dct['__ndarray__'])
+    if dct.get('compression') == 'zlib':
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype=_build_dtype(dct['dtype'])).reshape(shape)
 
 class NumpyEncoder(json.JSONEncoder):
+    compress_threshold = COMPRESS_THRESHOLD
     def default(self, obj):
         if isinstance(obj, np.ndarray):
-            data_b64 = base64.b64encode(obj.dumps())
-            return dict(__ndarray__=data_b64)
+            return encode_ndarray(obj, self.compress_threshold)
+        if isinstance(obj, np.generic):
+            return obj.item()
         return json.JSONEncoder.default(self, obj)
 
 def json_numpy_obj_hook(dct):
     if isinstance(dct, dict) and '__ndarray__' in dct:
-        data = base64.b64decode(dct['__ndarray__'])
-        return np.loads(data)
+        return decode_ndarray(dct)
     return dct
 
+def _apply_hook(obj):
+    # Same result as json_numpy_obj_hook, for parsers without object_hook
+    if type(obj) is dict and '__ndarray__' in obj:
+        return decode_ndarray(obj)
+    stack = [obj]
+    while stack:
+        container = stack.pop()
+        if type(container) is dict:
+            items = container.iteritems()
+        else:
+            items = enumerate(container)
+        for key, val in items:
+            t = type(val)
+            if t is dict:
+                if '__ndarray__' in val:
+                    container[key] = decode_ndarray(val)
+                else:
+                    stack.append(val)
+            elif t is list:
+                stack.append(val)
+    return obj
+
 def dumps(*args, **kwargs):
     kwargs.setdefault('cls', NumpyEncoder)
     return json.dumps(*args, **kwargs)
 
-def loads(*args, **kwargs):
+def loads(s, **kwargs):
+    # ujson parses much faster. It is only used for loading (its encoder
+    # rounds floats to 15 digits)
+    if ujson is not None and not kwargs:
+        try:
+            obj = ujson.loads(s, precise_float=True)
+        except ValueError:
+            # NaN and Infinity are only handled by the json module
+            obj = None
+        else:
+            if '"__ndarray__"' not in s:
+                return obj
+            return _apply_hook(obj)
     kwargs.setdefault('object_hook', json_numpy_obj_hook)
-    return json.loads(*args, **kwargs)
+    return json.loads(s, **kwargs)
 
 def dump(*args, **kwargs):
     kwargs.setdefault('cls', NumpyEncoder)
     return json.dump(*args, **kwargs)
 
-def load(*args, **kwargs):
-    kwargs.setdefault('object_hook', json_numpy_obj_hook)
-    return json.load(*args, **kwargs)
+def load(fp, **kwargs):
+    return loads(fp.read(), **kwargs)
@@ -0,0 +1,403 @@
+import os
+import json
+import time
+import gzip
+import base64
+import logging
+import sqlite3
+import datetime
+import threading
+
+import numpy as np
+
+from wwb_scanner.utils.config import Config
+from wwb_scanner.utils.samplecodec import decode_samples
+
+SECONDS_PER_DAY = 86400.
+
+logger = logging.getLogger(__name__)
+
+class RetentionPolicy(Config):
+    '''Settings for :class:`RetentionManager`
+
+    Attributes:
+        enabled: If False, :meth:`RetentionManager.run` does nothing
+        keep_full_scans: Number of most recent scans always kept at full
+            resolution
+        keep_full_days: Scans newer than this (in days) are also kept at full
+            resolution
+        summary_resolution: Frequency resolution (in MHz) of the daily
+            max-hold summaries that older scans are merged into
+        archive_after_days: Summaries older than this (in days) are moved to
+            compressed archive files. None to keep them in the database
+        batch_size: Maximum number of scans (or summaries) handled per step
+        step_interval: Seconds to wait between steps when running in the
+            background
+        vacuum_pages: Maximum number of free pages released per compaction
+            step
+        check_interval: Seconds between passes of a :class:`RetentionWorker`
+    '''
+    DEFAULTS = dict(
+        enabled=True,
+        keep_full_scans=100,
+        keep_full_days=30.,
+        summary_resolution=.025,
+        archive_after_days=365.,
+        batch_size=20,
+        step_interval=.5,
+        vacuum_pages=2048,
+        check_interval=3600.,
+    )
+    @classmethod
+    def load(cls, filename):
+        '''Load a policy saved with :meth:`save` (or the defaults if the file
+        does not exist)
+        '''
+        if not os.path.exists(filename):
+            return cls()
+        with open(filename, 'r') as f:
+            s = f.read()
+        return cls.from_json(s)
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.to_json(indent=2))
+
+class RetentionReport(object):
+    '''What a retention pass did and how much space it reclaimed
+
+    Attributes:
+        scans_summarized: Full resolution scans merged into summaries
+        summaries_written: Summaries created or updated
+        summaries_archived: Summaries moved to archive files
+        archive_bytes: Bytes appended to archive files
+        archive_files: Archive files written to
+        bytes_removed: Size of the scan and summary data removed from the
+            database
+        bytes_added: Size of the summary data added to the database
+        db_size_before: Size of the database (in bytes) before the pass
+        db_size_after: Size of the database after the pass
+    '''
+    def __init__(self, db_size=0):
+        self.start_ts = time.time()
+        self.end_ts = None
+        self.scans_summarized = 0
+        self.summaries_written = 0
+        self.summaries_archived = 0
+        self.archive_bytes = 0
+        self.archive_files = set()
+        self.bytes_removed = 0
+        self.bytes_added = 0
+        self.db_size_before = db_size
+        self.db_size_after = db_size
+    @property
+    def space_reclaimed(self):
+        '''Bytes by which the database file shrank
+        '''
+        return self.db_size_before - self.db_size_after
+    @property
+    def duration(self):
+        end_ts = self.end_ts
+        if end_ts is None:
+            end_ts = time.time()
+        return end_ts - self.start_ts
+    def _serialize(self):
+        attrs = ['scans_summarized', 'summaries_written', 'summaries_archived',
+                 'archive_bytes', 'bytes_removed', 'bytes_added',
+                 'db_size_before', 'db_size_after', 'space_reclaimed', 'duration']
+        d = {attr: getattr(self, attr) for attr in attrs}
+        d['archive_files'] = sorted(self.archive_files)
+        return d
+    def __str__(self):
+        return ('summarized %s scans into %s summaries, archived %s summaries '
+                '(%s bytes), database %s -> %s bytes (%s bytes reclaimed) in %.2fs') % (
+            self.scans_summarized, self.summaries_written,
+            self.summaries_archived, self.archive_bytes,
+            self.db_size_before, self.db_size_after, self.space_reclaimed,
+            self.duration)
+
+def max_hold(frequencies, values, resolution):
+    '''Merge sample arrays into one max-hold trace
+
+    params:
+        frequencies: sequence of frequency arrays (in MHz)
+        values: sequence of dBFS arrays for each frequency array
+        resolution: frequency step (in MHz) to bin the samples to
+
+    Returns a tuple of ``(frequencies, dbFS)``
+    '''
+    if not len(frequencies):
+        return np.array([]), np.array([])
+    freqs = np.concatenate([np.asarray(f, dtype=float) for f in frequencies])
+    dbFS = np.concatenate([np.asarray(v, dtype=float) for v in values])
+    bins = np.round(freqs / resolution).astype(np.int64)
+    unique_bins, index = np.unique(bins, return_inverse=True)
+    result = np.empty(unique_bins.size)
+    result.fill(-np.inf)
+    np.maximum.at(result, index, dbFS)
+    return unique_bins * resolution, result
+
+def iter_archive(path):
+    '''Iterate over the summaries stored in the archive files in ``path``
+
+    Yields dicts with the same keys as
+    :meth:`~wwb_scanner.utils.dbstore.DBStore.get_summary`
+    '''
+    if not os.path.exists(path):
+        return
+    for fn in sorted(os.listdir(path)):
+        if not fn.endswith('.jsonl.gz'):
+            continue
+        with gzip.open(os.path.join(path, fn), 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                d = json.loads(line)
+                d['samples'] = decode_samples(
+                    d['samples_format'], base64.b64decode(d['samples']))
+                yield d
+
+class RetentionManager(object):
+    '''Applies a :class:`RetentionPolicy` to a
+    :class:`~wwb_scanner.utils.dbstore.DBStore`
+
+    Recorded scans go through three tiers:
+
+    * The most recent scans are kept as they are
+    * Older scans are merged into one max-hold summary per (UTC) day in the
+      ``scan_summaries`` table and removed
+    * Summaries older than ``archive_after_days`` are appended to gzipped
+      json-lines files (one per month) in ``archive_path`` and removed
+
+    Free pages are then released from the database file. Work is done in
+    steps of at most ``batch_size`` rows (each in its own transaction) so
+    other writers are only held up briefly. Imported scans are not touched.
+
+    params:
+        store: the :class:`~wwb_scanner.utils.dbstore.DBStore`
+        policy: a :class:`RetentionPolicy`
+        archive_path: directory for archive files (defaults to ``archive``
+            next to the database)
+    '''
+    def __init__(self, store, policy=None, archive_path=None):
+        if policy is None:
+            policy = RetentionPolicy()
+        if archive_path is None:
+            archive_path = os.path.join(os.path.dirname(store.db_path), 'archive')
+        self.store = store
+        self.policy = policy
+        self.archive_path = archive_path
+    def get_db_size(self):
+        store = self.store
+        page_size = store.query_one('PRAGMA page_size')[0]
+        return store.query_one('PRAGMA page_count')[0] * page_size
+    def iter_steps(self, report):
+        '''Generator doing one step of work per iteration
+
+        Yields the name of each step done (``'summarize'``, ``'archive'``
+        or ``'compact'``) until there is nothing left to do.
+        '''
+        while self.summarize_step(report):
+            yield 'summarize'
+        while self.archive_step(report):
+            yield 'archive'
+        while self.compact_step(report):
+            yield 'compact'
+    def run(self, step_interval=None, stopped=None):
+        '''Run a full pass and return a :class:`RetentionReport`
+
+        params:
+            step_interval: seconds to sleep between steps (to limit the I/O
+                rate)
+            stopped: optional :class:`threading.Event` to end the pass early
+        '''
+        report = RetentionReport(self.get_db_size())
+        if self.policy.enabled:
+            for step in self.iter_steps(report):
+                if stopped is not None and stopped.is_set():
+                    break
+                if step_interval:
+                    if stopped is not None:
+                        stopped.wait(step_interval)
+                    else:
+                        time.sleep(step_interval)
+        report.db_size_after = self.get_db_size()
+        report.end_ts = time.time()
+        return report
+    def get_expired_scans(self, limit):
+        policy = self.policy
+        cutoff = time.time() - policy.keep_full_days * SECONDS_PER_DAY
+        return self.store.query(
+            'SELECT eid FROM scan_catalog WHERE timestamp_utc IS NOT NULL '
+            'AND timestamp_utc < ? AND eid NOT IN ('
+            'SELECT eid FROM scan_catalog ORDER BY timestamp_utc DESC, eid DESC LIMIT ?) '
+            'ORDER BY timestamp_utc, eid LIMIT ?',
+            (cutoff, policy.keep_full_scans, limit))
+    def summarize_step(self, report):
+        '''Merge a batch of expired scans into their daily summaries
+
+        Returns False if there were no expired scans
+        '''
+        store = self.store
+        resolution = self.policy.summary_resolution
+        with store.batch():
+            eids = [row[0] for row in self.get_expired_scans(self.policy.batch_size)]
+            if not eids:
+                return False
+            days = {}
+            for eid in eids:
+                row = store.query_one(
+                    'SELECT s.timestamp_utc, s.samples_format, s.samples, '
+                    'length(s.data) + ifnull(length(s.samples), 0) + '
+                    'ifnull(length(c.preview), 0) '
+                    'FROM scans_performed s JOIN scan_catalog c ON c.eid = s.eid '
+                    'WHERE s.eid=?', (eid,))
+                if row is None:
+                    continue
+                timestamp_utc, samples_format, samples, size = row
+                day = (timestamp_utc // SECONDS_PER_DAY) * SECONDS_PER_DAY
+                days.setdefault(day, []).append(
+                    (eid, decode_samples(samples_format, samples)))
+                report.bytes_removed += size
+            for day, scans in sorted(days.items()):
+                self.write_summary(day, resolution, scans, report)
+            params = ', '.join(['?'] * len(eids))
+            store.execute('DELETE FROM scans_performed WHERE eid IN (%s)' % (params), eids)
+            store.execute('DELETE FROM scan_catalog WHERE eid IN (%s)' % (params), eids)
+        report.scans_summarized += len(eids)
+        return True
+    def write_summary(self, day, resolution, scans, report):
+        store = self.store
+        freqs = [samples['frequency'] for eid, samples in scans]
+        dbFS = [samples['dbFS'] for eid, samples in scans]
+        scan_eids = [eid for eid, samples in scans]
+        summary = store.get_summary(day=day, resolution=resolution)
+        if summary is not None:
+            freqs.append(summary['samples']['frequency'])
+            dbFS.append(summary['samples']['dbFS'])
+            scan_eids = summary['scan_eids'] + scan_eids
+            report.bytes_removed += summary['size']
+        freqs, dbFS = max_hold(freqs, dbFS, resolution)
+        samples = store.encode_samples(freqs, dbFS)
+        scan_eids_json = json.dumps(scan_eids)
+        values = [day, resolution,
+                  float(freqs[0]) if freqs.size else None,
+                  float(freqs[-1]) if freqs.size else None,
+                  len(scan_eids), scan_eids_json, store.samples_format,
+                  freqs.size, sqlite3.Binary(samples)]
+        keys = ['day', 'resolution', 'start_freq', 'end_freq', 'num_scans',
+                'scan_eids', 'samples_format', 'num_samples', 'samples']
+        if summary is not None:
+            assignments = ', '.join('%s=?' % (key) for key in keys)
+            store.execute('UPDATE scan_summaries SET %s WHERE eid=?' % (assignments),
+                          values + [summary['eid']])
+        else:
+            store.execute('INSERT INTO scan_summaries (%s) VALUES (%s)' % (
+                ', '.join(keys), ', '.join(['?'] * len(keys))), values)
+        report.bytes_added += len(samples) + len(scan_eids_json)
+        report.summaries_written += 1
+    def archive_step(self, report):
+        '''Move a batch of summaries older than ``archive_after_days`` to the
+        archive files
+
+        Returns False if there was nothing to archive
+        '''
+        policy = self.policy
+        if policy.archive_after_days is None:
+            return False
+        store = self.store
+        cutoff = time.time() - policy.archive_after_days * SECONDS_PER_DAY
+        with store.batch():
+            rows = store.query(
+                'SELECT eid FROM scan_summaries WHERE day < ? ORDER BY day LIMIT ?',
+                (cutoff, policy.batch_size))
+            if not rows:
+                return False
+            by_month = {}
+            for (eid,) in rows:
+                summary = store.get_summary(eid=eid, decode=False)
+                dt = datetime.datetime.utcfromtimestamp(summary['day'])
+                by_month.setdefault(dt.strftime('%Y-%m'), []).append(summary)
+            if not os.path.exists(self.archive_path):
+                os.makedirs(self.archive_path)
+            for month, summaries in sorted(by_month.items()):
+                filename = os.path.join(self.archive_path, 'summaries_%s.jsonl.gz' % (month))
+                report.archive_bytes += self.write_archive(filename, summaries)
+                report.archive_files.add(filename)
+            # Rows are only removed once the archive files are on disk.
+            # If interrupted before the commit, the summaries are archived
+            # again on the next pass (readers keep the last copy of an eid)
+            eids = [row[0] for row in rows]
+            report.bytes_removed += sum(s['size'] for summaries in by_month.values()
+                                        for s in summaries)
+            store.execute('DELETE FROM scan_summaries WHERE eid IN (%s)' % (
+                ', '.join(['?'] * len(eids))), eids)
+        report.summaries_archived += len(rows)
+        return True
+    def write_archive(self, filename, summaries):
+        start_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        # Each write appends a new gzip member, which gzip readers handle
+        # as one stream
+        with open(filename, 'ab') as fp:
+            with gzip.GzipFile(fileobj=fp, mode='wb') as f:
+                for summary in summaries:
+                    d = dict(summary)
+                    d.pop('size')
+                    d['samples'] = base64.b64encode(d['samples'])
+                    f.write(json.dumps(d))
+                    f.write('\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        return os.path.getsize(filename) - start_size
+    def compact_step(self, report):
+        '''Release up to ``vacuum_pages`` free pages from the database file
+
+        Databases created before incremental vacuuming was enabled are
+        vacuumed completely once to switch them over.
+
+        Returns False if there were no free pages
+        '''
+        store = self.store
+        with store.lock:
+            free_pages = store.query_one('PRAGMA freelist_count')[0]
+            if not free_pages:
+                return False
+            store.conn.commit()
+            if store.query_one('PRAGMA auto_vacuum')[0] != 2:
+                logger.info('vacuuming %s to enable incremental vacuum', store.db_path)
+                store.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                store.conn.execute('VACUUM')
+            else:
+                store.conn.execute(
+                    'PRAGMA incremental_vacuum(%d)' % (self.policy.vacuum_pages)).fetchall()
+            store.conn.commit()
+        return True
+
+class RetentionWorker(threading.Thread):
+    '''Background thread applying a :class:`RetentionPolicy` every
+    ``check_interval`` seconds
+
+    The latest :class:`RetentionReport` is kept in :attr:`report`.
+    '''
+    def __init__(self, manager):
+        super(RetentionWorker, self).__init__(name='RetentionWorker')
+        self.daemon = True
+        self.manager = manager
+        self.report = None
+        self.stopped = threading.Event()
+    def run(self):
+        manager = self.manager
+        policy = manager.policy
+        while not self.stopped.is_set():
+            try:
+                report = manager.run(step_interval=policy.step_interval,
+                                     stopped=self.stopped)
+            except Exception:
+                logger.exception('retention pass failed')
+            else:
+                self.report = report
+                if report.scans_summarized or report.summaries_archived:
+                    logger.info('retention: %s', report)
+            self.stopped.wait(policy.check_interval)
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,102 @@
+import zlib
+import struct
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Encodings for the samples of a spectrum (frequency in MHz and dBFS)
+#
+# 'f64': frequency/dBFS pairs as little-endian float64 (lossless)
+# 'q16z': zlib compressed, with frequencies stored as a start frequency and
+#   integer deltas (in units of ``freq_resolution`` Hz) and dBFS quantized to
+#   ``db_resolution`` dB as int16
+SAMPLES_DTYPE = np.dtype([('frequency', '<f8'), ('dbFS', '<f8')])
+SAMPLE_FORMATS = ['f64', 'q16z']
+DEFAULT_FORMAT = 'q16z'
+
+DB_RESOLUTION = .01
+FREQ_RESOLUTION = 1.
+
+# num_points, start frequency (MHz), freq_resolution (Hz), db_resolution (dB)
+Q16_HEADER_STRUCT = struct.Struct('<Iddd')
+Q16_MIN = -32766
+Q16_MAX = 32766
+# Stored for values of -inf (a power of zero)
+Q16_NEG_INF = -32768
+# Stored for NaN values
+Q16_NAN = -32767
+
+def encode_samples(frequencies, dbFS, samples_format=DEFAULT_FORMAT, **kwargs):
+    '''Encode sample values as bytes
+
+    params:
+        frequencies: sorted frequencies (in MHz)
+        dbFS: the value for each frequency
+        samples_format: one of :data:`SAMPLE_FORMATS`
+        db_resolution: quantization step of dBFS values for ``'q16z'``.
+            Values outside of +/- ``db_resolution * 32766`` are clipped
+            (with a logged warning). NaN and -inf are stored as such
+        freq_resolution: quantization step of frequencies (in Hz) for
+            ``'q16z'``
+    '''
+    if samples_format == 'f64':
+        a = np.empty(len(frequencies), dtype=SAMPLES_DTYPE)
+        a['frequency'] = frequencies
+        a['dbFS'] = dbFS
+        return a.tostring()
+    if samples_format != 'q16z':
+        raise ValueError('Unknown samples format: %s' % (samples_format))
+    db_resolution = kwargs.get('db_resolution', DB_RESOLUTION)
+    freq_resolution = kwargs.get('freq_resolution', FREQ_RESOLUTION)
+    freqs = np.asarray(frequencies, dtype=np.float64)
+    dbFS = np.asarray(dbFS, dtype=np.float64)
+    start_freq = freqs[0] if freqs.size else 0.
+    steps = np.round((freqs - start_freq) * (1e6 / freq_resolution)).astype(np.int64)
+    deltas = np.diff(steps).astype('<i4')
+    q = np.round(dbFS / db_resolution)
+    nan = np.isnan(dbFS)
+    neg_inf = np.isneginf(dbFS)
+    q[nan] = 0
+    clipped = np.count_nonzero((q < Q16_MIN) | (q > Q16_MAX)) - np.count_nonzero(neg_inf)
+    if clipped:
+        logger.warning('%d dBFS values outside of +/- %s clipped',
+                       clipped, Q16_MAX * db_resolution)
+    q = np.clip(q, Q16_MIN, Q16_MAX).astype('<i2')
+    q[nan] = Q16_NAN
+    q[neg_inf] = Q16_NEG_INF
+    header = Q16_HEADER_STRUCT.pack(freqs.size, start_freq, freq_resolution, db_resolution)
+    return header + zlib.compress(deltas.tostring() + q.tostring())
+
+def decode_samples(samples_format, data):
+    '''Decode bytes written by :func:`encode_samples`
+
+    Returns a structured array with ``frequency`` and ``dbFS`` fields
+    '''
+    if data is None:
+        return np.empty(0, dtype=SAMPLES_DTYPE)
+    data = bytes(data)
+    if samples_format == 'f64':
+        return np.frombuffer(data, dtype=SAMPLES_DTYPE)
+    if samples_format != 'q16z':
+        raise ValueError('Unknown samples format: %s' % (samples_format))
+    header_size = Q16_HEADER_STRUCT.size
+    num_points, start_freq, freq_resolution, db_resolution = Q16_HEADER_STRUCT.unpack(
+        data[:header_size])
+    a = np.empty(num_points, dtype=SAMPLES_DTYPE)
+    if not num_points:
+        return a
+    payload = zlib.decompress(data[header_size:])
+    deltas = np.frombuffer(payload, dtype='<i4', count=num_points - 1)
+    q = np.frombuffer(payload, dtype='<i2', offset=deltas.nbytes, count=num_points)
+    steps = np.zeros(num_points, dtype=np.int64)
+    np.cumsum(deltas, out=steps[1:])
+    # Round to the resolution so decoded frequencies are stable dict keys
+    decimals = max(int(np.ceil(-np.log10(freq_resolution / 1e6))), 0)
+    a['frequency'] = np.round(start_freq + steps * (freq_resolution / 1e6), decimals)
+    dbFS = q * db_resolution
+    dbFS[q == Q16_NEG_INF] = -np.inf
+    dbFS[q == Q16_NAN] = np.nan
+    a['dbFS'] = dbFS
+    return a